@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class ChatappConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'ChatApp'
+
+    def ready(self):
+        # connect the receiver that drops the cached user of a session when it logs out,
+        # - the logout view may run in a process that never imports asgi.py, e.g. under WSGI
+        from . import auth  # noqa: F401
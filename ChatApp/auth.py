@@ -0,0 +1,164 @@
+# a cache of the user of each session for the WebSocket handshakes
+# - channels.auth.AuthMiddleware reads the session & the user from the database on a thread for every connection,
+#   so a reconnect storm, e.g. after a deploy, queues thousands of reads on the thread pool & every handshake waits
+# - CachedAuthMiddleware keeps the user of each session for CHAT_AUTH_CACHE_TTL seconds, so the reconnects of a
+#   session after the first are answered from memory & a connection without a session cookie never leaves the event loop
+# the cache is chosen with the CHAT_AUTH_CACHE_BACKEND setting
+# - LocalAuthCache keeps the users in this process
+# - RedisAuthCache keeps them in Redis, shared by every worker
+# a session is dropped from the cache when it logs out, & a changed password is noticed within the TTL
+import asyncio
+import pickle
+import time
+from collections import OrderedDict
+
+from channels.auth import AuthMiddleware, get_user
+from channels.sessions import CookieMiddleware, SessionMiddleware
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_out
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.functional import LazyObject, empty
+from django.utils.module_loading import import_string
+
+from . import metrics
+
+# the prefix of the cached user of each session in Redis
+AUTH_KEY_PREFIX = "chat:auth:"
+
+
+class LocalAuthCache:
+    """The user of each session in a dictionary of this process, the least recently used session is dropped first.
+
+    The settings are read when the cache is created:
+
+    - ``CHAT_AUTH_CACHE_TTL``: the seconds a user is kept
+    - ``CHAT_AUTH_CACHE_SIZE``: the sessions kept
+    """
+
+    def __init__(self):
+        self.ttl = getattr(settings, "CHAT_AUTH_CACHE_TTL", 30)
+        self.size = getattr(settings, "CHAT_AUTH_CACHE_SIZE", 10000)
+        # session key -> (the time.monotonic() value when the user expires, user)
+        self._users = OrderedDict()
+
+    async def get(self, session_key):
+        """Return the cached user of a session.
+
+        :param session_key: The key of the session.
+        :type session_key: str
+        :return: The user, or None if the session isn't cached.
+        :rtype: User or AnonymousUser or None
+        """
+        entry = self._users.get(session_key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._users.pop(session_key, None)
+            return None
+        self._users.move_to_end(session_key)
+        return entry[1]
+
+    async def set(self, session_key, user):
+        self._users[session_key] = (time.monotonic() + self.ttl, user)
+        self._users.move_to_end(session_key)
+        if len(self._users) > self.size:
+            self._users.popitem(last=False)
+
+    def delete(self, session_key):
+        """Drop a session, called from the thread of the logout view."""
+        self._users.pop(session_key, None)
+
+
+class RedisAuthCache:
+    """The user of each session in Redis, pickled, so a logout is seen by every worker.
+
+    The settings are read when the cache is created:
+
+    - ``CHAT_AUTH_CACHE_TTL``: the seconds a user is kept
+    - ``CHAT_AUTH_CACHE_REDIS_URL``: the Redis server
+    """
+
+    def __init__(self):
+        self.ttl = getattr(settings, "CHAT_AUTH_CACHE_TTL", 30)
+        self.url = getattr(settings, "CHAT_AUTH_CACHE_REDIS_URL", "redis://127.0.0.1:6379/0")
+        # a pool is bound to the event loop it was created on, so keep one client per loop
+        self._clients = {}
+
+    def client(self):
+        """Return the Redis client for the running event loop."""
+        import redis.asyncio
+
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = self._clients[loop] = redis.asyncio.Redis.from_url(self.url)
+        return client
+
+    async def get(self, session_key):
+        data = await self.client().get(f"{AUTH_KEY_PREFIX}{session_key}")
+        return None if data is None else pickle.loads(data)
+
+    async def set(self, session_key, user):
+        await self.client().set(f"{AUTH_KEY_PREFIX}{session_key}", pickle.dumps(user), ex=self.ttl)
+
+    def delete(self, session_key):
+        # the logout view runs on a thread without an event loop, so use a synchronous client
+        import redis
+
+        with redis.Redis.from_url(self.url) as client:
+            client.delete(f"{AUTH_KEY_PREFIX}{session_key}")
+
+
+class DefaultAuthCache(LazyObject):
+    """The auth cache chosen by the ``CHAT_AUTH_CACHE_BACKEND`` setting, created when it's first used."""
+
+    def _setup(self):
+        self._wrapped = import_string(getattr(settings, "CHAT_AUTH_CACHE_BACKEND", "ChatApp.auth.LocalAuthCache"))()
+
+
+# the users of the sessions shared by every handshake in this worker
+auth_cache = DefaultAuthCache()
+
+
+@receiver(setting_changed)
+def _reset_auth_cache(setting, **kwargs):
+    # create the cache again when the tests change it
+    if setting.startswith("CHAT_AUTH_CACHE_"):
+        auth_cache._wrapped = empty
+
+
+@receiver(user_logged_out)
+def _forget_logged_out_session(sender, request, **kwargs):
+    # the session still has its key when the signal is sent, it's flushed afterwards
+    session_key = request.session.session_key if hasattr(request, "session") else None
+    if session_key:
+        auth_cache.delete(session_key)
+
+
+class CachedAuthMiddleware(AuthMiddleware):
+    """Populate scope["user"] like channels.auth.AuthMiddleware, from :data:`auth_cache` when it has the session."""
+
+    async def resolve_scope(self, scope):
+        from django.contrib.auth.models import AnonymousUser
+
+        session_key = scope["session"].session_key
+        if not session_key:
+            # no session cookie, so there is no user to read from the database
+            scope["user"]._wrapped = AnonymousUser()
+            return
+
+        user = await auth_cache.get(session_key)
+        if user is not None:
+            metrics.AUTH_CACHE.inc("hit")
+        else:
+            metrics.AUTH_CACHE.inc("miss")
+            user = await get_user(scope)
+            # an unknown or expired session is cached as AnonymousUser too, so it doesn't hit the database again
+            await auth_cache.set(session_key, user)
+        scope["user"]._wrapped = user
+
+
+def CachedAuthMiddlewareStack(inner):
+    """Wrap a WebSocket application like channels.auth.AuthMiddlewareStack, with the cached user lookup."""
+    return CookieMiddleware(SessionMiddleware(CachedAuthMiddleware(inner)))
@@ -0,0 +1,102 @@
+# send the chat messages of a busy room to a client in batches
+# - every message is its own WebSocket frame by default, so a room with hundreds of messages per second costs every
+#   member hundreds of frames per second, each with its own header, write & wakeup on the server & in the browser
+# - a client that opts in collects the messages for a few milliseconds or up to a number of messages
+#   & receives them as one frame: {"type": "batch", "messages": [{...}, {...}]}
+# the client asks for batching when it connects with ?batch=<milliseconds>&batch_size=<messages>
+# - the server caps both with CHAT_BATCH_MAX_WINDOW & CHAT_BATCH_MAX_SIZE & replies with the values it uses:
+#   {"type": "batching", "window": <milliseconds>, "size": <messages>}
+import asyncio
+import logging
+from urllib.parse import parse_qs
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def negotiate_batching(scope):
+    """Return the batching a client asked for in the query string of its WebSocket URL, within the server's caps.
+
+    :param scope: The scope of the connection.
+    :type scope: dict
+    :return: The (window in seconds, most messages per batch), or None if the client didn't ask for batching.
+    :rtype: tuple or None
+    """
+    query = parse_qs(scope.get("query_string", b"").decode())
+    try:
+        window = float(query.get("batch", ["0"])[0]) / 1000
+        size = int(query.get("batch_size", ["0"])[0])
+    except ValueError:
+        return None
+    if window <= 0:
+        return None
+    max_size = getattr(settings, "CHAT_BATCH_MAX_SIZE", 100)
+    window = min(window, getattr(settings, "CHAT_BATCH_MAX_WINDOW", 0.05))
+    size = max_size if size <= 0 else min(size, max_size)
+    return window, size
+
+
+def batch_frame(frames):
+    """Join the JSON strings of chat messages into a batch frame without serializing the messages again.
+
+    :param frames: The JSON strings of the messages, oldest first.
+    :type frames: list
+    :return: The JSON string of the batch frame.
+    :rtype: str
+    """
+    return '{"type": "batch", "messages": [%s]}' % ",".join(frames)
+
+
+class MessageBatcher:
+    """The chat messages waiting to be sent to one client as a batch frame.
+
+    A batch is sent ``window`` seconds after its first message, or as soon as it has ``size`` messages.
+
+    :param send: An asynchronous function that sends the JSON string of a frame to the WebSocket.
+    :type send: callable
+    :param window: The seconds a message waits for others to join its batch.
+    :type window: float
+    :param size: The most messages in a batch.
+    :type size: int
+    """
+
+    def __init__(self, send, window, size):
+        self.send = send
+        self.window = window
+        self.size = size
+        self.frames = []
+        self._flush_task = None
+
+    async def add(self, frame):
+        """Add the JSON string of a message to the current batch.
+
+        :param frame: The JSON string of the message.
+        :type frame: str
+        """
+        self.frames.append(frame)
+        if len(self.frames) >= self.size:
+            self.close()
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self._flush_task = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Failed to send a batch of chat messages")
+
+    async def flush(self):
+        """Send the messages of the current batch as one frame."""
+        frames, self.frames = self.frames, []
+        if frames:
+            await self.send(batch_frame(frames))
+
+    def close(self):
+        """Cancel the timer of the current batch."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
@@ -0,0 +1,183 @@
+# encode & decode the JSON frames sent over the WebSockets
+# - the consumers use these functions instead of calling json directly so a faster library can be swapped in
+# - orjson is optional, it is used when it's installed unless CHAT_FAST_JSON is set to False in settings.py
+# the consumers build every frame as JSON, a connection that negotiated another wire format has its frames converted
+# - when they are sent, see WireFormat below
+import json
+import zlib
+from collections import OrderedDict
+
+import msgpack
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# use orjson when it's installed & allowed, the name of the library in use is shown by the broadcast benchmark
+if orjson is not None and getattr(settings, "CHAT_FAST_JSON", True):
+    name = "orjson"
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+else:
+    name = "json"
+    _dumps = None
+    _loads = json.loads
+
+
+def dumps(obj):
+    """Convert a Python object into a JSON-formatted string.
+
+    :param obj: The object to convert.
+    :type obj: dict or list
+    :return: The JSON-formatted string.
+    :rtype: str
+    """
+    if _dumps is None:
+        return json.dumps(obj)
+    # orjson returns bytes but a text frame must be sent as a str
+    return _dumps(obj).decode()
+
+
+def loads(text_data):
+    """Convert a JSON-formatted string into a Python object.
+
+    :param text_data: The JSON-formatted string received from the WebSocket.
+    :type text_data: str or bytes
+    :return: The Python object.
+    :rtype: dict or list
+    """
+    return _loads(text_data)
+
+
+# the wire formats a client can ask for with the subprotocols of its WebSocket, in the server's names
+# - "chat.json": JSON text frames, the default when the client doesn't ask for a subprotocol
+# - "chat.msgpack": msgpack binary frames, smaller & faster to parse on mobile clients
+# - "chat.json.deflate" & "chat.msgpack.deflate": the same with the frames over CHAT_COMPRESS_MIN_SIZE compressed,
+#   e.g. the history sent to a new member
+# a compressed frame is a binary frame, with the JSON format it is the zlib-compressed JSON text
+# - & with msgpack it is {"type": "deflate", "data": <the zlib-compressed msgpack frame>} packed with msgpack
+class WireFormat:
+    """How the frames of a connection are encoded on the wire.
+
+    The frames of a room are the same strings for every member, so the encoded frames are cached by their JSON
+    string & a frame sent to many members of the same format is converted once per worker.
+
+    :param binary: Whether the frames are msgpack instead of JSON.
+    :type binary: bool
+    :param compress: Whether the frames over ``CHAT_COMPRESS_MIN_SIZE`` characters are compressed.
+    :type compress: bool
+    """
+
+    # the most frames kept in the cache of each format
+    cache_size = 1024
+
+    def __init__(self, binary=False, compress=False):
+        self.binary = binary
+        self.compress = compress
+        self.subprotocol = "chat." + ("msgpack" if binary else "json") + (".deflate" if compress else "")
+        self._cache = OrderedDict()
+
+    def encode(self, text):
+        """Return the ASGI websocket.send message of a frame.
+
+        :param text: The JSON string of the frame.
+        :type text: str
+        :return: The message with the "text" or the "bytes" of the frame.
+        :rtype: dict
+        """
+        compress = self.compress and len(text) >= getattr(settings, "CHAT_COMPRESS_MIN_SIZE", 4096)
+        if not self.binary and not compress:
+            return {"type": "websocket.send", "text": text}
+
+        data = self._cache.get(text)
+        if data is None:
+            data = msgpack.packb(loads(text)) if self.binary else text.encode()
+            if compress:
+                data = zlib.compress(data)
+                if self.binary:
+                    data = msgpack.packb({"type": "deflate", "data": data})
+            self._cache[text] = data
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(text)
+        return {"type": "websocket.send", "bytes": data}
+
+    def decode(self, text_data=None, bytes_data=None):
+        """Convert a frame received from the WebSocket into a Python object.
+
+        :param text_data: The frame if it was a text frame.
+        :type text_data: str or None
+        :param bytes_data: The frame if it was a binary frame.
+        :type bytes_data: bytes or None
+        :return: The Python object.
+        :rtype: dict or list
+        """
+        if text_data is not None:
+            return loads(text_data)
+        if self.binary:
+            return msgpack.unpackb(bytes_data)
+        return loads(bytes_data)
+
+    def sender(self, send, subprotocol=None):
+        """Wrap the ASGI send function of a connection to encode its frames.
+
+        :param send: The ASGI send function.
+        :type send: callable
+        :param subprotocol: The subprotocol to accept the connection with, if the client asked for one.
+        :type subprotocol: str or None
+        :return: An asynchronous function that takes an ASGI message.
+        :rtype: callable
+        """
+        async def send_encoded(message):
+            if message["type"] == "websocket.send" and message.get("text") is not None:
+                message = self.encode(message["text"])
+            elif message["type"] == "websocket.accept" and subprotocol is not None:
+                # a browser that asked for subprotocols drops the connection unless one of them is accepted
+                message = {**message, "subprotocol": subprotocol}
+            await send(message)
+
+        return send_encoded
+
+
+# the formats by subprotocol
+JSON = WireFormat()
+WIRE_FORMATS = {
+    wire_format.subprotocol: wire_format
+    for wire_format in (
+        JSON,
+        WireFormat(compress=True),
+        WireFormat(binary=True),
+        WireFormat(binary=True, compress=True),
+    )
+}
+
+
+def negotiate(scope):
+    """Return the wire format of a connection, the first subprotocol the client asked for that the server knows.
+
+    :param scope: The scope of the connection.
+    :type scope: dict
+    :return: The wire format, JSON if the client didn't ask for one the server knows.
+    :rtype: WireFormat
+    """
+    for subprotocol in scope.get("subprotocols") or ():
+        if subprotocol in WIRE_FORMATS:
+            return WIRE_FORMATS[subprotocol]
+    return JSON
+
+
+class WireFormatMixin:
+    """Send & receive the frames of a consumer in the wire format its client negotiated.
+
+    The consumer keeps building its frames as JSON strings, they are converted when they are sent.
+    """
+
+    wire_format = JSON
+
+    async def __call__(self, scope, receive, send):
+        self.wire_format = negotiate(scope)
+        subprotocol = self.wire_format.subprotocol if self.wire_format.subprotocol in (scope.get("subprotocols") or ()) else None
+        await super().__call__(scope, receive, self.wire_format.sender(send, subprotocol))
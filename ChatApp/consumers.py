@@ -1,6 +1,11 @@
-# import json to encode and decode JSON data
-# - messages received from the WebSocket and sent to the WebSocket are formatted as JSON strings
-import json
+# import logging to log the presence connections at debug level
+import logging
+# import uuid to give every message an id, so the consumers of a room in the same worker can recognise the same message
+import uuid
+# import time to measure the latency of the messages for the metrics
+import time
+# import parse_qs to read the username from the query string of the WebSocket URL
+from urllib.parse import parse_qs
 
 # https://channels.readthedocs.io/en/latest/tutorial/part_2.html#write-your-first-consumer
 # write a basic consumer that accepts WebSocket connections on the path /ws/ChatApp/ROOM_NAME/,
@@ -22,6 +27,86 @@ from channels.generic.websocket import AsyncWebsocketConsumer
 # import get_channel_layer because...
 from channels.layers import get_channel_layer
 
+# import timezone to timestamp messages with the time the server received them
+from django.utils import timezone
+
+# import the codec to encode and decode JSON data
+# - messages received from the WebSocket and sent to the WebSocket are formatted as JSON strings
+# - the codec uses orjson when it's installed & falls back to the json module
+from . import codec
+from .codec import WireFormatMixin
+# import the metrics recorded by the consumers
+from . import metrics
+from .metrics import count_errors
+
+# import the functions that save and read the history of a chat room
+from .history import get_history_async, save_message
+# import the per-room store of the users who are online
+from .presence import presence_diffs, presence_group_name, presence_store, start_sweeper
+# import the cache of the latest messages of each room that is sent to new members of a room
+from .recent import catchup_frame, history_frame, recent_messages
+# import the sequence numbers of the rooms, stamped on every message so a reconnecting client can catch up
+from .sequence import room_sequences
+# import the mixin that sends the frames of a connection through a bounded queue
+# - so a slow client can't hold up the consumer that sends the group messages to it
+# - WireFormatMixin comes first so the frames are converted to the client's wire format by the queue's writer
+from .outbox import SendQueueMixin
+# import the flood control that limits the size & the rate of the frames a client sends
+from .ratelimit import FloodControl
+# import the batching of the chat messages sent to a client that asked for it when it connected
+from .batching import MessageBatcher, negotiate_batching
+# import the shard of each room, for a deployment that keeps the members of a room in one process
+from .sharding import SHARD_MOVED_CLOSE_CODE, shard_map
+# import the mixin that pings the quiet connections & closes the idle ones
+# - it comes first so a pong is dropped before the frame reaches the other mixins
+from .liveness import LivenessMixin
+# import the directory of the active rooms that counts the members of each room
+from .directory import DIRECTORY_GROUP, directory_snapshot, join_room, leave_room
+
+logger = logging.getLogger(__name__)
+
+# convert an optional cursor or limit from a client frame to an int
+def _optional_int(value):
+    return None if value is None else int(value)
+
+# read the username from the query string of a WebSocket connection
+def _query_username(scope):
+    query = parse_qs(scope.get("query_string", b"").decode())
+    return query.get("username", [""])[0]
+
+# read the sequence number of the last message a reconnecting client saw from the query string, e.g. ?since=42
+def _query_since(scope):
+    query = parse_qs(scope.get("query_string", b"").decode())
+    try:
+        return int(query["since"][0])
+    except (KeyError, ValueError):
+        return None
+
+# tell a client that its frame was rejected by the flood control
+async def _reject(consumer, limit):
+    # a frame that is too big is a broken or hostile client, so close the connection with 1009 (message too big)
+    if limit == "frame_size":
+        await consumer.close(code=1009)
+    else:
+        await consumer.send(text_data=codec.dumps({"type": "error", "error": "rate limited", "limit": limit}))
+
+# send a client whose room lives on another shard to that shard
+# - the connection is accepted first if it wasn't, so the client can read where to go before the close
+# - every process sends "shard.moved" to the room's groups, so a client already redirected isn't sent it again
+async def _redirect_to_shard(consumer, room_name, reason="connect"):
+    if getattr(consumer, "redirected", False):
+        return True
+    shard = shard_map.redirect_for(room_name)
+    if shard is None:
+        return False
+    consumer.redirected = True
+    metrics.SHARD_REDIRECTS.inc(reason)
+    if reason == "connect":
+        await consumer.accept()
+    await consumer.send(text_data=codec.dumps({"type": "redirect", **shard}))
+    await consumer.close(code=SHARD_MOVED_CLOSE_CODE)
+    return True
+
 # when Channels accepts a WebSocket connection, it consults the root routing configuration to lookup a consumer,
 # - and then calls various functions on the consumer to handle events from the connection.
 # https://channels.readthedocs.io/en/latest/tutorial/part_2.html#enable-a-channel-layer
@@ -34,7 +119,7 @@ from channels.layers import get_channel_layer
 # change all methods from just def to async def 
 # change async_to_sync to await when joining, leaving & sending messages in a room
 # - because it's used to call asynchronous functions that perform network I/O (Involves sending/receiving data over a network)
-class ChatConsumer(AsyncWebsocketConsumer):
+class ChatConsumer(LivenessMixin, WireFormatMixin, SendQueueMixin, AsyncWebsocketConsumer):
     """Create a ChatConsumer class.
 
     :param AsyncWebsocketConsumer: The ChatConsumer class inherits from AsyncWebsocketConsumer 
@@ -56,27 +141,58 @@ class ChatConsumer(AsyncWebsocketConsumer):
         # - code will fail if the room name contains any invalid characters or exceeds the length limit
         self.room_group_name = f"chat_{self.room_name}"
 
+        # send the client to the shard of the room when the rooms are sharded, e.g. after a shard joined
+        if await _redirect_to_shard(self, self.room_name):
+            return
+
+        # the username of the logged in user, or the username the browser passed in the query string
+        # - e.g. ws://host/ws/ChatApp/lobby/?username=alice
+        self.username = self.scope["user"].username or _query_username(self.scope)
+
+        # the limits on the size & the rate of the frames this client sends
+        self.flood_control = FloodControl(self.room_name)
+
         # Join room group
         # Asynchronously join the WebSocket connection to a group.
         # add the current WebSocket connection (identified by its channel name) to a group (identified by room_group_name).
         # This allows the WebSocket connection to receive messages sent to this group.
-        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        await count_errors("group_add", self.channel_layer.group_add(self.room_group_name, self.channel_name))
 
         # Accept the WebSocket connection.
         # If you do not call accept() within the connect() method then the connection will be rejected and closed. 
         # (*but you can reject a connection if the requesting user is not authorised to perform the requested action.)
         # It is recommended that accept() be called as the last action in connect() if you choose to accept the connection.
         await self.accept()
+        metrics.ACTIVE_CONNECTIONS.inc()
+        self.counted = True
+        shard_map.join(self.room_name)
+        # count the member in the directory of the active rooms
+        await join_room(self.room_name)
+        # the recent messages of the room are cached while this worker has members in it
+        recent_messages.join(self.room_name)
+
+        # send the chat messages in batch frames if the client asked for it, e.g. ?batch=20&batch_size=50
+        # - & tell it the window & the size the server agreed to
+        self.batcher = None
+        batching = negotiate_batching(self.scope)
+        if batching is not None:
+            window, size = batching
+            self.batcher = MessageBatcher(lambda text_data: self.send(text_data=text_data), window, size)
+            await self.send(text_data=codec.dumps({"type": "batching", "window": window * 1000, "size": size}))
+
+        # send the latest messages of the room straight after accepting the connection
+        await self.send_recent_messages()
 
         # send a message to the presence consumer that there is a new user online
-        await self.channel_layer.send(
+        await count_errors("send", self.channel_layer.send(
             "presence_channel",
             {
                 "type":"add_user",
+                "room_name": self.room_name,
                 "room_group_name": self.room_group_name,
-                "username":self.scope["user"].username,
+                "username":self.username,
             }
-        )
+        ))
 
     # disconnect from WebSocket
     async def disconnect(self, close_code):
@@ -85,32 +201,80 @@ class ChatConsumer(AsyncWebsocketConsumer):
         :param close_code: A numerical code indicating the reason for the WebSocket connection closure.
         :type close_code: int
         """
+        # a client sent to another shard while connecting never joined the room here
+        # - a member redirected because its room moved joined it, so it leaves it like any other member
+        if getattr(self, "redirected", False) and not getattr(self, "counted", False):
+            return
+
         # Leave room group
         # Asynchronously remove the current WebSocket connection (id by its channel name) from a group (id by room_group_name)
         # - ensures that the WebSocket connection will no longer receive messages sent to this group.
-        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        await count_errors("group_discard", self.channel_layer.group_discard(self.room_group_name, self.channel_name))
+        # the messages waiting for a batch are dropped with the connection
+        if getattr(self, "batcher", None) is not None:
+            self.batcher.close()
+        if getattr(self, "counted", False):
+            metrics.ACTIVE_CONNECTIONS.dec()
+            self.counted = False
+            shard_map.leave(self.room_name)
+            await leave_room(self.room_name)
+            # the worker stops receiving the room's messages once its last member leaves, so its cache would go stale
+            recent_messages.leave(self.room_name)
 
         # send a message to the presence consumer that a user disconnected from the chat app & to remove user 
-        await self.channel_layer.send(
+        await count_errors("send", self.channel_layer.send(
             "presence_channel",
             {
                 "type":"remove_user",
+                "room_name": self.room_name,
                 "room_group_name": self.room_group_name,
-                "username":self.scope["user"].username,
+                "username":self.username,
             }
-        )
+        ))
 
     # Receive messages from WebSocket
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """An asynchronous method that receives messages from the WebSocket.
 
         :param text_data: The message received from the WebSocket as a JSON-formatted string.
-        :type text_data: str
+        :type text_data: str or None
+        :param bytes_data: The message received as a binary frame, in the wire format the client negotiated.
+        :type bytes_data: bytes or None
         """
+        # a client sent to another shard is being closed, its frames are ignored
+        if getattr(self, "redirected", False):
+            return
+
         # convert/parse the JSON-formatted string received from the WebSocket into a Python dictionary with the loads method,
         # e.g. "{key:value}" => {key:value}
         # - allowing for the extraction and use of the message content.
-        text_data_json = json.loads(text_data)
+        # reject a frame that is too big or over the connection's rate before spending any time decoding it
+        limit = self.flood_control.check_frame(text_data if text_data is not None else bytes_data)
+        if limit is not None:
+            await _reject(self, limit)
+            return
+
+        received_at = time.perf_counter()
+        text_data_json = self.wire_format.decode(text_data, bytes_data)
+        metrics.JSON_DECODE.observe(time.perf_counter() - received_at)
+        await self.receive_frame(text_data_json, received_at)
+
+    # handle a frame that was decoded from the WebSocket
+    async def receive_frame(self, text_data_json, received_at=None):
+        """An asynchronous method that handles a decoded frame from the WebSocket.
+
+        :param text_data_json: The decoded frame, a chat message or a history request.
+        :type text_data_json: dict
+        :param received_at: The time.perf_counter() value when the frame was received.
+        :type received_at: float or None
+        """
+        if received_at is None:
+            received_at = time.perf_counter()
+
+        # a frame with the type "history" asks for a page of the room's history instead of sending a message
+        if text_data_json.get("type") == "history":
+            await self.send_history(text_data_json)
+            return
 
         # retrieve the value associated with the key "message" from the text_data_json dictionary
         # - it's the actual message content sent through the WebSocket.
@@ -118,15 +282,107 @@ class ChatConsumer(AsyncWebsocketConsumer):
         message = text_data_json["message"]
         username = text_data_json["username"]
 
+        # reject a message that is too long or over the room's rate before it is sent to every member of the room
+        limit = self.flood_control.check_message(message)
+        if limit is not None:
+            await _reject(self, limit)
+            return
+
+        # timestamp the message with the server's time so every client and the saved history show the same time
+        created_at = timezone.now()
+        # number the message so a client that reconnects can ask for the messages after the last one it saw
+        seq = await room_sequences.next(self.room_name)
+
+        # convert the message into the JSON-formatted string sent to the WebSocket once, here, before the fan-out
+        # - every consumer in the group sends this string as it is instead of converting the message again
+        message_id = uuid.uuid4().hex
+        encode_started = time.perf_counter()
+        text_data = codec.dumps(
+            {"message": message, "username": username, "timestamp": created_at.isoformat(), "seq": seq}
+        )
+        metrics.JSON_ENCODE.observe(time.perf_counter() - encode_started)
+
         # Send message to room group
         # send the message to all WebSocket connections that are part of the specified group (room_group_name).
-        # send the message as a dictionary with a type identifier "chat.message" & the actual message content.
+        # send the message as a dictionary with a type identifier "chat.message" & the encoded message.
         # Django Channels uses this type identifier to call the corresponding method in the consumer that handles chat messages
         # - messages will route to chat_message()
-        # send the username associated with the message to all WebSocket connections
-        await self.channel_layer.group_send(
-            self.room_group_name, {"type": "chat.message", "message": message, "username": username}
-        )
+        # send the wall clock time of the group_send so the members can measure how long the message took to arrive
+        await count_errors("group_send", self.channel_layer.group_send(
+            self.room_group_name,
+            {"type": "chat.message", "id": message_id, "seq": seq, "text": text_data, "sent_at": time.time()},
+        ))
+        metrics.RECEIVE_TO_GROUP_SEND.observe(time.perf_counter() - received_at)
+
+        # save the message to the room's history after the fan-out
+        # - the message is written in a batch by the write-behind buffer so it never delays the group_send
+        await save_message(self.room_name, username, message, created_at, seq=seq)
+
+    # send the latest messages of the room to a new member
+    async def send_recent_messages(self):
+        """An asynchronous method that sends the latest messages of the room to the WebSocket as a history frame.
+
+        The messages come from the worker's cache of the room without touching the database.
+        Only a room that isn't cached yet is read from the database, and its messages are added to the cache.
+        A client that reconnects with ?since=<seq> is sent only the messages after that number in a catch-up frame,
+        unless the cache no longer has all of them.
+        """
+        since = _query_since(self.scope)
+        if since is not None:
+            frames = recent_messages.frames_since(
+                self.room_name, since, current=await room_sequences.current(self.room_name)
+            )
+            if frames is not None:
+                metrics.CATCH_UPS.inc("gap")
+                await self.send(text_data=catchup_frame(frames, since))
+                return
+            # the gap is bigger than the cache, so the client starts again from the latest page
+            metrics.CATCH_UPS.inc("snapshot")
+
+        frames = recent_messages.frames(self.room_name)
+        # a full ring may have older messages in the database, a ring with room to spare holds all of them
+        has_more = len(frames) >= recent_messages.per_room
+        if not frames:
+            page = await get_history_async(self.room_name, limit=recent_messages.per_room)
+            # don't cache the page if messages were added to the room while reading it, they would be out of order
+            if not recent_messages.frames(self.room_name):
+                frames = [
+                    recent_messages.add(
+                        self.room_name, f"db:{message['id']}", lambda: codec.dumps(message), seq=message["seq"]
+                    )
+                    for message in page["messages"]
+                ]
+            else:
+                frames = [codec.dumps(message) for message in page["messages"]]
+            has_more = page["has_more"]
+
+        await self.send(text_data=history_frame(frames, has_more))
+
+    # send a page of the room's history to the WebSocket
+    async def send_history(self, request):
+        """An asynchronous method that sends a page of the room's history to the WebSocket.
+
+        :param request: The history request from the client, with optional "before", "after", "before_seq",
+            "after_seq" & "limit" keys.
+        :type request: dict
+        """
+        # the client passes the id of a message as the cursor
+        # - "before" to scroll back through older messages, "after" to fetch the messages it missed
+        # - or the sequence number of a message it received live, which has no id, as "before_seq" or "after_seq"
+        try:
+            page = await get_history_async(
+                self.room_name,
+                before=_optional_int(request.get("before")),
+                after=_optional_int(request.get("after")),
+                limit=_optional_int(request.get("limit")),
+                before_seq=_optional_int(request.get("before_seq")),
+                after_seq=_optional_int(request.get("after_seq")),
+            )
+        except (TypeError, ValueError):
+            await self.send(text_data=codec.dumps({"type": "error", "error": "invalid history cursor"}))
+            return
+
+        await self.send(text_data=codec.dumps({"type": "history", **page}))
 
     # Receive message from room group
     async def chat_message(self, event):
@@ -135,19 +391,24 @@ class ChatConsumer(AsyncWebsocketConsumer):
         :param event: The event dictionary containing the type identifier and message content from the async def receive(self, text_data) method.
         :type event: dict
         """
-        # retrieve the message content sent to the room group by extracting the value for the key "message" in the event dict
-        # retrieve the username which sent the message content
-        # - needed to ensure display of username in chat log
-        message = event["message"]
-        username = event["username"]
+        # the message was converted to a JSON-formatted string by the consumer that received it
+        # - so it is sent to the WebSocket without being converted again
+        # - and cached for new members of the room
+        text_data = recent_messages.add(self.room_name, event["id"], lambda: event["text"], seq=event.get("seq"))
+        if self.batcher is not None:
+            await self.batcher.add(text_data)
+        else:
+            await self.send(text_data=text_data)
+        if "sent_at" in event:
+            metrics.GROUP_SEND_TO_SEND.observe(time.time() - event["sent_at"])
 
-        # Send message to WebSocket
-        # send username to WebSocket to ensure display in chat log
-        # convert the Python dictionary into a JSON-formatted string for transmission to the WebSocket with dumps method
-        await self.send(text_data=json.dumps({"message": message, "username": username}))
+    # Receive the news that the room moved to another shard
+    # - the event is sent by the process whose map changed, the room may still live on this process's shard
+    async def shard_moved(self, event):
+        await _redirect_to_shard(self, self.room_name, "moved")
 
 # create a class for the consumer that tracks the users who are online
-class PresenceConsumer(AsyncWebsocketConsumer):
+class PresenceConsumer(LivenessMixin, WireFormatMixin, SendQueueMixin, AsyncWebsocketConsumer):
     # connect to WebSocket    
     async def connect(self):
         """An asynchronous method to connect to WebSocket. 
@@ -163,7 +424,13 @@ class PresenceConsumer(AsyncWebsocketConsumer):
         # - with a max length of 100 char according to the default backend.        
         # - code will fail if the room name contains any invalid characters or exceeds the length limit
         # extract the room name from the URL and create a group name for online users
-        self.room_group_name = f"{self.room_name}_online_users"
+        self.room_group_name = presence_group_name(self.room_name)
+        # the username is sent by the browser in its first frame
+        self.username = None
+
+        # send the client to the shard of the room when the rooms are sharded
+        if await _redirect_to_shard(self, self.room_name):
+            return
 
         # Join room group
         # Asynchronously add the WebSocket connection to a online users group.
@@ -176,7 +443,15 @@ class PresenceConsumer(AsyncWebsocketConsumer):
         # (*but you can reject a connection if the requesting user is not authorised to perform the requested action.)
         # It is recommended that accept() be called as the last action in connect() if you choose to accept the connection.
         await self.accept()
-        print(f"Connected to presence channel: {self.room_group_name}") ##        
+        shard_map.join(self.room_name)
+        self.joined = True
+        logger.debug("Connected to presence channel: %s", self.room_group_name)
+
+        # make sure this worker sweeps the users whose tab closed without saying goodbye
+        start_sweeper()
+
+        # send the users who are already online, later frames only carry the users who joined or left
+        await self.send_presence_snapshot()
 
     # disconnect from WebSocket
     async def disconnect(self, close_code):
@@ -189,68 +464,257 @@ class PresenceConsumer(AsyncWebsocketConsumer):
         # Asynchronously remove the current WebSocket connection (id by its channel name) from a group (id by room_group_name)
         # - ensures that the WebSocket connection will no longer receive messages sent to this group.
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
-        
-        print(f"Disconnected from presence channel: {self.room_group_name}") ##
+        # a client sent to another shard while connecting never joined the room here
+        if not getattr(self, "joined", False):
+            return
+        self.joined = False
+        shard_map.leave(self.room_name)
+        logger.debug("Disconnected from presence channel: %s", self.room_group_name)
+
+        # the socket closed without a close frame, e.g. the network dropped, so mark the user as offline
+        # - if the user has another tab open its next heartbeat marks them as online again
+        if self.username is not None:
+            await self.change_online_status(self.username, "close")
 
     # Receive messages from WebSocket
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """An asynchronous method that receives messages from the WebSocket.
 
         :param text_data: The message received from the WebSocket as a JSON-formatted string.
-        :type text_data: str
+        :type text_data: str or None
+        :param bytes_data: The message received as a binary frame, in the wire format the client negotiated.
+        :type bytes_data: bytes or None
         """
+        # a client sent to another shard is being closed, its frames are ignored
+        if getattr(self, "redirected", False):
+            return
+
         # convert/parse the JSON-formatted string received from the WebSocket into a Python dictionary with the loads method,
         # e.g. "{key:value}" => {key:value}
         # - allowing for the extraction and use of the message content.
-        text_data_json = json.loads(text_data)
-        
+        await self.receive_frame(self.wire_format.decode(text_data, bytes_data))
+
+    # handle a frame that was decoded from the WebSocket
+    async def receive_frame(self, text_data_json, received_at=None):
+        """An asynchronous method that handles a decoded presence frame from the WebSocket.
+
+        :param text_data_json: The decoded frame with the "username" & the connection type.
+        :type text_data_json: dict
+        :param received_at: The time.perf_counter() value when the frame was received, unused by presence frames.
+        :type received_at: float or None
+        """
+        # a client that was sent a resync frame asks for the users who are online again
+        if text_data_json.get("type") == "snapshot":
+            await self.send_presence_snapshot()
+            return
+
         # retrieve the value associated with the key "username" from the text_data_json dictionary        
         username = text_data_json["username"]
         
         # retrieve the value associated with the key "connection_type" from the text_data_json dictionary        
-        # -  indicates whether the user is connecting ("open") or disconnecting ("close")
+        # -  indicates whether the user is connecting ("open"), still online ("heartbeat") or disconnecting ("close")
         # used to determine the appropriate action for updating the user's online status
-        connection_type = text_data_json["connection_type"]
-        print(connection_type) ##
+        # - chat_room.html sends the connection type with the key "type"
+        connection_type = text_data_json.get("connection_type", text_data_json.get("type"))
 
         # Send online status to room group
         # send the online status to all WebSocket connections that are part of the specified group (room_group_name)        
         await self.change_online_status(username, connection_type)
 
-    # method to send online status update to websocket
-    async def send_onlineStatus(self, event):
-        # parse event data from json format
-        # extract username & status
-        data = json.loads(event.get('value'))
-        username = data['username']
-        online_status = data['status']
-
-        # send online status update to websocket
-        await self.send(text_data=json.dumps({
-            'username': username,
-            'online_status': online_status
-        }))
-
-    # send a message to the WebSocket group about an online user
-    # - all clients connected to this group will receive the message
+    # send the full list of online users to a new member of the room
+    async def send_presence_snapshot(self):
+        """An asynchronous method that sends every user who is online in the room to the WebSocket."""
+        users = await presence_store.online_users(self.room_name)
+        await self.send(text_data=codec.dumps({"type": "presence_snapshot", "users": users}))
+
+    # method to send the online status changes of the room to websocket
+    async def presence_diff(self, event):
+        """An asynchronous method that sends the users who joined or left the room to the WebSocket.
+
+        :param event: The event dictionary with the diff already converted to a JSON-formatted string.
+        :type event: dict
+        """
+        # the diff was converted once by the coalescer so it is sent as it is
+        await self.send(text_data=event["text"])
+
+    # Receive the news that the room moved to another shard
+    async def shard_moved(self, event):
+        await _redirect_to_shard(self, self.room_name, "moved")
+
+    # tell the WebSocket group about an online user
+    # - the change is collected with the other changes of the room & all clients receive them in one diff frame
     async def notify_online_status(self, username, is_online):
-        await self.channel_layer.group_send(
-            self.room_group_name, {"type": 'send_online_status',
-                                   "username": username,
-                                   "status": is_online
-                                   }
-                                   )
-
-    # method to change status of users from Redis
+        presence_diffs.add(self.room_name, username, is_online)
+
+    # method to change status of users in the room's presence store
     async def change_online_status(self, username, connection_type):
-        # Use Redis directly to get the members of the group
-        redis = self.channel_layer._get_client()
-        if connection_type == 'open':
-            await redis.sadd('online_users', username)
+        """An asynchronous method that updates the user's entry in the room's presence store.
+
+        :param username: The username of the user.
+        :type username: str
+        :param connection_type: "open" or "heartbeat" while the user is online, anything else when they leave.
+        :type connection_type: str
+        """
+        if connection_type in ("open", "heartbeat"):
+            self.username = username
+            # a heartbeat only refreshes the time the user was last seen
+            # - the room is only notified when the user wasn't already online
+            changed = await presence_store.heartbeat(self.room_name, username)
+            is_online = True
         else:
-            await redis.srem('online_users', username)
+            self.username = None
+            changed = await presence_store.leave(self.room_name, username)
+            is_online = False
 
         # call the method to send the online status notification to websocket.
-        # connection_type == 'open' results in True or False, which represents whether the user is online or offline
-        await self.notify_online_status(username, connection_type == 'open')
-        
\ No newline at end of file
+        if changed:
+            metrics.PRESENCE_UPDATES.inc("consumer")
+            await self.notify_online_status(username, is_online)
+
+
+# create a class for the consumer that carries both the chat & the presence of a room over one WebSocket
+# - each browser tab used to open two sockets, one to ChatConsumer & one to PresenceConsumer,
+# - which doubled the connections, the auth middleware & session lookups & the channel layer registrations
+# every frame is wrapped in an envelope that names its stream, e.g. {"stream": "chat", "payload": {"message": ...}}
+# the two streams are handled by a ChatConsumer & a PresenceConsumer that share this consumer's connection & channel
+class MultiplexConsumer(LivenessMixin, WireFormatMixin, SendQueueMixin, AsyncWebsocketConsumer):
+    """Create a MultiplexConsumer class.
+
+    :param AsyncWebsocketConsumer: The MultiplexConsumer class inherits from AsyncWebsocketConsumer
+    :type AsyncWebsocketConsumer: Class
+    """
+    # the consumer class that handles each stream
+    streams = {"chat": ChatConsumer, "presence": PresenceConsumer}
+
+    # connect to WebSocket
+    async def connect(self):
+        """An asynchronous method to connect to WebSocket & to start the consumer of each stream.
+        """
+        self.room_name = self.scope["url_route"]["kwargs"]["room_name"]
+
+        # send the client to the shard of the room before starting the streams
+        # - the redirect frame isn't wrapped in an envelope, like the error frames of this consumer
+        if await _redirect_to_shard(self, self.room_name):
+            return
+
+        # the limits on the size & the rate of the frames this client sends on any stream
+        # - the chat stream also checks the length & the room's rate of each chat message
+        self.flood_control = FloodControl(self.room_name)
+
+        # accept the connection once for every stream, the streams' own accept() calls are ignored
+        await self.accept()
+
+        self.stream_consumers = {}
+        for stream, consumer_class in self.streams.items():
+            # the stream consumer runs inside this consumer instead of being an ASGI application of its own
+            # - it shares the scope, the channel layer & the channel name, so it joins its room group with this channel
+            consumer = consumer_class()
+            consumer.scope = self.scope
+            consumer.channel_layer = self.channel_layer
+            consumer.channel_name = self.channel_name
+            consumer.base_send = self.stream_sender(stream)
+            self.stream_consumers[stream] = consumer
+            await consumer.connect()
+
+    # wrap the frames a stream consumer sends in the envelope of its stream
+    def stream_sender(self, stream):
+        """Return the function a stream consumer uses to send ASGI messages through this connection.
+
+        :param stream: The name of the stream, e.g. "chat".
+        :type stream: str
+        :return: An asynchronous function that takes an ASGI message.
+        :rtype: callable
+        """
+        # the payload is already a JSON-formatted string, so the envelope is added around it without decoding it
+        prefix = '{"stream": "%s", "payload": ' % stream
+
+        async def send(message):
+            if message["type"] == "websocket.send":
+                await self.base_send({"type": "websocket.send", "text": prefix + message["text"] + "}"})
+            elif message["type"] == "websocket.close":
+                await self.base_send(message)
+            # websocket.accept is dropped because the connection was accepted by connect()
+
+        return send
+
+    # disconnect from WebSocket
+    async def disconnect(self, close_code):
+        """An asynchronous method to disconnect the consumer of each stream from the WebSocket.
+
+        :param close_code: A numerical code indicating the reason for the WebSocket connection closure.
+        :type close_code: int
+        """
+        for consumer in getattr(self, "stream_consumers", {}).values():
+            await consumer.disconnect(close_code)
+
+    # Receive messages from WebSocket
+    async def receive(self, text_data=None, bytes_data=None):
+        """An asynchronous method that receives a frame from the WebSocket & passes its payload to its stream.
+
+        :param text_data: The envelope received from the WebSocket as a JSON-formatted string.
+        :type text_data: str or None
+        :param bytes_data: The envelope received as a binary frame, in the wire format the client negotiated.
+        :type bytes_data: bytes or None
+        """
+        # a client sent to another shard is being closed, its frames are ignored
+        if getattr(self, "redirected", False):
+            return
+
+        limit = self.flood_control.check_frame(text_data if text_data is not None else bytes_data)
+        if limit is not None:
+            await _reject(self, limit)
+            return
+
+        received_at = time.perf_counter()
+        envelope = self.wire_format.decode(text_data, bytes_data)
+        metrics.JSON_DECODE.observe(time.perf_counter() - received_at)
+
+        consumer = self.stream_consumers.get(envelope.get("stream"))
+        if consumer is None:
+            await self.send(text_data=codec.dumps({"type": "error", "error": "unknown stream"}))
+            return
+
+        # the payload was decoded with the envelope so the stream consumer doesn't decode it again
+        await consumer.receive_frame(envelope["payload"], received_at)
+
+    # Receive message from the chat room group
+    async def chat_message(self, event):
+        await self.stream_consumers["chat"].chat_message(event)
+
+    # Receive the online status changes from the presence room group
+    async def presence_diff(self, event):
+        await self.stream_consumers["presence"].presence_diff(event)
+
+    # Receive the news that the room moved to another shard, once from each of the room's groups
+    async def shard_moved(self, event):
+        await _redirect_to_shard(self, self.room_name, "moved")
+
+
+# push the member counts of the active rooms, e.g. to the landing page
+class RoomDirectoryConsumer(LivenessMixin, WireFormatMixin, SendQueueMixin, AsyncWebsocketConsumer):
+    """Send a client the busiest rooms, then the new member count of each room that changes.
+
+    :param AsyncWebsocketConsumer: The RoomDirectoryConsumer class inherits from AsyncWebsocketConsumer
+    :type AsyncWebsocketConsumer: Class
+    """
+    # connect to WebSocket
+    async def connect(self):
+        """An asynchronous method to connect to WebSocket & send the busiest rooms.
+        """
+        # join the feed before reading the directory so no change is missed
+        # - the changes received in the meantime are handled after connect(), so they're sent after the snapshot
+        await count_errors("group_add", self.channel_layer.group_add(DIRECTORY_GROUP, self.channel_name))
+        await self.accept()
+        await self.send(text_data=codec.dumps({"type": "rooms", **await directory_snapshot()}))
+
+    # disconnect from WebSocket
+    async def disconnect(self, close_code):
+        await count_errors("group_discard", self.channel_layer.group_discard(DIRECTORY_GROUP, self.channel_name))
+
+    # the feed only sends, the frames of the client are ignored
+    async def receive(self, text_data=None, bytes_data=None):
+        pass
+
+    # Receive the new counts of the rooms that changed, e.g. {"type": "room_counts", "rooms": {"lobby": 12}}
+    async def directory_update(self, event):
+        await self.send(text_data=event["text"])
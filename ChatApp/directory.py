@@ -0,0 +1,316 @@
+# the directory of the active chat rooms & the members connected to each
+# - every ChatConsumer adds 1 to the count of its room when it connects & takes 1 away when it disconnects,
+#   so the directory is kept up to date as the members come & go instead of listing the groups of the channel layer,
+#   which channels_redis can't do cheaply
+# - the rooms are also kept in order of their counts, so the busiest rooms are read without looking at the others
+# the backend is chosen with the CHAT_DIRECTORY_BACKEND setting
+# - RedisRoomDirectory keeps the counts in a sorted set shared by every worker, ZINCRBY is O(log N)
+# - LocalRoomDirectory keeps them in this process, for the tests & for running a single worker without Redis
+# /rooms/ serves the busiest rooms as JSON & /ws/rooms/ pushes the counts of the rooms as they change
+import asyncio
+import logging
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.functional import LazyObject, empty
+from django.utils.module_loading import import_string
+
+from . import codec
+from .metrics import count_errors
+
+logger = logging.getLogger(__name__)
+
+# the sorted set of the rooms by their member count
+DIRECTORY_KEY = "chat:rooms"
+# the group of the consumers that push the changes of the directory to their clients
+DIRECTORY_GROUP = "room_directory"
+
+
+class _Bucket:
+    # the rooms with the same count, a node of the list of counts
+    __slots__ = ("count", "rooms", "prev", "next")
+
+    def __init__(self, count):
+        self.count = count
+        # the room names, a dict is an ordered set
+        self.rooms = {}
+        self.prev = None
+        self.next = None
+
+
+class LocalRoomDirectory:
+    """Count the members of each room in this process.
+
+    The rooms are kept in a linked list of buckets, one for each count that has rooms, from the lowest count to the
+    highest. A member joining or leaving moves its room to the next or the previous bucket, so every change is O(1)
+    & the busiest rooms are read from the end of the list.
+    """
+
+    def __init__(self):
+        # room name -> its bucket
+        self._rooms = {}
+        # the buckets with the lowest & the highest count
+        self._lowest = None
+        self._highest = None
+
+    def _insert(self, count, prev, next):
+        bucket = _Bucket(count)
+        bucket.prev, bucket.next = prev, next
+        if prev is None:
+            self._lowest = bucket
+        else:
+            prev.next = bucket
+        if next is None:
+            self._highest = bucket
+        else:
+            next.prev = bucket
+        return bucket
+
+    def _unlink(self, bucket):
+        if bucket.prev is None:
+            self._lowest = bucket.next
+        else:
+            bucket.prev.next = bucket.next
+        if bucket.next is None:
+            self._highest = bucket.prev
+        else:
+            bucket.next.prev = bucket.prev
+
+    def _move(self, room_name, bucket, target):
+        if bucket is not None:
+            del bucket.rooms[room_name]
+            if not bucket.rooms:
+                self._unlink(bucket)
+        if target is None:
+            del self._rooms[room_name]
+        else:
+            target.rooms[room_name] = None
+            self._rooms[room_name] = target
+
+    async def join(self, room_name):
+        """Count a member in a room.
+
+        :param room_name: The name of the chat room.
+        :type room_name: str
+        :return: The members of the room.
+        :rtype: int
+        """
+        bucket = self._rooms.get(room_name)
+        if bucket is None:
+            count, prev, next = 1, None, self._lowest
+        else:
+            count, prev, next = bucket.count + 1, bucket, bucket.next
+        target = next if next is not None and next.count == count else self._insert(count, prev, next)
+        self._move(room_name, bucket, target)
+        return count
+
+    async def leave(self, room_name):
+        """Stop counting a member in a room, a room without members leaves the directory.
+
+        :param room_name: The name of the chat room.
+        :type room_name: str
+        :return: The members left in the room.
+        :rtype: int
+        """
+        bucket = self._rooms.get(room_name)
+        if bucket is None:
+            return 0
+        count, prev = bucket.count - 1, bucket.prev
+        if not count:
+            target = None
+        elif prev is not None and prev.count == count:
+            target = prev
+        else:
+            target = self._insert(count, prev, bucket)
+        self._move(room_name, bucket, target)
+        return count
+
+    async def top(self, limit):
+        """Return the busiest rooms.
+
+        :param limit: The most rooms to return.
+        :type limit: int
+        :return: The (room name, members) of the rooms, the busiest first.
+        :rtype: list
+        """
+        rooms = []
+        bucket = self._highest
+        while bucket is not None and len(rooms) < limit:
+            for room_name in bucket.rooms:
+                rooms.append((room_name, bucket.count))
+                if len(rooms) == limit:
+                    break
+            bucket = bucket.prev
+        return rooms
+
+    async def size(self):
+        """Return the number of rooms with members."""
+        return len(self._rooms)
+
+    def clear(self):
+        """Forget every room, used by the tests."""
+        self._rooms.clear()
+        self._lowest = self._highest = None
+
+
+class RedisRoomDirectory:
+    """Count the members of each room in a Redis sorted set shared by every worker.
+
+    The directory has its own pool of connections to ``CHAT_DIRECTORY_REDIS_URL``.
+    The counts of a worker that dies without disconnecting its consumers stay in the set, delete the
+    ``chat:rooms`` key to start counting again.
+    """
+
+    def __init__(self):
+        # a pool is bound to the event loop it was created on, so keep one client per loop
+        self._clients = {}
+
+    def client(self):
+        """Return the Redis client for the running event loop."""
+        import redis.asyncio
+
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            pool = redis.asyncio.ConnectionPool.from_url(
+                getattr(settings, "CHAT_DIRECTORY_REDIS_URL", "redis://127.0.0.1:6379/0")
+            )
+            client = self._clients[loop] = redis.asyncio.Redis(connection_pool=pool)
+        return client
+
+    async def join(self, room_name):
+        return int(await self.client().zincrby(DIRECTORY_KEY, 1, room_name))
+
+    async def leave(self, room_name):
+        redis = self.client()
+        count = int(await redis.zincrby(DIRECTORY_KEY, -1, room_name))
+        if count <= 0:
+            # remove every empty room in one command, a member who joined in the meantime keeps the room's count above 0
+            await redis.zremrangebyscore(DIRECTORY_KEY, "-inf", 0)
+        return max(count, 0)
+
+    async def top(self, limit):
+        rooms = await self.client().zrevrange(DIRECTORY_KEY, 0, limit - 1, withscores=True)
+        return [(room_name.decode(), int(count)) for room_name, count in rooms]
+
+    async def size(self):
+        return await self.client().zcard(DIRECTORY_KEY)
+
+
+class DefaultRoomDirectory(LazyObject):
+    """The directory backend chosen by the ``CHAT_DIRECTORY_BACKEND`` setting, created when it's first used."""
+
+    def _setup(self):
+        self._wrapped = import_string(
+            getattr(settings, "CHAT_DIRECTORY_BACKEND", "ChatApp.directory.RedisRoomDirectory")
+        )()
+
+
+# the member counts kept by the chat consumers
+room_directory = DefaultRoomDirectory()
+
+# (the time.monotonic() value when it expires, the busiest rooms)
+_hot_rooms = None
+
+
+async def directory_snapshot():
+    """Return the CHAT_DIRECTORY_SIZE busiest rooms & the number of rooms with members.
+
+    :return: The {"rooms": [{"room_name": ..., "members": ...}], "active_rooms": ...} of the directory.
+    :rtype: dict
+    """
+    rooms = await room_directory.top(getattr(settings, "CHAT_DIRECTORY_SIZE", 50))
+    return {
+        "rooms": [{"room_name": room_name, "members": members} for room_name, members in rooms],
+        "active_rooms": await room_directory.size(),
+    }
+
+
+async def hot_rooms():
+    """Return the :func:`directory_snapshot`, cached for CHAT_DIRECTORY_CACHE_TTL seconds."""
+    global _hot_rooms
+    now = time.monotonic()
+    if _hot_rooms is None or _hot_rooms[0] <= now:
+        _hot_rooms = (now + getattr(settings, "CHAT_DIRECTORY_CACHE_TTL", 2), await directory_snapshot())
+    return _hot_rooms[1]
+
+
+class RoomCountCoalescer:
+    """Collect the new member counts of the rooms & push them to the directory feed once per window.
+
+    A deploy reconnects thousands of members within a few moments, so the counts are collected for
+    ``CHAT_DIRECTORY_PUSH_WINDOW`` seconds & sent as one frame with the latest count of each room that changed.
+    """
+
+    def __init__(self):
+        # room name -> the latest count
+        self._pending = {}
+        self._task = None
+
+    def add(self, room_name, members):
+        """Record the new member count of a room.
+
+        :param room_name: The name of the chat room.
+        :type room_name: str
+        :param members: The members of the room, 0 when it emptied.
+        :type members: int
+        """
+        self._pending[room_name] = members
+        if self._task is None or self._task.done() or self._task.get_loop() is not asyncio.get_running_loop():
+            # the first change starts the window
+            self._task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(getattr(settings, "CHAT_DIRECTORY_PUSH_WINDOW", 1))
+        # a count that changes while this window's counts are sent starts the next window
+        self._task = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Failed to push the room counts")
+
+    async def flush(self):
+        """Push the counts collected without waiting for the window to end."""
+        rooms, self._pending = self._pending, {}
+        if not rooms:
+            return
+        # the frame is converted once for every client of the feed
+        text_data = codec.dumps({"type": "room_counts", "rooms": rooms})
+        await count_errors("group_send", get_channel_layer().group_send(
+            DIRECTORY_GROUP, {"type": "directory.update", "text": text_data}
+        ))
+
+    def clear(self):
+        """Forget the counts waiting to be pushed, used by the tests."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._pending.clear()
+
+
+# the changes of the rooms of this worker waiting to be pushed
+room_counts = RoomCountCoalescer()
+
+
+async def join_room(room_name):
+    """Count a member in a room of the directory & queue the new count for the feed."""
+    room_counts.add(room_name, await room_directory.join(room_name))
+
+
+async def leave_room(room_name):
+    """Stop counting a member in a room of the directory & queue the new count for the feed."""
+    room_counts.add(room_name, await room_directory.leave(room_name))
+
+
+@receiver(setting_changed)
+def _reset_room_directory(setting, **kwargs):
+    # create the backend again & forget the cached rooms when the tests change them
+    global _hot_rooms
+    if setting in ("CHAT_DIRECTORY_BACKEND", "CHAT_DIRECTORY_REDIS_URL"):
+        room_directory._wrapped = empty
+        room_counts.clear()
+    if setting in ("CHAT_DIRECTORY_BACKEND", "CHAT_DIRECTORY_REDIS_URL", "CHAT_DIRECTORY_SIZE", "CHAT_DIRECTORY_CACHE_TTL"):
+        _hot_rooms = None
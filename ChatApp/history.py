@@ -0,0 +1,146 @@
+# the server-side history of the chat rooms
+# - messages are appended to the Message table when they are received by the ChatConsumer
+# - and read back a page at a time with the id of a message as the cursor,
+# - so a client only fetches the last N messages of a room (or those after a given id) instead of the whole room
+# - the live frames only carry the sequence number of a message, its id is given when the write-behind buffer saves it,
+#   so the sequence number can be the cursor too
+# https://channels.readthedocs.io/en/stable/topics/databases.html#database-sync-to-async
+# import database_sync_to_async because the ORM is synchronous and can't be called from the consumer's event loop
+from channels.db import database_sync_to_async
+
+from .models import Message
+from .persistence import message_buffer
+
+# the number of messages in a page of history when the client doesn't ask for a limit
+HISTORY_PAGE_SIZE = 50
+# the largest page of history a client can ask for
+HISTORY_MAX_PAGE_SIZE = 200
+
+
+def serialize_message(message):
+    """Convert a Message into the dictionary that is sent to the client.
+
+    :param message: The message to convert.
+    :type message: Message
+    :return: The id, content, username, ISO 8601 timestamp and sequence number of the message.
+    :rtype: dict
+    """
+    return {
+        "id": message.id,
+        "message": message.content,
+        "username": message.username,
+        "timestamp": message.created_at.isoformat(),
+        "seq": message.seq,
+    }
+
+
+def clamp_limit(limit):
+    """Return a page size between 1 and HISTORY_MAX_PAGE_SIZE.
+
+    :param limit: The page size the client asked for, or None for the default.
+    :type limit: int or None
+    :return: The page size to use.
+    :rtype: int
+    """
+    if limit is None:
+        return HISTORY_PAGE_SIZE
+    return max(1, min(int(limit), HISTORY_MAX_PAGE_SIZE))
+
+
+def get_history(room_name, before=None, after=None, limit=None, before_seq=None, after_seq=None):
+    """Return a page of the history of a chat room, oldest message first.
+
+    With no cursor the latest messages of the room are returned. With ``before`` the messages older than that id
+    are returned (to scroll back) and with ``after`` the messages newer than that id (to catch up after a reconnect).
+    ``before_seq`` & ``after_seq`` do the same with the sequence number of a message, which every live frame has,
+    & only return the numbered messages.
+
+    :param room_name: The name of the chat room.
+    :type room_name: str
+    :param before: Only return messages with an id lower than this one.
+    :type before: int or None
+    :param after: Only return messages with an id higher than this one.
+    :type after: int or None
+    :param limit: The maximum number of messages to return.
+    :type limit: int or None
+    :param before_seq: Only return messages with a sequence number lower than this one.
+    :type before_seq: int or None
+    :param after_seq: Only return messages with a sequence number higher than this one.
+    :type after_seq: int or None
+    :return: The messages and whether there are more messages past the page in the direction that was read.
+    :rtype: dict
+    :raises ValueError: If an id cursor & a sequence number cursor are both given.
+    """
+    limit = clamp_limit(limit)
+    queryset = Message.objects.filter(room_name=room_name)
+
+    # page by the sequence numbers with the (room_name, seq) index, or by the ids with the (room_name, id) index
+    if before_seq is not None or after_seq is not None:
+        if before is not None or after is not None:
+            raise ValueError("Use either the id cursors or the sequence number cursors")
+        field, before, after = "seq", before_seq, after_seq
+        queryset = queryset.filter(seq__isnull=False)
+    else:
+        field = "id"
+
+    # fetch one extra row to know if there is another page without running a COUNT query
+    if after is not None:
+        rows = list(queryset.filter(**{f"{field}__gt": after}).order_by(field)[: limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+    else:
+        if before is not None:
+            queryset = queryset.filter(**{f"{field}__lt": before})
+        rows = list(queryset.order_by(f"-{field}")[: limit + 1])
+        has_more = len(rows) > limit
+        # the rows were read newest first so reverse them to display them in the order they were sent
+        rows = rows[:limit][::-1]
+
+    return {"messages": [serialize_message(row) for row in rows], "has_more": has_more}
+
+
+# the async version of get_history for the consumers
+get_history_async = database_sync_to_async(get_history)
+
+
+def get_last_seq(room_name):
+    """Return the highest sequence number saved for a chat room.
+
+    :param room_name: The name of the chat room.
+    :type room_name: str
+    :return: The sequence number, or 0 if the room has no numbered messages.
+    :rtype: int
+    """
+    last = (
+        Message.objects.filter(room_name=room_name, seq__isnull=False)
+        .order_by("-seq")
+        .values_list("seq", flat=True)
+        .first()
+    )
+    return last or 0
+
+
+# the async version of get_last_seq for the room sequences
+get_last_seq_async = database_sync_to_async(get_last_seq)
+
+
+async def save_message(room_name, username, content, created_at, seq=None):
+    """Add a message to the write-behind buffer that saves it to the database.
+
+    The message is written in a batch with the other messages received by the worker, so the consumer only waits
+    when the buffer is full.
+
+    :param room_name: The name of the chat room.
+    :type room_name: str
+    :param username: The username that sent the message.
+    :type username: str
+    :param content: The message content.
+    :type content: str
+    :param created_at: The time the server received the message.
+    :type created_at: datetime
+    :param seq: The sequence number of the message in its room.
+    :type seq: int or None
+    """
+    await message_buffer.put(
+        Message(room_name=room_name, username=username, content=content, created_at=created_at, seq=seq)
+    )
@@ -0,0 +1,326 @@
+# a channel layer that delivers the group messages of this process in memory
+# - channels_redis.core.RedisChannelLayer pushes a copy of every group_send to Redis for each member of the group,
+#   even when every member is a consumer in the same Daphne process
+# - HybridChannelLayer keeps the members of each group in a dictionary of this process & hands the message to them
+#   directly, then publishes it once on the group's Redis pub/sub topic for the other processes with members,
+#   so a broadcast costs one Redis message per process instead of one per member
+# the named channels, e.g. "presence_channel" for the presence worker, still go through RedisChannelLayer
+# - its Redis lists keep the events until the worker reads them, a pub/sub message is lost if nobody is listening
+import asyncio
+import logging
+import time
+import uuid
+from collections import defaultdict
+
+import msgpack
+from channels.layers import InMemoryChannelLayer
+from django.utils.module_loading import import_string
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class RedisPubSubTransport:
+    """Carry the messages between the processes with Redis pub/sub.
+
+    :param on_message: The function called with the topic & the data of every message published to a subscribed topic.
+    :type on_message: callable
+    :param hosts: The Redis servers of the channel layer, only the first one is used for pub/sub.
+    :type hosts: list or None
+    :param config: The rest of the channel layer's CONFIG, passed to the RedisChannelLayer of the named channels.
+    """
+
+    def __init__(self, on_message, hosts=None, **config):
+        from channels_redis.core import RedisChannelLayer
+        from channels_redis.utils import decode_hosts
+
+        self.on_message = on_message
+        self.host = decode_hosts(hosts)[0]
+        # the named channels are Redis lists, so an event sent while the worker is restarting isn't lost
+        self.named = RedisChannelLayer(hosts=hosts, **config)
+        # a connection is bound to the event loop it was created on, so keep one subscriber per loop
+        self._subscribers = {}
+
+    def subscriber(self):
+        """Return the Redis client, the pub/sub connection & the subscribed topics of the running event loop."""
+        import redis.asyncio
+        from channels_redis.utils import create_pool
+
+        loop = asyncio.get_running_loop()
+        subscriber = self._subscribers.get(loop)
+        if subscriber is None:
+            client = redis.asyncio.Redis(connection_pool=create_pool(self.host))
+            subscriber = self._subscribers[loop] = {
+                "client": client,
+                "pubsub": client.pubsub(),
+                "topics": set(),
+                "lock": asyncio.Lock(),
+                "reader": None,
+            }
+        return subscriber
+
+    async def publish(self, topic, data):
+        await self.subscriber()["client"].publish(topic, data)
+
+    async def subscribe(self, topic):
+        subscriber = self.subscriber()
+        async with subscriber["lock"]:
+            if topic not in subscriber["topics"]:
+                await subscriber["pubsub"].subscribe(topic)
+                subscriber["topics"].add(topic)
+            if subscriber["reader"] is None:
+                subscriber["reader"] = asyncio.ensure_future(self._read(subscriber["pubsub"]))
+
+    async def unsubscribe(self, topic):
+        subscriber = self.subscriber()
+        async with subscriber["lock"]:
+            if topic in subscriber["topics"]:
+                await subscriber["pubsub"].unsubscribe(topic)
+                subscriber["topics"].discard(topic)
+
+    async def _read(self, pubsub):
+        while True:
+            try:
+                if not pubsub.subscribed:
+                    await asyncio.sleep(0.1)
+                    continue
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=0.1)
+                if message is not None:
+                    self.on_message(_decode(message["channel"]), message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # keep reading, a message that failed to be delivered shouldn't stop the others
+                logger.exception("Failed to read from the Redis pub/sub connection")
+                await asyncio.sleep(1)
+
+    async def send(self, channel, message):
+        await self.named.send(channel, message)
+
+    async def receive(self, channel):
+        return await self.named.receive(channel)
+
+    async def flush(self):
+        subscriber = self._subscribers.pop(asyncio.get_running_loop(), None)
+        if subscriber is not None:
+            if subscriber["reader"] is not None:
+                subscriber["reader"].cancel()
+            await subscriber["pubsub"].aclose()
+            await subscriber["client"].aclose()
+        await self.named.flush()
+
+
+class InMemoryPubSubTransport:
+    """Carry the messages between the channel layers of this process.
+
+    Every HybridChannelLayer created with this transport acts like a separate process, so the tests can check what a
+    deployment with several processes would send without a Redis server.
+    """
+
+    # topic -> the transports subscribed to it, shared by every layer in the process
+    subscribers = defaultdict(set)
+    # the named channels, shared like the Redis lists are
+    named = InMemoryChannelLayer()
+
+    def __init__(self, on_message, **config):
+        self.on_message = on_message
+        # the number of messages this transport published, i.e. the messages a Redis server would have been sent
+        self.published = 0
+
+    async def publish(self, topic, data):
+        self.published += 1
+        for transport in list(self.subscribers.get(topic, ())):
+            transport.on_message(topic, data)
+
+    async def subscribe(self, topic):
+        self.subscribers[topic].add(self)
+
+    async def unsubscribe(self, topic):
+        self.subscribers[topic].discard(self)
+        if not self.subscribers[topic]:
+            del self.subscribers[topic]
+
+    async def send(self, channel, message):
+        await self.named.send(channel, message)
+
+    async def receive(self, channel):
+        return await self.named.receive(channel)
+
+    async def flush(self):
+        for topic in [topic for topic, transports in self.subscribers.items() if self in transports]:
+            await self.unsubscribe(topic)
+
+
+class HybridChannelLayer(InMemoryChannelLayer):
+    """A channel layer that delivers to the consumers of this process in memory & to the other processes with pub/sub.
+
+    The specific channel of each consumer lives in this process, its name contains the name of the process so a
+    message sent to it from another process is published on that process's topic. Each process subscribes to the topic
+    of a group while it has members in the group, so a group_send is one publish however many members there are.
+
+    Set it up in settings.py with::
+
+        CHANNEL_LAYERS = {
+            "default": {
+                "BACKEND": "ChatApp.layers.HybridChannelLayer",
+                "CONFIG": {"hosts": [("127.0.0.1", 6379)]},
+            },
+        }
+
+    :param transport: The dotted path of the class that carries the messages between the processes.
+    :type transport: str
+    :param prefix: The prefix of the pub/sub topics & the Redis keys.
+    :type prefix: str
+    :param config: The rest of the CONFIG, passed to the transport.
+    """
+
+    def __init__(
+        self,
+        transport="ChatApp.layers.RedisPubSubTransport",
+        prefix="asgi",
+        expiry=60,
+        group_expiry=86400,
+        capacity=100,
+        channel_capacity=None,
+        **config,
+    ):
+        super().__init__(expiry=expiry, group_expiry=group_expiry, capacity=capacity, channel_capacity=channel_capacity)
+        self.prefix = prefix
+        # the unsubscriptions of the groups emptied by _clean_expired, which can't wait for them
+        self._tasks = set()
+        # the name of this process in its channel names & in the messages it publishes
+        self.process_name = uuid.uuid4().hex
+        self.transport = import_string(transport)(
+            self.receive_published,
+            prefix=prefix,
+            expiry=expiry,
+            group_expiry=group_expiry,
+            capacity=capacity,
+            channel_capacity=channel_capacity,
+            **config,
+        )
+
+    def group_topic(self, group):
+        return f"{self.prefix}:group:{group}"
+
+    def process_topic(self, process_name):
+        return f"{self.prefix}:process:{process_name}"
+
+    def pack(self, target, message):
+        return msgpack.packb([self.process_name, target, message])
+
+    def deliver(self, channel, message):
+        """Put a message on the queue of a channel of this process.
+
+        The message isn't copied, the consumers that receive the same group message share one dictionary & only read it.
+
+        :param channel: The name of the channel.
+        :type channel: str
+        :param message: The message.
+        :type message: dict
+        :return: Whether the message was delivered, False if the channel is full.
+        :rtype: bool
+        """
+        queue = self.channels.setdefault(channel, asyncio.Queue())
+        if queue.qsize() >= self.get_capacity(channel):
+            # a full channel misses the message, like it does with the other channel layers
+            return False
+        queue.put_nowait((time.time() + self.expiry, message))
+        return True
+
+    def receive_published(self, topic, data):
+        """Deliver a message published by another process to the channels of this process.
+
+        :param topic: The topic the message was published on.
+        :type topic: str
+        :param data: The message packed by :meth:`pack`.
+        :type data: bytes
+        """
+        origin, target, message = msgpack.unpackb(data)
+        if origin == self.process_name:
+            # the members in this process were given the message by group_send already
+            return
+        if topic == self.process_topic(self.process_name):
+            self.deliver(target, message)
+            return
+        members = self.groups.get(target, ())
+        for channel in members:
+            self.deliver(channel, message)
+        metrics.CHANNEL_LAYER_MESSAGES.inc("remote", amount=len(members))
+
+    # Channel layer API
+
+    async def new_channel(self, prefix="specific."):
+        # listen for the messages other processes send to the channels of this process
+        await self.transport.subscribe(self.process_topic(self.process_name))
+        return f"{prefix}{self.process_name}!{uuid.uuid4().hex}"
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        if "!" not in channel:
+            # a named channel, read by whichever worker runs it
+            await self.transport.send(channel, message)
+            return
+        process_name = channel.partition("!")[0].rpartition(".")[2]
+        if process_name == self.process_name:
+            await super().send(channel, message)
+        else:
+            await self.transport.publish(self.process_topic(process_name), self.pack(channel, message))
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        if "!" not in channel:
+            return await self.transport.receive(channel)
+        return await super().receive(channel)
+
+    async def flush(self):
+        await super().flush()
+        await self.transport.flush()
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        first = group not in self.groups
+        await super().group_add(group, channel)
+        if first:
+            await self.transport.subscribe(self.group_topic(group))
+
+    async def group_discard(self, group, channel):
+        await super().group_discard(group, channel)
+        # the last member of this process left, the other processes don't need to send the group's messages here
+        await self._unsubscribe_if_empty(group)
+
+    async def _unsubscribe_if_empty(self, group):
+        if not self.groups.get(group):
+            self.groups.pop(group, None)
+            await self.transport.unsubscribe(self.group_topic(group))
+
+    def _clean_expired(self):
+        super()._clean_expired()
+        # the channels whose messages or memberships expired left their groups without a group_discard
+        # - so the groups they emptied are dropped & unsubscribed here, unless a member joins again first
+        for group in [group for group, members in self.groups.items() if not members]:
+            del self.groups[group]
+            task = asyncio.ensure_future(self._unsubscribe_if_empty(group))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Invalid group name"
+        self._clean_expired()
+        # the members in this process get the message straight from memory
+        members = self.groups.get(group, ())
+        for channel in members:
+            self.deliver(channel, message)
+        metrics.CHANNEL_LAYER_MESSAGES.inc("local", amount=len(members))
+
+        # & every other process with members gets it once from its subscription to the group's topic
+        await self.transport.publish(self.group_topic(group), self.pack(group, message))
+        metrics.CHANNEL_LAYER_MESSAGES.inc("published")
@@ -0,0 +1,189 @@
+# close the WebSockets whose clients went away without closing them
+# - a tab that was suspended, a laptop that went to sleep or a network that dropped leaves a socket open until TCP
+#   notices, & until then its consumer stays in its groups & receives every message of its room
+# - the idle reaper of each worker checks the time each connection last sent a frame every CHAT_PING_INTERVAL seconds:
+#   a connection that was quiet for CHAT_PING_INTERVAL is sent {"type": "ping"} & answers {"type": "pong"},
+#   a connection that was quiet for CHAT_IDLE_TIMEOUT is closed with CHAT_IDLE_CLOSE_CODE & leaves its groups
+# - any frame counts as a sign of life, so a tab that sends presence heartbeats is never pinged
+# when the worker shuts down, drain_connections() tells every client to reconnect after a random delay & closes it
+# - so the clients of a worker spread their reconnects over CHAT_DRAIN_JITTER seconds, see `python manage.py serve`
+# the consumers also drop the parts of their scope they only read while connecting, e.g. the headers & the cookies
+# - the middleware keeps its own copies of the scope while the connection is open, so this mostly stops the consumer
+#   holding on to them, see `python manage.py measure_idle_connections` for the bytes kept per idle connection
+import asyncio
+import logging
+import random
+import time
+
+import msgpack
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from . import codec, metrics
+
+logger = logging.getLogger(__name__)
+
+# the frame sent to a quiet connection
+PING = '{"type": "ping"}'
+# the frames a client answers a ping with, as JSON text or as msgpack for the clients that negotiated it
+PONG_TEXT = frozenset(('{"type": "pong"}', '{"type":"pong"}'))
+PONG_BYTES = msgpack.packb({"type": "pong"})
+# the scope keys only read while connecting, dropped once the connection is accepted
+# - the session & the user were resolved by the auth middleware & the consumer keeps the username it needs
+TRIMMED_SCOPE_KEYS = ("headers", "cookies", "session", "subprotocols", "query_string", "client", "server")
+
+
+class IdleReaper:
+    """The connections of this worker & the time each one last sent a frame.
+
+    The settings are read when the reaper starts:
+
+    - ``CHAT_PING_INTERVAL``: the seconds between the checks & the quiet seconds before a connection is pinged,
+      or None to turn the reaper off
+    - ``CHAT_IDLE_TIMEOUT``: the quiet seconds before a connection is closed
+    - ``CHAT_IDLE_CLOSE_CODE``: the close code of a connection closed for being idle
+    """
+
+    def __init__(self):
+        # consumer -> the time.monotonic() value when it last sent a frame
+        self.connections = {}
+        self._task = None
+
+    def add(self, consumer):
+        self.connections[consumer] = time.monotonic()
+        if self._task is None or self._task.done() or self._task.get_loop() is not asyncio.get_running_loop():
+            self.interval = getattr(settings, "CHAT_PING_INTERVAL", 20)
+            self.timeout = getattr(settings, "CHAT_IDLE_TIMEOUT", 60)
+            self.close_code = getattr(settings, "CHAT_IDLE_CLOSE_CODE", 4011)
+            if self.interval is not None:
+                self._task = asyncio.ensure_future(self._run())
+
+    def seen(self, consumer):
+        # a connection that is being closed isn't added back
+        if consumer in self.connections:
+            self.connections[consumer] = time.monotonic()
+
+    def discard(self, consumer):
+        self.connections.pop(consumer, None)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.reap()
+            except Exception:
+                # a failed check is retried at the next interval
+                logger.exception("Failed to check the idle connections")
+
+    async def reap(self, now=None):
+        """Ping the quiet connections & close the idle ones.
+
+        :param now: The time.monotonic() value to compare with, defaults to the current time.
+        :type now: float or None
+        :return: The number of connections pinged & closed.
+        :rtype: tuple
+        """
+        now = time.monotonic() if now is None else now
+        pinged = closed = 0
+        for consumer, last_seen in list(self.connections.items()):
+            quiet = now - last_seen
+            if quiet >= self.timeout:
+                # the consumer closes itself on its own task, so it leaves its groups & disconnects as usual
+                self.connections.pop(consumer, None)
+                await consumer.channel_layer.send(
+                    consumer.channel_name, {"type": "connection.idle", "code": self.close_code}
+                )
+                closed += 1
+            elif quiet >= self.interval:
+                await consumer.send(text_data=PING)
+                pinged += 1
+        return pinged, closed
+
+    def clear(self):
+        """Stop the checks & forget the connections, used by the tests."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.connections.clear()
+
+
+# the connections of this worker
+idle_reaper = IdleReaper()
+
+
+async def drain_connections():
+    """Tell every client of this worker to reconnect & close its connection, the worker is shutting down.
+
+    Each client is sent ``{"type": "reconnect", "retry_after": <ms>}`` with its own delay of up to ``CHAT_DRAIN_JITTER``
+    seconds, so the clients don't all reconnect to the other workers at once, & the connection is closed with
+    ``CHAT_DRAIN_CLOSE_CODE``.
+
+    :return: The number of connections closed.
+    :rtype: int
+    """
+    jitter = getattr(settings, "CHAT_DRAIN_JITTER", 5)
+    code = getattr(settings, "CHAT_DRAIN_CLOSE_CODE", 4012)
+    consumers = list(idle_reaper.connections)
+    for consumer in consumers:
+        idle_reaper.discard(consumer)
+        await consumer.channel_layer.send(
+            consumer.channel_name,
+            {"type": "connection.drain", "code": code, "retry_after": round(random.uniform(0, jitter) * 1000)},
+        )
+    return len(consumers)
+
+
+@receiver(setting_changed)
+def _reset_idle_reaper(setting, **kwargs):
+    # read the intervals again when the tests or the measurement change them
+    if setting in ("CHAT_PING_INTERVAL", "CHAT_IDLE_TIMEOUT", "CHAT_IDLE_CLOSE_CODE"):
+        idle_reaper.clear()
+
+
+class LivenessMixin:
+    """Track the frames of a consumer's connection for the :data:`idle_reaper` & trim its scope once it's accepted.
+
+    The connection is closed when the idle reaper finds it idle or when its worker drains.
+    """
+
+    async def websocket_connect(self, message):
+        await super().websocket_connect(message)
+        for key in TRIMMED_SCOPE_KEYS:
+            self.scope.pop(key, None)
+        idle_reaper.add(self)
+
+    async def websocket_receive(self, message):
+        idle_reaper.seen(self)
+        # a pong only says the client is alive, it isn't passed to the consumer
+        if message.get("text") in PONG_TEXT or message.get("bytes") == PONG_BYTES:
+            return
+        await super().websocket_receive(message)
+
+    async def websocket_disconnect(self, message):
+        idle_reaper.discard(self)
+        await super().websocket_disconnect(message)
+
+    # Receive the news from the idle reaper that the client stopped answering
+    async def connection_idle(self, event):
+        metrics.IDLE_CONNECTIONS_CLOSED.inc()
+        await self.close_now(event["code"])
+
+    # Receive the news that this worker is shutting down
+    async def connection_drain(self, event):
+        # the frame isn't wrapped in an envelope by MultiplexConsumer, like its redirect frame
+        await self.send(text_data=codec.dumps({"type": "reconnect", "retry_after": event["retry_after"]}))
+        await self.close_now(event["code"])
+
+    async def close_now(self, code):
+        """Close the connection & leave its groups without waiting for the client to answer the close.
+
+        :param code: The close code.
+        :type code: int
+        """
+        await self.close(code=code)
+        # hand the close to the server before the consumer stops, the send queue is dropped with the consumer
+        if self.send_queue is not None:
+            await self.send_queue.drain()
+        # leave the groups & run disconnect() now instead of waiting for TCP to notice the client is gone
+        await self.websocket_disconnect({"type": "websocket.disconnect", "code": code})
@@ -0,0 +1,40 @@
+# a benchmark of the batch frames against sending one frame per chat message
+# - run with: python manage.py bench_batching --rooms 2 --clients 50 --rate 200 --duration 5
+# runs the load test twice with the same rooms, clients & message rate, once with one frame per message
+# - & once with the clients asking for batch frames, then compares the frames per second & the CPU time per delivery
+# the in-memory mode measures the consumers & the clients in this process together,
+# - pass --url to measure a running server over real sockets, the CPU time is then only the clients'
+from django.core.management.base import BaseCommand
+
+from .loadtest_chat import Command as LoadTestCommand
+
+
+class Command(BaseCommand):
+    help = "Compare the frames per second & the CPU time per delivery with & without batch frames."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rooms", type=int, default=2, help="The number of rooms.")
+        parser.add_argument("--clients", type=int, default=50, help="The number of clients in each room.")
+        parser.add_argument("--rate", type=float, default=200, help="The messages sent to each room per second.")
+        parser.add_argument("--duration", type=float, default=5, help="The seconds to send messages for.")
+        parser.add_argument("--batch", type=float, default=20, help="The batch window in milliseconds.")
+        parser.add_argument("--batch-size", type=int, default=0, help="The most messages in a batch frame.")
+        parser.add_argument("--url", help="Connect real sockets to a running server, e.g. ws://127.0.0.1:8000.")
+
+    def handle(self, *args, **options):
+        load_test = LoadTestCommand(stdout=self.stdout, stderr=self.stderr)
+        self.stdout.write(
+            f"{options['rooms']} rooms × {options['clients']} clients × {options['rate']:g} messages/s "
+            f"for {options['duration']:g}s"
+        )
+        baseline = None
+        for label, batch in (("one frame per message", 0), (f"batch frames ({options['batch']:g} ms)", options["batch"])):
+            results = load_test.run_options({**options, "batch": batch})
+            delivered = len(results["latencies"])
+            cpu_us = results["cpu"] * 1e6 / max(delivered, 1)
+            baseline = baseline or cpu_us
+            self.stdout.write(
+                f"{label:<28} {results['frames'] / results['elapsed']:10.0f} frames/s "
+                f"{delivered / results['elapsed']:10.0f} deliveries/s {cpu_us:8.1f} µs CPU per delivery "
+                f"({baseline / max(cpu_us, 1e-9):.1f}x)"
+            )
@@ -0,0 +1,54 @@
+# a benchmark of the CPU time spent encoding a chat message broadcast to a room
+# - run with: python manage.py bench_broadcast --members 5000
+# compares converting the message to JSON in every consumer of the group (how chat_message used to work)
+# - with converting it once before the group_send & sending the same string to every member
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from ChatApp import codec
+
+
+class Command(BaseCommand):
+    help = "Measure the encode CPU time per broadcast with & without serialize-once fan-out."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--members", type=int, default=5000, help="The number of members in the room.")
+        parser.add_argument("--broadcasts", type=int, default=20, help="The number of messages broadcast.")
+
+    def handle(self, *args, **options):
+        members = options["members"]
+        broadcasts = options["broadcasts"]
+        message = {
+            "message": "Has anyone tried the new build on a slow mobile connection yet?",
+            "username": "alice",
+            "timestamp": "2024-07-28T18:30:00.123456+00:00",
+        }
+
+        def per_member():
+            # every consumer converts the event it received from the group
+            for _ in range(members):
+                json.dumps(message)
+
+        def encode_once(dumps):
+            def broadcast():
+                # the sender converts the message once & every consumer sends the string in the event
+                event = {"type": "chat.message", "text": dumps(message)}
+                for _ in range(members):
+                    event["text"]
+            return broadcast
+
+        cases = [("per-member json.dumps", per_member), ("encode once (json)", encode_once(json.dumps))]
+        if codec.name != "json":
+            cases.append((f"encode once ({codec.name})", encode_once(codec.dumps)))
+
+        self.stdout.write(f"{members} members, {broadcasts} broadcasts")
+        baseline = None
+        for label, broadcast in cases:
+            start = time.process_time()
+            for _ in range(broadcasts):
+                broadcast()
+            cpu_ms = (time.process_time() - start) * 1000 / broadcasts
+            baseline = baseline or cpu_ms
+            self.stdout.write(f"{label:<24} {cpu_ms:10.3f} ms CPU per broadcast ({baseline / max(cpu_ms, 1e-9):.0f}x)")
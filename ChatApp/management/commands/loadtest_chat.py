@@ -0,0 +1,251 @@
+# a load test of the chat rooms
+# - run with: python manage.py loadtest_chat --rooms 10 --clients 20 --rate 5 --duration 10
+# opens N rooms × M clients & sends K messages per second to every room,
+# - then reports the p50/p99 delivery latency, the messages delivered per second, the frames received per second,
+#   the CPU time per delivered message & the memory per connection
+# pass --batch 20 to have the clients ask for the messages in batch frames collected over 20 ms
+# by default the clients are channels.testing.WebsocketCommunicator instances connected to the consumers in this
+# - process through the in-memory channel layer, with a temporary in-memory database
+# pass --url to connect real sockets to a running server instead, e.g. --url ws://127.0.0.1:8000
+# - the real socket mode needs the websockets package: python -m pip install websockets
+import asyncio
+import itertools
+import time
+from urllib.parse import urlsplit
+
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from ChatApp import codec
+from ChatApp.persistence import message_buffer
+
+
+def rss_bytes():
+    """Return the resident set size of this process in bytes, or None if it can't be read."""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+
+def percentile(sorted_values, fraction):
+    """Return the value at a fraction of a sorted list, e.g. 0.99 for the p99."""
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class MemoryClient:
+    """A chat client connected to the consumers of this process with a WebsocketCommunicator."""
+
+    def __init__(self, application, path):
+        from channels.testing import WebsocketCommunicator
+
+        self.communicator = WebsocketCommunicator(application, path)
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect()
+        if not connected:
+            raise CommandError("The consumer rejected the connection")
+
+    async def send(self, text_data):
+        await self.communicator.send_to(text_data=text_data)
+
+    async def receive(self, timeout):
+        return await self.communicator.receive_from(timeout=timeout)
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class SocketClient:
+    """A chat client connected to a running server over a real WebSocket."""
+
+    def __init__(self, url):
+        self.url = url
+        self.socket = None
+
+    async def connect(self):
+        try:
+            import websockets
+        except ImportError:
+            raise CommandError("--url needs the websockets package: python -m pip install websockets")
+        # the server only accepts the sockets opened from its own pages (AllowedHostsOriginValidator),
+        # - so send the Origin a browser on the target host would send
+        parts = urlsplit(self.url)
+        origin = f"{'https' if parts.scheme == 'wss' else 'http'}://{parts.netloc}"
+        self.socket = await websockets.connect(self.url, origin=origin, max_queue=None)
+
+    async def send(self, text_data):
+        await self.socket.send(text_data)
+
+    async def receive(self, timeout):
+        return await asyncio.wait_for(self.socket.recv(), timeout)
+
+    async def close(self):
+        await self.socket.close()
+
+
+class Command(BaseCommand):
+    help = "Load test the chat rooms & report delivery latency, throughput & memory per connection."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rooms", type=int, default=10, help="The number of rooms (N).")
+        parser.add_argument("--clients", type=int, default=20, help="The number of clients in each room (M).")
+        parser.add_argument("--rate", type=float, default=5, help="The messages sent to each room per second (K).")
+        parser.add_argument("--duration", type=float, default=5, help="The seconds to send messages for.")
+        parser.add_argument("--url", help="Connect real sockets to a running server, e.g. ws://127.0.0.1:8000.")
+        parser.add_argument(
+            "--batch", type=float, default=0, help="Ask for the messages in batch frames collected over this many ms."
+        )
+        parser.add_argument("--batch-size", type=int, default=0, help="The most messages in a batch frame.")
+
+    def handle(self, *args, **options):
+        self.report(self.run_options(options), options)
+
+    def run_options(self, options):
+        """Run the load test without reporting it & return the results, used by the batching benchmark."""
+        if options["url"]:
+            base_url = options["url"].rstrip("/")
+            return asyncio.run(self.run(lambda path: SocketClient(base_url + path), options))
+        return self.run_in_memory(options)
+
+    def run_in_memory(self, options):
+        from channels.routing import URLRouter
+
+        from ChatApp.auth import CachedAuthMiddlewareStack
+        from ChatApp.routing import websocket_urlpatterns
+
+        # the websocket application from asgi.py without the allowed hosts check, which needs an Origin header
+        application = CachedAuthMiddlewareStack(URLRouter(websocket_urlpatterns))
+        in_memory = override_settings(
+            CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer", "CONFIG": {"capacity": 10000}}},
+            PRESENCE_BACKEND="ChatApp.presence.InMemoryPresenceBackend",
+            CHAT_SEQUENCE_BACKEND="ChatApp.sequence.LocalRoomSequence",
+            CHAT_DIRECTORY_BACKEND="ChatApp.directory.LocalRoomDirectory",
+            # measure the consumers at the rate asked for, not at the rate the flood control allows
+            CHAT_RATE_LIMIT_CONNECTION=None,
+            CHAT_RATE_LIMIT_ROOM=None,
+        )
+        # save the messages to a temporary database so the load test doesn't fill db.sqlite3
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with in_memory:
+                return async_to_sync(self.run)(lambda path: MemoryClient(application, path), options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    async def run(self, make_client, options):
+        rooms = [f"loadtest{number}" for number in range(options["rooms"])]
+        rss_before = rss_bytes()
+        batching = ""
+        if options["batch"]:
+            batching = f"&batch={options['batch']:g}&batch_size={options['batch_size']}"
+
+        clients = {}
+        for room_name in rooms:
+            clients[room_name] = []
+            for number in range(options["clients"]):
+                client = make_client(f"/ws/ChatApp/{room_name}/?username=user{number}{batching}")
+                await client.connect()
+                clients[room_name].append(client)
+        connections = sum(len(room_clients) for room_clients in clients.values())
+        rss_connected = rss_bytes()
+
+        latencies = []
+        # the frames received, a batch frame carries several messages
+        frames = [0]
+        receivers = [
+            asyncio.ensure_future(self.receive_all(client, latencies, frames))
+            for room_clients in clients.values()
+            for client in room_clients
+        ]
+
+        # every room sends K messages per second, from its clients in turn
+        interval = 1 / options["rate"]
+        sent = 0
+        started = time.perf_counter()
+        cpu_started = time.process_time()
+        for tick in itertools.count():
+            due = started + tick * interval
+            if due - started >= options["duration"]:
+                break
+            await asyncio.sleep(max(0, due - time.perf_counter()))
+            for room_name in rooms:
+                sender = clients[room_name][tick % len(clients[room_name])]
+                text_data = codec.dumps({"message": str(time.perf_counter()), "username": "loadtest"})
+                await sender.send(text_data)
+                sent += 1
+
+        # wait for the messages in flight to be delivered
+        expected = sent * options["clients"]
+        deadline = time.perf_counter() + 10
+        while len(latencies) < expected and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        cpu = time.process_time() - cpu_started
+
+        for receiver in receivers:
+            receiver.cancel()
+        await asyncio.gather(*receivers, return_exceptions=True)
+        for room_clients in clients.values():
+            for client in room_clients:
+                await client.close()
+        # write the messages of the in-memory run before its temporary database is destroyed
+        await message_buffer.close()
+
+        return {
+            "connections": connections,
+            "sent": sent,
+            "expected": expected,
+            "latencies": sorted(latencies),
+            "elapsed": elapsed,
+            "cpu": cpu,
+            "frames": frames[0],
+            "rss_before": rss_before,
+            "rss_connected": rss_connected,
+        }
+
+    async def receive_all(self, client, latencies, frames):
+        while True:
+            try:
+                text_data = await client.receive(timeout=30)
+            except asyncio.TimeoutError:
+                continue
+            data = codec.loads(text_data)
+            if data.get("type") == "ping":
+                # a client that only receives is quiet, answer so it isn't closed as idle in a long run
+                await client.send('{"type": "pong"}')
+                continue
+            messages = data["messages"] if data.get("type") == "batch" else [data]
+            if messages and messages[0].get("username") == "loadtest":
+                frames[0] += 1
+            # only the chat messages sent by the load test carry a send time, skip the history & other frames
+            for message in messages:
+                if message.get("username") == "loadtest":
+                    latencies.append(time.perf_counter() - float(message["message"]))
+
+    def report(self, results, options):
+        latencies = results["latencies"]
+        delivered = len(latencies)
+        self.stdout.write(
+            f"{options['rooms']} rooms × {options['clients']} clients × {options['rate']:g} messages/s "
+            f"for {options['duration']:g}s ({results['connections']} connections)"
+        )
+        self.stdout.write(f"sent {results['sent']} messages, delivered {delivered}/{results['expected']}")
+        self.stdout.write(f"throughput: {delivered / results['elapsed']:.0f} deliveries/s")
+        self.stdout.write(
+            f"frames: {results['frames'] / results['elapsed']:.0f} frames/s, "
+            f"CPU: {results['cpu'] * 1e6 / max(delivered, 1):.1f} µs per delivery"
+        )
+        self.stdout.write(
+            f"latency: p50 {percentile(latencies, 0.5) * 1000:.2f} ms, p99 {percentile(latencies, 0.99) * 1000:.2f} ms"
+        )
+        if results["rss_before"] is not None and results["rss_connected"] is not None and results["connections"]:
+            per_connection = (results["rss_connected"] - results["rss_before"]) / results["connections"]
+            self.stdout.write(f"memory: {per_connection / 1024:.1f} KiB RSS per connection")
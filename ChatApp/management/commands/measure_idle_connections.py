@@ -0,0 +1,139 @@
+# measure the memory kept by the idle WebSocket connections of one worker
+# - run with: python manage.py measure_idle_connections --connections 10000 --rooms 100
+# opens the connections to /ws/room/<room_name>/ & leaves them idle, then reports the bytes per connection
+# - allocated by Python (tracemalloc) & added to the resident set size, & the files that allocated the most
+# the clients are channels.testing.WebsocketCommunicator instances in this process, like the in-memory load test,
+# - so the numbers include the two queues & the task of each test client on top of the consumer's own state
+# opening 10k connections takes a few minutes, the in-memory channel layer checks every channel for expired messages
+# - on each send, so it slows down as the connections add up
+import asyncio
+import gc
+import time
+import tracemalloc
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from ChatApp.management.commands.loadtest_chat import rss_bytes
+from ChatApp.persistence import message_buffer
+
+
+def drain(communicator):
+    """Drop the frames a connection was sent, e.g. its history & the presence of the room."""
+    while not communicator.output_queue.empty():
+        communicator.output_queue.get_nowait()
+
+
+async def drop_presence_events():
+    # the presence worker runs in a process of its own, so its events aren't kept in this one
+    channel_layer = get_channel_layer()
+    while True:
+        await channel_layer.receive("presence_channel")
+
+
+class Command(BaseCommand):
+    help = "Open idle WebSocket connections & report the memory kept per connection."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--connections", type=int, default=10000, help="The number of idle connections.")
+        parser.add_argument("--rooms", type=int, default=100, help="The rooms the connections are spread over.")
+        parser.add_argument("--top", type=int, default=10, help="The number of files to list by memory allocated.")
+
+    def handle(self, *args, **options):
+        if options["connections"] < 1 or options["rooms"] < 1:
+            raise CommandError("--connections & --rooms must be at least 1")
+
+        from channels.routing import URLRouter
+
+        from ChatApp.auth import CachedAuthMiddlewareStack
+        from ChatApp.routing import websocket_urlpatterns
+
+        application = CachedAuthMiddlewareStack(URLRouter(websocket_urlpatterns))
+        in_memory = override_settings(
+            CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+            PRESENCE_BACKEND="ChatApp.presence.InMemoryPresenceBackend",
+            CHAT_SEQUENCE_BACKEND="ChatApp.sequence.LocalRoomSequence",
+            CHAT_DIRECTORY_BACKEND="ChatApp.directory.LocalRoomDirectory",
+            CHAT_RATE_LIMIT_CONNECTION=None,
+            CHAT_RATE_LIMIT_ROOM=None,
+            # the connections stay quiet for longer than the timeout while the others are opened
+            CHAT_PING_INTERVAL=None,
+        )
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with in_memory:
+                results = async_to_sync(self.run)(application, options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        self.report(results, options)
+
+    async def run(self, application, options):
+        from channels.testing import WebsocketCommunicator
+
+        rooms = [f"idle{number}" for number in range(options["rooms"])]
+        presence_worker = asyncio.ensure_future(drop_presence_events())
+
+        async def open_connection(room_name, number):
+            communicator = WebsocketCommunicator(application, f"/ws/room/{room_name}/?username=user{number}")
+            connected, _ = await communicator.connect()
+            if not connected:
+                raise CommandError("The consumer rejected the connection")
+            return communicator
+
+        # open & close a connection in every room first, so the state kept per room isn't counted per connection
+        for room_name in rooms:
+            communicator = await open_connection(room_name, 0)
+            await communicator.disconnect()
+
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        traced_before = tracemalloc.get_traced_memory()[0]
+        rss_before = rss_bytes()
+
+        started = time.perf_counter()
+        communicators = []
+        for number in range(options["connections"]):
+            communicators.append(await open_connection(rooms[number % len(rooms)], number))
+        # let the presence & the other frames sent on connect arrive, then drop them
+        await asyncio.sleep(0.5)
+        for communicator in communicators:
+            drain(communicator)
+        elapsed = time.perf_counter() - started
+
+        gc.collect()
+        traced = tracemalloc.get_traced_memory()[0] - traced_before
+        after = tracemalloc.take_snapshot()
+        rss_after = rss_bytes()
+        tracemalloc.stop()
+        top = after.compare_to(before, "filename")[: options["top"]]
+
+        for communicator in communicators:
+            await communicator.disconnect()
+        presence_worker.cancel()
+        # write the messages of the run before its temporary database is destroyed
+        await message_buffer.close()
+
+        return {
+            "connections": len(communicators),
+            "elapsed": elapsed,
+            "traced": traced,
+            "rss": None if rss_before is None or rss_after is None else rss_after - rss_before,
+            "top": top,
+        }
+
+    def report(self, results, options):
+        connections = results["connections"]
+        self.stdout.write(
+            f"{connections} idle connections in {options['rooms']} rooms, opened in {results['elapsed']:.1f}s"
+        )
+        self.stdout.write(f"tracemalloc: {results['traced'] / connections:,.0f} bytes per connection")
+        if results["rss"] is not None:
+            # the RSS also grows with the tracemalloc bookkeeping, so it's an upper bound
+            self.stdout.write(f"RSS: {results['rss'] / connections:,.0f} bytes per connection")
+        self.stdout.write("allocated by:")
+        for stat in results["top"]:
+            self.stdout.write(f"  {stat.size_diff / connections:8,.0f} B  {stat.traceback[0].filename}")
@@ -0,0 +1,45 @@
+# send new shards to every process of a sharded deployment, see ChatApp/sharding.py
+# - run with: python manage.py reshard --shard a=ws://10.0.0.1:8001 --shard b=ws://10.0.0.2:8001 --shard c=ws://10.0.0.3:8001
+# every process listens on the "chat_shards" group from its start & redirects the members of its rooms that moved
+# - set CHAT_SHARDS to the same shards so the processes started later use them too
+# pass --dry-run to only print the share of the rooms that would move from the CHAT_SHARDS in settings.py
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ChatApp.sharding import SHARDS_GROUP, HashRing
+
+
+class Command(BaseCommand):
+    help = "Send new room shards to every chat process & redirect the members of the rooms that moved."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--shard", action="append", default=[], metavar="NAME=URL", help="A shard & its WebSocket base URL."
+        )
+        parser.add_argument("--dry-run", action="store_true", help="Only print the share of the rooms that would move.")
+        parser.add_argument("--rooms", type=int, default=10000, help="The sample of room names for the share moved.")
+
+    def handle(self, *args, **options):
+        shards = {}
+        for shard in options["shard"]:
+            name, sep, url = shard.partition("=")
+            if not sep or not name or not url:
+                raise CommandError(f"--shard must be NAME=URL, not {shard!r}")
+            shards[name] = url
+
+        # the share of a sample of rooms that move, ~1/N when a shard joins N-1 shards or leaves N
+        replicas = getattr(settings, "CHAT_SHARD_REPLICAS", 100)
+        old = HashRing(getattr(settings, "CHAT_SHARDS", None) or (), replicas)
+        new = HashRing(shards, replicas)
+        rooms = [f"chat_room{number}" for number in range(options["rooms"])]
+        if len(old):
+            moved = sum(old.get(room) != new.get(room) for room in rooms)
+            self.stdout.write(f"{moved / max(len(rooms), 1):.1%} of the rooms move to {len(shards)} shards")
+        else:
+            self.stdout.write(f"CHAT_SHARDS is None, every room gets one of the {len(shards)} shards")
+
+        if not options["dry_run"]:
+            async_to_sync(get_channel_layer().group_send)(SHARDS_GROUP, {"type": "shards.update", "shards": shards or None})
+            self.stdout.write(f"Sent the shards to the {SHARDS_GROUP} group")
@@ -0,0 +1,201 @@
+# run the chat app in production: one master process & N Daphne workers forked from it, sharing its listening socket
+# - run with: DJANGO_SETTINGS_MODULE=CodingNightChatApp.settings_production python manage.py serve --workers 4
+# the master loads the application, the URLs & Twisted's protocols once & forks the workers from it
+# - so a worker is ready in a few ms & its first requests don't wait for the imports, e.g. when it replaces another
+# - Twisted's reactor is only installed by each worker after the fork, so the settings mustn't have "daphne" in
+#   INSTALLED_APPS, which installs it when Django starts (CodingNightChatApp/settings_production.py removes it)
+# signals to the master:
+# - TERM or INT: every worker drains, see ChatApp/server.py, then the master exits
+# - HUP: the workers are replaced one at a time, each new worker starts before the worker it replaces drains
+# a worker that dies is replaced
+# to deploy new code, start a new master on the same port (the socket has SO_REUSEPORT) & send TERM to the old one
+# - the clients of the old workers reconnect to the new ones within CHAT_DRAIN_JITTER seconds
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+logger = logging.getLogger(__name__)
+
+# the modules loaded by the master before the fork, Twisted's protocols without its reactor
+PRELOADED_MODULES = (
+    "twisted.internet.asyncioreactor",
+    "twisted.internet.endpoints",
+    "twisted.internet.tcp",
+    "daphne.http_protocol",
+    "daphne.ws_protocol",
+)
+
+
+def bind(address, backlog):
+    """Return a listening socket for a HOST:PORT address, e.g. "0.0.0.0:8000"."""
+    host, sep, port = address.rpartition(":")
+    if not sep or not port.isdigit():
+        raise CommandError(f"--bind must be HOST:PORT, not {address!r}")
+    if ":" in host:
+        # Daphne's fd: endpoint, which the workers listen on the socket with, can only adopt IPv4 sockets
+        raise CommandError("--bind only takes IPv4 addresses, put a proxy in front of the workers for IPv6")
+    try:
+        return socket.create_server((host, int(port)), backlog=backlog, reuse_port=hasattr(socket, "SO_REUSEPORT"))
+    except OSError as error:
+        raise CommandError(f"Can't listen on {address}: {error}")
+
+
+def preload():
+    """Load the application & everything its first requests would import, return the application."""
+    import importlib
+
+    from channels.routing import get_default_application
+    from django.db import connections
+    from django.urls import get_resolver
+
+    application = get_default_application()
+    # the URLconf is imported by the first HTTP request otherwise, with the views & the admin
+    get_resolver().url_patterns
+    for module in PRELOADED_MODULES:
+        importlib.import_module(module)
+    # the workers open their own database connections
+    connections.close_all()
+    return application
+
+
+class Command(BaseCommand):
+    help = "Serve the chat app with N Daphne workers sharing one socket, with graceful drain on TERM & HUP."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="The number of workers.")
+        parser.add_argument("--bind", default="127.0.0.1:8000", help="The HOST:PORT to listen on.")
+        parser.add_argument("--backlog", type=int, default=2048, help="The connections waiting to be accepted.")
+        parser.add_argument(
+            "--proxy-headers", action="store_true", help="Take the client's address from the X-Forwarded-* headers."
+        )
+
+    def handle(self, *args, **options):
+        if options["workers"] < 1:
+            raise CommandError("--workers must be at least 1")
+        if "twisted.internet.reactor" in sys.modules:
+            raise CommandError(
+                "Twisted's reactor is already installed, e.g. by 'daphne' in INSTALLED_APPS, & it can't be shared by "
+                "forked workers. Use settings without it: DJANGO_SETTINGS_MODULE=CodingNightChatApp.settings_production"
+            )
+
+        self.options = options
+        self.sock = bind(options["bind"], options["backlog"])
+        started = time.perf_counter()
+        self.application = preload()
+        self.stdout.write(f"Loaded the application in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+        # pid -> the time.monotonic() value when the worker was started
+        self.workers = {}
+        self.signals = []
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, lambda signum, frame: self.signals.append(signum))
+
+        self.stdout.write(f"Listening on {options['bind']} with {options['workers']} workers (master {os.getpid()})")
+        while len(self.workers) < options["workers"]:
+            self.spawn()
+        self.supervise()
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            self.run_worker()
+        self.workers[pid] = time.monotonic()
+        return pid
+
+    def run_worker(self):
+        # the forked worker never returns to the master's code
+        code = 0
+        try:
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, signal.SIG_DFL)
+            # the master replaces the workers on HUP, a worker ignores it
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            started = time.perf_counter()
+            from ChatApp.server import run_worker
+
+            logger.info("Worker %d started in %.1f ms", os.getpid(), (time.perf_counter() - started) * 1000)
+            run_worker(self.sock, self.application, proxy_headers=self.options["proxy_headers"])
+        except BaseException:
+            logger.exception("Worker %d failed", os.getpid())
+            code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def reap(self):
+        """Forget the workers that exited, return their pids."""
+        exited = []
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                break
+            started = self.workers.pop(pid, None)
+            if started is not None:
+                exited.append(pid)
+                if status:
+                    logger.warning("Worker %d exited with status %d", pid, os.waitstatus_to_exitcode(status))
+                    if time.monotonic() - started < 1:
+                        # don't fork as fast as the workers fail, e.g. when the database is down
+                        time.sleep(1)
+        return exited
+
+    def supervise(self):
+        while True:
+            self.reap()
+            while self.signals:
+                signum = self.signals.pop(0)
+                if signum == signal.SIGHUP:
+                    self.restart_workers()
+                else:
+                    self.stop_workers()
+                    return
+            while len(self.workers) < self.options["workers"]:
+                self.spawn()
+            time.sleep(0.1)
+
+    def wait_for(self, pids, timeout):
+        """Wait for some workers to exit, kill the ones still running after the timeout."""
+        deadline = time.monotonic() + timeout
+        while pids & self.workers.keys() and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in pids & self.workers.keys():
+            logger.warning("Killing worker %d, it didn't drain in time", pid)
+            os.kill(pid, signal.SIGKILL)
+        while pids & self.workers.keys():
+            self.reap()
+            time.sleep(0.01)
+
+    def drain_timeout(self):
+        # the workers stop themselves after CHAT_DRAIN_TIMEOUT, with a margin to write the last messages
+        return getattr(settings, "CHAT_DRAIN_TIMEOUT", 10) + 5
+
+    def restart_workers(self):
+        self.stdout.write("Replacing the workers")
+        for pid in list(self.workers):
+            if self.signals and self.signals[0] != signal.SIGHUP:
+                # stopping the master takes over from the restart
+                return
+            self.spawn()
+            os.kill(pid, signal.SIGTERM)
+            self.wait_for({pid}, self.drain_timeout())
+
+    def stop_workers(self):
+        self.stdout.write("Draining the workers")
+        # once the workers stop listening the socket is closed, so the kernel sends the new connections to a new master
+        self.sock.close()
+        pids = set(self.workers)
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+        self.wait_for(pids, self.drain_timeout())
+        self.stdout.write("Stopped")
@@ -0,0 +1,214 @@
+# lightweight instrumentation of the consumers
+# - the counters, gauges & histograms are plain Python numbers in this worker's memory, with no locks or I/O,
+# - & the metrics view renders them in the Prometheus text format for a scraper to aggregate across workers
+# set METRICS_ENABLED = False in settings.py to turn the recording & the metrics view off entirely
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+# the upper bounds of the latency histograms in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+# every metric of this worker, in the order they were created
+registry = []
+
+# whether the metrics are recorded, checked by every metric before it records anything
+enabled = getattr(settings, "METRICS_ENABLED", True)
+
+
+@receiver(setting_changed)
+def _update_enabled(setting, **kwargs):
+    global enabled
+    if setting == "METRICS_ENABLED":
+        enabled = getattr(settings, "METRICS_ENABLED", True)
+
+
+def _format_labels(labelnames, labelvalues, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    """A number that only goes up, e.g. the number of errors.
+
+    :param name: The name of the metric.
+    :type name: str
+    :param documentation: The help text of the metric.
+    :type documentation: str
+    :param labelnames: The names of the labels, the values are passed in the same order when recording.
+    :type labelnames: tuple
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = defaultdict(float)
+        registry.append(self)
+
+    def inc(self, *labelvalues, amount=1):
+        if enabled:
+            self._values[labelvalues] += amount
+
+    def value(self, *labelvalues):
+        return self._values.get(labelvalues, 0)
+
+    def samples(self):
+        for labelvalues, value in self._values.items():
+            yield self.name + _format_labels(self.labelnames, labelvalues), value
+
+    def clear(self):
+        self._values.clear()
+
+
+class Gauge(Counter):
+    """A number that goes up & down, e.g. the number of open connections."""
+
+    kind = "gauge"
+
+    def dec(self, *labelvalues, amount=1):
+        if enabled:
+            self._values[labelvalues] -= amount
+            # drop labels that went back to zero so they don't stay in the output forever
+            if labelvalues and not self._values[labelvalues]:
+                del self._values[labelvalues]
+
+    def set(self, *labelvalues, value):
+        if enabled:
+            self._values[labelvalues] = value
+
+
+class Histogram(Counter):
+    """The distribution of a measurement, e.g. a latency, in cumulative buckets.
+
+    :param buckets: The upper bounds of the buckets, in increasing order.
+    :type buckets: tuple
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+        # label values -> [a count for each bucket & one for +Inf, sum]
+        self._values = {}
+
+    def observe(self, value, *labelvalues):
+        if not enabled:
+            return
+        state = self._values.get(labelvalues)
+        if state is None:
+            state = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+        # only the bucket the value falls in is incremented, the counts are made cumulative when rendered
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def count(self, *labelvalues):
+        state = self._values.get(labelvalues)
+        return sum(state[0]) if state else 0
+
+    def samples(self):
+        for labelvalues, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, labelvalues, f'le="{bound}"')
+                yield f"{self.name}_bucket{labels}", cumulative
+            labels = _format_labels(self.labelnames, labelvalues)
+            yield f"{self.name}_sum{labels}", total
+            yield f"{self.name}_count{labels}", cumulative
+
+
+async def count_errors(operation, awaitable):
+    """Await a channel layer call & count it in chat_channel_layer_errors_total if it raises.
+
+    :param operation: The name of the call, e.g. "group_send".
+    :type operation: str
+    :param awaitable: The call to await.
+    :type awaitable: Awaitable
+    :return: The result of the call.
+    """
+    try:
+        return await awaitable
+    except Exception:
+        CHANNEL_LAYER_ERRORS.inc(operation)
+        raise
+
+
+def render():
+    """Render every metric in the Prometheus text exposition format.
+
+    :return: The metrics, one sample per line.
+    :rtype: str
+    """
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for sample, value in metric.samples():
+            lines.append(f"{sample} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# the metrics of the consumers
+# - not by room, the rooms are unbounded, the room directory counts the members of each room
+ACTIVE_CONNECTIONS = Gauge("chat_active_connections", "The chat sockets open in this worker.")
+RECEIVE_TO_GROUP_SEND = Histogram(
+    "chat_receive_to_group_send_seconds", "The time from receiving a chat frame to the end of its group_send."
+)
+GROUP_SEND_TO_SEND = Histogram(
+    "chat_group_send_to_send_seconds", "The time from the group_send of a message to sending it to a member."
+)
+JSON_DECODE = Histogram("chat_json_decode_seconds", "The time spent decoding a frame received from a WebSocket.")
+JSON_ENCODE = Histogram("chat_json_encode_seconds", "The time spent encoding a frame for a broadcast.")
+CHANNEL_LAYER_ERRORS = Counter(
+    "chat_channel_layer_errors_total", "The channel layer calls that raised an error, by operation.", ("operation",)
+)
+PRESENCE_UPDATES = Counter(
+    "chat_presence_updates_total", "The presence changes applied to the presence store, by source.", ("source",)
+)
+CHANNEL_LAYER_MESSAGES = Counter(
+    "chat_channel_layer_messages_total",
+    "The group messages of the hybrid channel layer, by path: delivered locally, published or delivered from another "
+    "process.",
+    ("path",),
+)
+SEND_QUEUE_LAG = Histogram(
+    "chat_send_queue_lag_seconds", "The time a frame waited in the send queue of its connection before it was sent."
+)
+SEND_QUEUE_DROPPED = Counter(
+    "chat_send_queue_dropped_total", "The frames dropped from the send queue of a slow connection, by policy.", ("policy",)
+)
+SLOW_CLIENTS_CLOSED = Counter(
+    "chat_slow_clients_closed_total", "The connections closed because their send queue was full."
+)
+RATE_LIMITED = Counter(
+    "chat_rate_limited_total", "The frames rejected by the flood control, by the limit they hit.", ("limit",)
+)
+CATCH_UPS = Counter(
+    "chat_catch_ups_total",
+    "The reconnects that were sent only the messages they missed (gap) or the latest page (snapshot).",
+    ("result",),
+)
+AUTH_CACHE = Counter(
+    "chat_auth_cache_total", "The WebSocket handshakes with a session, by whether its user was cached.", ("result",)
+)
+IDLE_CONNECTIONS_CLOSED = Counter(
+    "chat_idle_connections_closed_total", "The connections closed after their client stopped answering the pings."
+)
+SHARD_REDIRECTS = Counter(
+    "chat_shard_redirects_total",
+    "The connections sent to the shard of their room, when they connected or when the room moved.",
+    ("reason",),
+)
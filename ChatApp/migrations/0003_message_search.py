@@ -0,0 +1,66 @@
+# the full-text index of the chat messages, see ChatApp/search.py
+# - an SQLite FTS5 table that indexes the content, the room & the author of every message by word
+# - it's an external content table, the text is read from ChatApp_message so it isn't stored twice
+# - prefix='2 3' also indexes the first 2 & 3 letters of every word, so a search for the start of a word is fast
+# - the triggers add every message to the index as it's inserted, including the batches of bulk_create
+# other databases don't have FTS5, so nothing is created & the search falls back to a scan of the room's messages
+
+from django.db import migrations
+
+FORWARD = [
+    """
+    CREATE VIRTUAL TABLE chatapp_message_fts USING fts5(
+        content, room_name, username, content='ChatApp_message', content_rowid='id', prefix='2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER chatapp_message_fts_insert AFTER INSERT ON ChatApp_message BEGIN
+        INSERT INTO chatapp_message_fts(rowid, content, room_name, username)
+        VALUES (new.id, new.content, new.room_name, new.username);
+    END
+    """,
+    """
+    CREATE TRIGGER chatapp_message_fts_delete AFTER DELETE ON ChatApp_message BEGIN
+        INSERT INTO chatapp_message_fts(chatapp_message_fts, rowid, content, room_name, username)
+        VALUES ('delete', old.id, old.content, old.room_name, old.username);
+    END
+    """,
+    """
+    CREATE TRIGGER chatapp_message_fts_update AFTER UPDATE ON ChatApp_message BEGIN
+        INSERT INTO chatapp_message_fts(chatapp_message_fts, rowid, content, room_name, username)
+        VALUES ('delete', old.id, old.content, old.room_name, old.username);
+        INSERT INTO chatapp_message_fts(rowid, content, room_name, username)
+        VALUES (new.id, new.content, new.room_name, new.username);
+    END
+    """,
+    # index the messages saved before the index existed
+    "INSERT INTO chatapp_message_fts(chatapp_message_fts) VALUES ('rebuild')",
+]
+
+BACKWARD = [
+    "DROP TRIGGER IF EXISTS chatapp_message_fts_insert",
+    "DROP TRIGGER IF EXISTS chatapp_message_fts_delete",
+    "DROP TRIGGER IF EXISTS chatapp_message_fts_update",
+    "DROP TABLE IF EXISTS chatapp_message_fts",
+]
+
+
+def run_on_sqlite(statements):
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor != "sqlite":
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ChatApp', '0002_message_seq'),
+    ]
+
+    operations = [
+        migrations.RunPython(run_on_sqlite(FORWARD), run_on_sqlite(BACKWARD)),
+    ]
@@ -1,3 +1,38 @@
 from django.db import models
+from django.utils import timezone
 
 # Create your models here.
+# create a model for the chat messages so that the history of a room is kept on the server
+# - instead of only in each browser's localStorage
+# NOTE: the table is append-only, rows are inserted when a message is received and never updated
+class Message(models.Model):
+    """A chat message that was sent to a chat room.
+
+    :param models.Model: The Message class inherits from Django's Model class
+    :type models.Model: Class
+    """
+    # the room name from the URL route, e.g. /ChatApp/lobby/ => "lobby"
+    room_name = models.CharField(max_length=100)
+    # the username that was entered on the index page
+    username = models.CharField(max_length=150)
+    # the actual message content sent through the WebSocket
+    content = models.TextField()
+    # the time the server received the message, used to display the timestamp in the chat log
+    created_at = models.DateTimeField(default=timezone.now)
+    # the position of the message in its room, a reconnecting client asks for the messages after the last one it saw
+    # - empty for the messages saved before rooms had sequence numbers
+    seq = models.PositiveBigIntegerField(null=True, blank=True)
+
+    class Meta:
+        # order by the auto-incrementing id because it is the cursor used to paginate the history of a room
+        ordering = ["id"]
+        # index the room name together with the id so a page of history is a range scan of the index
+        # - instead of a scan over the messages of every room
+        indexes = [
+            models.Index(fields=["room_name", "id"], name="chatapp_message_room_id"),
+            # the latest sequence number of a room is read from this index when a worker starts counting the room
+            models.Index(fields=["room_name", "seq"], name="chatapp_message_room_seq"),
+        ]
+
+    def __str__(self):
+        return f"{self.room_name} - {self.username}: {self.content[:50]}"
@@ -0,0 +1,187 @@
+# a bounded queue of the frames waiting to be sent to each WebSocket
+# - without it a consumer awaits every send, so a client on a slow link holds up the group messages of its consumer
+#   while the channel layer's queue of its channel fills up & the messages to it are dropped at random
+# - the consumer puts each frame on the queue of its connection & a writer task sends them in the background,
+#   so the consumer is free to handle the next message as soon as the frame is queued
+# when the queue is full the CHAT_SEND_QUEUE_POLICY decides what happens to a client that can't keep up:
+# - "drop_oldest": the oldest frame waiting is dropped
+# - "coalesce": the frames waiting are replaced by one resync frame, the client then fetches the history & the users again
+# - "disconnect": the connection is closed with CHAT_SEND_QUEUE_CLOSE_CODE & the client reconnects
+# the wait between queueing & sending a frame is the lag of the connection, it is recorded in the metrics
+import asyncio
+import logging
+import time
+from collections import deque
+
+from django.conf import settings
+
+from . import codec, metrics
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+
+class SendQueue:
+    """The frames waiting to be sent to one WebSocket, with the lag counters of the connection.
+
+    The settings are read when the queue is created:
+
+    - ``CHAT_SEND_QUEUE_SIZE``: the frames that can wait before the policy is applied
+    - ``CHAT_SEND_QUEUE_POLICY``: "drop_oldest", "coalesce" or "disconnect"
+    - ``CHAT_SEND_QUEUE_CLOSE_CODE``: the close code of a connection disconnected for being too slow
+
+    :param send: The ASGI send function of the connection.
+    :type send: callable
+    """
+
+    # one queue per connection, so no __dict__
+    __slots__ = (
+        "_send", "maxsize", "policy", "close_code", "_queue", "_writer", "closed",
+        "sent", "dropped", "coalesced", "last_lag", "max_lag",
+    )
+
+    def __init__(self, send):
+        self._send = send
+        self.maxsize = getattr(settings, "CHAT_SEND_QUEUE_SIZE", 256)
+        self.policy = getattr(settings, "CHAT_SEND_QUEUE_POLICY", "drop_oldest")
+        if self.policy not in POLICIES:
+            raise ValueError(f"CHAT_SEND_QUEUE_POLICY must be one of {', '.join(POLICIES)}, not {self.policy!r}")
+        self.close_code = getattr(settings, "CHAT_SEND_QUEUE_CLOSE_CODE", 4008)
+        # (the time.monotonic() value when the message was queued, ASGI message)
+        self._queue = deque()
+        # the task sending the queued frames, it only runs while there are frames so an idle connection has no task
+        self._writer = None
+        self.closed = False
+
+        # the lag counters of the connection
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def stats(self):
+        """Return the lag counters of the connection.
+
+        :return: The counters by name, with the frames waiting as "queued".
+        :rtype: dict
+        """
+        return {
+            "queued": len(self._queue),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "last_lag": self.last_lag,
+            "max_lag": self.max_lag,
+        }
+
+    async def send(self, message):
+        """Queue an ASGI message to be sent to the WebSocket, the consumer's ``base_send``.
+
+        The accept is sent straight away, the close is queued after the frames waiting so none of them are lost.
+
+        :param message: The ASGI message, e.g. {"type": "websocket.send", "text": "..."}.
+        :type message: dict
+        """
+        if self.closed:
+            return
+        if message["type"] == "websocket.accept":
+            await self._send(message)
+            return
+        if message["type"] == "websocket.send" and len(self._queue) >= self.maxsize:
+            if self.policy == "disconnect":
+                await self.evict()
+                return
+            if self.policy == "coalesce":
+                self.coalesce()
+            else:
+                self._queue.popleft()
+                self.dropped += 1
+                metrics.SEND_QUEUE_DROPPED.inc(self.policy)
+
+        self._queue.append((time.monotonic(), message))
+        if self._writer is None:
+            self._writer = asyncio.ensure_future(self._write())
+
+    def coalesce(self):
+        """Replace the frames waiting with one resync frame that tells the client how many frames it missed."""
+        missed = 0
+        kept = deque()
+        for queued_at, message in self._queue:
+            if message["type"] != "websocket.send":
+                kept.append((queued_at, message))
+            elif message.get("resync"):
+                # a client that is still behind after a resync misses the frames of both
+                missed += message["resync"]
+            else:
+                missed += 1
+        self._queue = kept
+        self.coalesced += missed
+        metrics.SEND_QUEUE_DROPPED.inc(self.policy, amount=missed)
+        # the resync frame goes first, the frames queued after it are still sent
+        # - "resync" is kept in the ASGI message so a later coalesce can count the frames this one replaced
+        text = codec.dumps({"type": "resync", "missed": missed})
+        self._queue.appendleft((time.monotonic(), {"type": "websocket.send", "text": text, "resync": missed}))
+
+    async def evict(self):
+        """Drop the frames waiting & close the connection of a client that fell too far behind."""
+        logger.info("Closing a connection with %d frames waiting to be sent", len(self._queue))
+        self.dropped += len(self._queue)
+        metrics.SEND_QUEUE_DROPPED.inc(self.policy, amount=len(self._queue))
+        metrics.SLOW_CLIENTS_CLOSED.inc()
+        self._queue.clear()
+        self.closed = True
+        # the close is sent by a task of its own, the consumer mustn't wait for the slow client to take it
+        # - the frame the writer was sending is abandoned
+        if self._writer is not None:
+            self._writer.cancel()
+        self._writer = asyncio.ensure_future(self._send({"type": "websocket.close", "code": self.close_code}))
+
+    async def _write(self):
+        try:
+            while self._queue:
+                queued_at, message = self._queue.popleft()
+                message.pop("resync", None)
+                await self._send(message)
+                self.sent += 1
+                self.last_lag = time.monotonic() - queued_at
+                self.max_lag = max(self.max_lag, self.last_lag)
+                metrics.SEND_QUEUE_LAG.observe(self.last_lag)
+        finally:
+            # a send that failed, e.g. because the socket closed, lets the next frame start a writer again
+            # - unless evict() already replaced this writer with the task sending the close
+            if self._writer is asyncio.current_task():
+                self._writer = None
+
+    async def drain(self):
+        """Wait for the frames waiting to be sent."""
+        while self._writer is not None and not self._writer.done():
+            await asyncio.shield(self._writer)
+
+    def close(self):
+        """Stop the writer, the frames that are still waiting are dropped with the connection."""
+        self.closed = True
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+
+
+class SendQueueMixin:
+    """Send the frames of a consumer through a :class:`SendQueue`.
+
+    The queue wraps the ASGI send function of the connection, so a consumer that runs inside another consumer,
+    like the streams of MultiplexConsumer, uses the queue of the outer consumer instead of having its own.
+    """
+
+    send_queue = None
+
+    async def __call__(self, scope, receive, send):
+        self.send_queue = SendQueue(send)
+        try:
+            await super().__call__(scope, receive, self.send_queue.send)
+        finally:
+            self.send_queue.close()
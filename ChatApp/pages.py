@@ -0,0 +1,77 @@
+# a cache of the rendered HTML of the pages
+# - the index & the chat rooms are shells with no per-user content, the chat itself arrives over the WebSocket,
+# - so each page is rendered once per worker instead of running the template engine & the context processors on every
+#   request
+# every cached page has an ETag, so a browser that already has the page is answered with 304 Not Modified
+# the scripts & the styles of the pages are static files with a hash of their content in their name, see STORAGES,
+# - so the shell stays small & the assets can be cached by the browser for a year
+import hashlib
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.template.loader import render_to_string
+
+
+class PageCache:
+    """The rendered HTML of each page & its ETag, the least recently used page is dropped first.
+
+    The pages are rendered without a request, so their templates mustn't use the request, the user or the CSRF token.
+    The settings are read when the cache is first used so they can be changed in the tests:
+
+    - ``CHAT_PAGE_CACHE_SIZE``: the pages kept, e.g. one per chat room
+    """
+
+    def __init__(self):
+        # (template name, key) -> (HTML, ETag)
+        self._pages = OrderedDict()
+        self._configured = False
+
+    def _configure(self):
+        self.size = getattr(settings, "CHAT_PAGE_CACHE_SIZE", 1000)
+        self._configured = True
+
+    def get(self, template_name, context=None, key=None):
+        """Return the rendered HTML of a page & its ETag, rendering the page if it isn't cached.
+
+        :param template_name: The name of the template of the page.
+        :type template_name: str
+        :param context: The context of the template, the same for every request with the same key.
+        :type context: dict or None
+        :param key: What tells the pages of the template apart, e.g. the room name.
+        :type key: str or None
+        :return: The (HTML, quoted ETag) of the page.
+        :rtype: tuple
+        """
+        if not self._configured:
+            self._configure()
+
+        cache_key = (template_name, key)
+        page = self._pages.get(cache_key)
+        if page is not None:
+            self._pages.move_to_end(cache_key)
+            return page
+
+        html = render_to_string(template_name, context)
+        page = self._pages[cache_key] = (html, '"%s"' % hashlib.md5(html.encode(), usedforsecurity=False).hexdigest())
+        if len(self._pages) > self.size:
+            self._pages.popitem(last=False)
+        return page
+
+    def clear(self):
+        """Drop every cached page."""
+        self._pages.clear()
+        self._configured = False
+
+
+# the pages rendered by this worker
+page_cache = PageCache()
+
+
+@receiver(setting_changed)
+def _reset_page_cache(setting, **kwargs):
+    # the pages depend on the static files storage & the heartbeat interval, render them again when the tests change
+    # them
+    if setting in ("CHAT_PAGE_CACHE_SIZE", "STATIC_URL", "STORAGES", "PRESENCE_HEARTBEAT_INTERVAL"):
+        page_cache.clear()
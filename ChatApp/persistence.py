@@ -0,0 +1,129 @@
+# a write-behind buffer for the messages saved to the history of the chat rooms
+# - every ChatConsumer in the worker puts its messages into one queue
+# - and a single background task writes them with bulk_create when a batch is full or the flush interval has passed,
+# - so a burst of messages costs one database round trip per batch instead of one per message
+import asyncio
+import atexit
+import logging
+
+# https://channels.readthedocs.io/en/stable/topics/databases.html#database-sync-to-async
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriteBuffer:
+    """Collect messages from every consumer in the worker and save them to the database in batches.
+
+    The settings are read when the buffer is first used so they can be changed in the tests:
+
+    - ``CHAT_HISTORY_BATCH_SIZE``: the number of messages that triggers a write straight away
+    - ``CHAT_HISTORY_FLUSH_INTERVAL``: the seconds a partial batch waits for more messages before it is written
+    - ``CHAT_HISTORY_MAX_PENDING``: the number of messages that can wait in the buffer before ``put`` blocks
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._queue = None
+        self._task = None
+        # set when enough messages are waiting to fill a batch, to wake the writer before the flush interval ends
+        self._batch_ready = None
+        # the batch that is being collected & hasn't been handed to bulk_create yet
+        self._batch = []
+
+    def _start(self):
+        # the buffer belongs to the event loop that first used it
+        # - Daphne runs a single loop per worker but the tests start a new loop for every test
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._task is not None and not self._task.done():
+            return
+        self.batch_size = getattr(settings, "CHAT_HISTORY_BATCH_SIZE", 100)
+        self.flush_interval = getattr(settings, "CHAT_HISTORY_FLUSH_INTERVAL", 0.05)
+        max_pending = getattr(settings, "CHAT_HISTORY_MAX_PENDING", 5000)
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize=max_pending)
+        self._batch_ready = asyncio.Event()
+        self._task = loop.create_task(self._run())
+
+    async def put(self, message):
+        """Add a message to the buffer.
+
+        When the buffer is full this waits for the writer to make room, which slows down the consumer that is
+        sending instead of letting the buffer grow without bound.
+
+        :param message: The unsaved message.
+        :type message: Message
+        """
+        self._start()
+        await self._queue.put(message)
+        if self._queue.qsize() >= self.batch_size:
+            self._batch_ready.set()
+
+    async def _run(self):
+        queue = self._queue
+        while True:
+            # wait for the first message of a batch
+            self._batch.append(await queue.get())
+
+            # give the batch up to the flush interval to fill unless enough messages are already waiting
+            if queue.qsize() + 1 < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._batch_ready.clear()
+
+            while len(self._batch) < self.batch_size and not queue.empty():
+                self._batch.append(queue.get_nowait())
+
+            batch, self._batch = self._batch, []
+            await self._write(batch)
+            for _ in batch:
+                queue.task_done()
+
+    async def _write(self, batch):
+        try:
+            await database_sync_to_async(Message.objects.bulk_create)(batch)
+        except Exception:
+            # a failed batch is logged & dropped so one bad write doesn't stop the history of every room
+            logger.exception("Failed to save %d chat messages", len(batch))
+
+    async def drain(self):
+        """Wait until every message put in the buffer has been written."""
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def close(self):
+        """Write the remaining messages and stop the background writer."""
+        if self._task is None:
+            return
+        await self.drain()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def flush_sync(self):
+        """Write the messages left in the buffer after the event loop has stopped.
+
+        Registered with atexit so the messages of a worker that is shut down aren't lost.
+        """
+        pending = self._batch
+        self._batch = []
+        try:
+            while self._queue is not None and not self._queue.empty():
+                pending.append(self._queue.get_nowait())
+            if pending:
+                Message.objects.bulk_create(pending)
+        except Exception:
+            logger.exception("Failed to save %d chat messages on shutdown", len(pending))
+
+
+# the buffer shared by every consumer in this worker
+message_buffer = MessageWriteBuffer()
+atexit.register(message_buffer.flush_sync)
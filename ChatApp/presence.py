@@ -0,0 +1,435 @@
+# track the users who are online in each chat room
+# - every room has its own Redis sorted set of usernames scored by the time the user was last seen,
+# - instead of one global set of every online user in the deployment
+# the backend is chosen with the PRESENCE_BACKEND setting, InMemoryPresenceBackend needs no Redis server
+# a user is online while their browser keeps sending heartbeats
+# - a user whose tab crashed stops sending heartbeats & is removed by the sweeper once PRESENCE_TTL has passed
+import asyncio
+import logging
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.functional import LazyObject, empty
+from django.utils.module_loading import import_string
+
+from . import codec
+from .metrics import count_errors
+
+logger = logging.getLogger(__name__)
+
+# the prefix of the sorted set of each room
+ROOM_KEY_PREFIX = "presence:room:"
+# a set of the rooms that have online users, so the sweeper doesn't have to scan the keys of every room
+ROOMS_KEY = "presence:rooms"
+
+
+def room_key(room_name):
+    """Return the Redis key of the sorted set of a room.
+
+    :param room_name: The name of the chat room.
+    :type room_name: str
+    :return: The Redis key.
+    :rtype: str
+    """
+    return f"{ROOM_KEY_PREFIX}{room_name}"
+
+
+def presence_group_name(room_name):
+    """Return the name of the channel layer group of the presence consumers of a room.
+
+    :param room_name: The name of the chat room.
+    :type room_name: str
+    :return: The group name.
+    :rtype: str
+    """
+    return f"{room_name}_online_users"
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class BasePresenceBackend:
+    """The online users of each room, scored by the time they were last seen.
+
+    The settings are read when the backend is used so they can be changed in the tests:
+
+    - ``PRESENCE_TTL``: the seconds after the last heartbeat that a user is shown as offline
+    """
+
+    @property
+    def ttl(self):
+        return getattr(settings, "PRESENCE_TTL", 45)
+
+    async def heartbeat(self, room_name, username, now=None):
+        """Mark a user as seen in a room.
+
+        :param room_name: The name of the chat room.
+        :type room_name: str
+        :param username: The username that is online.
+        :type username: str
+        :param now: The time the user was seen, defaults to the current time.
+        :type now: float or None
+        :return: Whether the user wasn't already online in the room.
+        :rtype: bool
+        """
+        changed = await self.update_many({(room_name, username): True}, now=now)
+        return bool(changed)
+
+    async def leave(self, room_name, username):
+        """Remove a user from a room.
+
+        :param room_name: The name of the chat room.
+        :type room_name: str
+        :param username: The username that went offline.
+        :type username: str
+        :return: Whether the user was online in the room.
+        :rtype: bool
+        """
+        changed = await self.update_many({(room_name, username): False})
+        return bool(changed)
+
+    async def update_many(self, changes, now=None):
+        """Apply many presence changes at once.
+
+        :param changes: Whether each user is online, by (room name, username).
+        :type changes: dict
+        :param now: The time the users were seen, defaults to the current time.
+        :type now: float or None
+        :return: The (room name, username) pairs whose status actually changed.
+        :rtype: list
+        """
+        raise NotImplementedError
+
+    async def online_users(self, room_name, now=None):
+        """Return the usernames that are online in a room.
+
+        Only the entries of the room are read, so the cost doesn't depend on the number of users in other rooms.
+
+        :param room_name: The name of the chat room.
+        :type room_name: str
+        :param now: The current time, defaults to the current time.
+        :type now: float or None
+        :return: The usernames, the most recently seen last.
+        :rtype: list
+        """
+        raise NotImplementedError
+
+    async def statuses(self, room_name, usernames, now=None):
+        """Return whether each of a list of users is online in a room, with one lookup for the whole list.
+
+        :param room_name: The name of the chat room.
+        :type room_name: str
+        :param usernames: The usernames to look up.
+        :type usernames: list
+        :param now: The current time, defaults to the current time.
+        :type now: float or None
+        :return: Whether each user is online, by username.
+        :rtype: dict
+        """
+        raise NotImplementedError
+
+    async def count(self, room_name, now=None):
+        """Return the number of users who are online in a room.
+
+        :param room_name: The name of the chat room.
+        :type room_name: str
+        :param now: The current time, defaults to the current time.
+        :type now: float or None
+        :return: The number of online users.
+        :rtype: int
+        """
+        raise NotImplementedError
+
+    async def sweep(self, now=None):
+        """Remove the users whose last heartbeat is older than the TTL from every room.
+
+        :param now: The current time, defaults to the current time.
+        :type now: float or None
+        :return: The usernames that were removed, by room name.
+        :rtype: dict
+        """
+        raise NotImplementedError
+
+
+class RedisPresenceBackend(BasePresenceBackend):
+    """Store the online users of each room in a Redis sorted set scored by the time they were last seen.
+
+    The backend has its own pool of connections to ``PRESENCE_REDIS_URL`` instead of borrowing the channel layer's,
+    and every update that needs several commands is sent as one pipeline.
+    """
+
+    def __init__(self):
+        # a pool is bound to the event loop it was created on, so keep one client per loop
+        self._clients = {}
+
+    def client(self):
+        """Return the Redis client for the running event loop."""
+        import redis.asyncio
+
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            pool = redis.asyncio.ConnectionPool.from_url(
+                getattr(settings, "PRESENCE_REDIS_URL", "redis://127.0.0.1:6379/0"),
+                max_connections=getattr(settings, "PRESENCE_REDIS_MAX_CONNECTIONS", 50),
+            )
+            client = self._clients[loop] = redis.asyncio.Redis(connection_pool=pool)
+        return client
+
+    async def update_many(self, changes, now=None):
+        if not changes:
+            return []
+        now = time.time() if now is None else now
+        expire = int(self.ttl * 2)
+        items = list(changes.items())
+        # the sorted set update, the score (the time the user was last seen), the expiry of an idle room
+        # - & the set of active rooms are sent in one round trip
+        async with self.client().pipeline(transaction=False) as pipe:
+            for (room_name, username), is_online in items:
+                key = room_key(room_name)
+                if is_online:
+                    pipe.zadd(key, {username: now})
+                    pipe.expire(key, expire)
+                    pipe.sadd(ROOMS_KEY, room_name)
+                else:
+                    pipe.zrem(key, username)
+            results = iter(await pipe.execute())
+
+        # ZADD & ZREM return the number of members they added or removed, the other replies are skipped
+        changed = []
+        for pair, is_online in items:
+            if next(results):
+                changed.append(pair)
+            if is_online:
+                next(results)
+                next(results)
+        return changed
+
+    async def online_users(self, room_name, now=None):
+        now = time.time() if now is None else now
+        members = await self.client().zrangebyscore(room_key(room_name), now - self.ttl, "+inf")
+        return [_decode(member) for member in members]
+
+    async def statuses(self, room_name, usernames, now=None):
+        if not usernames:
+            return {}
+        now = time.time() if now is None else now
+        # ZMSCORE looks up the last seen time of every username with one command
+        scores = await self.client().zmscore(room_key(room_name), list(usernames))
+        cutoff = now - self.ttl
+        return {username: score is not None and score >= cutoff for username, score in zip(usernames, scores)}
+
+    async def count(self, room_name, now=None):
+        now = time.time() if now is None else now
+        return await self.client().zcount(room_key(room_name), now - self.ttl, "+inf")
+
+    async def sweep(self, now=None):
+        now = time.time() if now is None else now
+        cutoff = now - self.ttl
+        redis = self.client()
+        removed = {}
+        for room_name in await redis.smembers(ROOMS_KEY):
+            room_name = _decode(room_name)
+            key = room_key(room_name)
+            # read & remove the stale users in one transaction so a heartbeat can't sneak in between
+            # - each room is swept with one ZREMRANGEBYSCORE instead of removing the users one at a time
+            async with redis.pipeline(transaction=True) as pipe:
+                pipe.zrangebyscore(key, "-inf", f"({cutoff}")
+                pipe.zremrangebyscore(key, "-inf", f"({cutoff}")
+                pipe.zcard(key)
+                stale, _, remaining = await pipe.execute()
+            if stale:
+                removed[room_name] = [_decode(member) for member in stale]
+            if not remaining:
+                await redis.srem(ROOMS_KEY, room_name)
+        return removed
+
+
+class InMemoryPresenceBackend(BasePresenceBackend):
+    """Store the online users of each room in a dictionary of this process.
+
+    Use it for the tests & for running a single worker without a Redis server.
+    """
+
+    def __init__(self):
+        # room name -> {username: the time the user was last seen}
+        self._rooms = {}
+
+    async def update_many(self, changes, now=None):
+        now = time.time() if now is None else now
+        changed = []
+        for (room_name, username), is_online in changes.items():
+            room = self._rooms.setdefault(room_name, {})
+            if is_online:
+                if username not in room:
+                    changed.append((room_name, username))
+                room[username] = now
+            elif room.pop(username, None) is not None:
+                changed.append((room_name, username))
+        return changed
+
+    async def online_users(self, room_name, now=None):
+        now = time.time() if now is None else now
+        room = self._rooms.get(room_name, {})
+        return sorted((u for u, seen in room.items() if seen >= now - self.ttl), key=room.__getitem__)
+
+    async def statuses(self, room_name, usernames, now=None):
+        now = time.time() if now is None else now
+        room = self._rooms.get(room_name, {})
+        return {username: room.get(username, float("-inf")) >= now - self.ttl for username in usernames}
+
+    async def count(self, room_name, now=None):
+        return len(await self.online_users(room_name, now=now))
+
+    async def sweep(self, now=None):
+        now = time.time() if now is None else now
+        cutoff = now - self.ttl
+        removed = {}
+        for room_name, room in list(self._rooms.items()):
+            stale = [username for username, seen in room.items() if seen < cutoff]
+            for username in stale:
+                del room[username]
+            if stale:
+                removed[room_name] = stale
+            if not room:
+                del self._rooms[room_name]
+        return removed
+
+
+class DefaultPresenceStore(LazyObject):
+    """The presence backend chosen by the ``PRESENCE_BACKEND`` setting, created when it's first used."""
+
+    def _setup(self):
+        self._wrapped = import_string(getattr(settings, "PRESENCE_BACKEND", "ChatApp.presence.RedisPresenceBackend"))()
+
+
+# the store shared by the presence consumers, the worker & the sweeper
+presence_store = DefaultPresenceStore()
+
+
+@receiver(setting_changed)
+def _reset_presence_store(setting, **kwargs):
+    # create the backend again when the tests change it
+    if setting in ("PRESENCE_BACKEND", "PRESENCE_REDIS_URL"):
+        presence_store._wrapped = empty
+
+
+class PresenceDiffCoalescer:
+    """Collect the presence changes of each room & broadcast them as one diff frame per window.
+
+    When a big room reconnects after a deploy every member comes online within a few moments. Sending one frame per
+    change to every member would be O(n²) frames, so the changes of a room are collected for
+    ``PRESENCE_BROADCAST_WINDOW`` seconds & sent as a single frame with the joined & left usernames.
+    A user who joins & leaves within the same window isn't sent at all.
+    """
+
+    def __init__(self):
+        # room name -> {username: [online before the window, online now]}
+        self._pending = {}
+        # keep a reference to the flush tasks so they aren't garbage collected
+        self._tasks = set()
+
+    @property
+    def window(self):
+        return getattr(settings, "PRESENCE_BROADCAST_WINDOW", 0.25)
+
+    def add(self, room_name, username, is_online):
+        """Record that a user came online or went offline in a room.
+
+        :param room_name: The name of the chat room.
+        :type room_name: str
+        :param username: The username whose status changed.
+        :type username: str
+        :param is_online: Whether the user is now online.
+        :type is_online: bool
+        """
+        changes = self._pending.get(room_name)
+        if changes is None:
+            changes = self._pending[room_name] = {}
+            # the first change of a room starts its window
+            task = asyncio.ensure_future(self._flush_later(room_name))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        if username in changes:
+            changes[username][1] = is_online
+        else:
+            changes[username] = [not is_online, is_online]
+
+    async def _flush_later(self, room_name):
+        await asyncio.sleep(self.window)
+        try:
+            await self.flush(room_name)
+        except Exception:
+            logger.exception("Failed to broadcast the presence changes of %s", room_name)
+
+    async def flush(self, room_name):
+        """Broadcast the changes collected for a room.
+
+        :param room_name: The name of the chat room.
+        :type room_name: str
+        """
+        changes = self._pending.pop(room_name, {})
+        joined = [username for username, (before, now) in changes.items() if now and not before]
+        left = [username for username, (before, now) in changes.items() if before and not now]
+        if not joined and not left:
+            return
+        # the diff is converted once for every member of the room
+        text_data = codec.dumps({"type": "presence_diff", "joined": joined, "left": left})
+        await count_errors("group_send", get_channel_layer().group_send(
+            presence_group_name(room_name), {"type": "presence.diff", "text": text_data}
+        ))
+
+    async def flush_all(self):
+        """Broadcast the changes collected for every room without waiting for their windows to end."""
+        for room_name in list(self._pending):
+            await self.flush(room_name)
+
+
+# the coalescer shared by the presence consumers & the sweeper of this worker
+presence_diffs = PresenceDiffCoalescer()
+
+
+async def sweep_and_notify(store=None):
+    """Sweep the stale users & tell the presence consumers of each room that they went offline.
+
+    :param store: The presence store to sweep, defaults to the shared store.
+    :type store: BasePresenceBackend or None
+    :return: The usernames that were removed, by room name.
+    :rtype: dict
+    """
+    store = store or presence_store
+    removed = await store.sweep()
+    for room_name, usernames in removed.items():
+        for username in usernames:
+            presence_diffs.add(room_name, username, False)
+    return removed
+
+
+_sweeper = None
+
+
+def start_sweeper():
+    """Start the background task that sweeps stale users every PRESENCE_SWEEP_INTERVAL seconds.
+
+    The task is started once per worker by the first presence consumer. Running it in several workers is safe
+    because a sweep only removes users whose heartbeats have already expired.
+    """
+    global _sweeper
+    if _sweeper is not None and not _sweeper.done() and _sweeper.get_loop() is asyncio.get_running_loop():
+        return
+    _sweeper = asyncio.ensure_future(_sweep_forever())
+
+
+async def _sweep_forever():
+    while True:
+        await asyncio.sleep(getattr(settings, "PRESENCE_SWEEP_INTERVAL", 15))
+        try:
+            await sweep_and_notify()
+        except Exception:
+            # a failed sweep is retried at the next interval
+            logger.exception("Failed to sweep stale presence entries")
@@ -0,0 +1,169 @@
+# flood control for the frames received from the WebSockets
+# - every chat message is sent to every member of its room, so one script sending as fast as it can
+#   would cost the workers of the room members × its send rate
+# - each connection & each room has a token bucket: a frame takes a token & the tokens refill at a steady rate,
+#   so a client can send a short burst but not more than the rate on average
+# a frame that is too big or over the connection's rate is rejected before it is decoded,
+# - & a chat message over the room's rate is rejected before its group_send
+# the buckets are two numbers each in this worker's memory & every check is O(1)
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from . import metrics
+
+
+class TokenBucket:
+    """A bucket of ``burst`` tokens that refills at ``rate`` tokens per second.
+
+    :param rate: The tokens added per second, the average rate allowed.
+    :type rate: float
+    :param burst: The most tokens the bucket holds, the burst allowed after an idle period.
+    :type burst: float
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def take(self, now=None):
+        """Take a token if there is one.
+
+        :param now: The time.monotonic() value of the frame, defaults to the current time.
+        :type now: float or None
+        :return: Whether a token was taken, False if the rate was exceeded.
+        :rtype: bool
+        """
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RoomBuckets:
+    """The token bucket of each room, shared by every consumer of the room in this worker.
+
+    The settings are read when the buckets are first used so they can be changed in the tests:
+
+    - ``CHAT_RATE_LIMIT_ROOM``: the (messages per second, burst) allowed in a room, or None for no limit
+    - ``CHAT_RATE_LIMIT_MAX_ROOMS``: the rooms kept before the least recently used room is dropped,
+      a dropped room starts again with a full bucket
+    """
+
+    def __init__(self):
+        # the rooms in least recently used order, the last room is the most recently used
+        self._buckets = OrderedDict()
+        self._configured = False
+
+    def _configure(self):
+        self.limit = getattr(settings, "CHAT_RATE_LIMIT_ROOM", (50, 100))
+        self.max_rooms = getattr(settings, "CHAT_RATE_LIMIT_MAX_ROOMS", 10000)
+        self._configured = True
+
+    def take(self, room_name, now=None):
+        """Take a token from the bucket of a room.
+
+        :param room_name: The name of the chat room.
+        :type room_name: str
+        :param now: The time.monotonic() value of the message, defaults to the current time.
+        :type now: float or None
+        :return: Whether a token was taken, False if the room is over its rate.
+        :rtype: bool
+        """
+        if not self._configured:
+            self._configure()
+        if self.limit is None:
+            return True
+
+        bucket = self._buckets.get(room_name)
+        if bucket is None:
+            bucket = self._buckets[room_name] = TokenBucket(*self.limit)
+            if len(self._buckets) > self.max_rooms:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(room_name)
+        return bucket.take(now)
+
+    def clear(self):
+        """Drop the bucket of every room."""
+        self._buckets.clear()
+        self._configured = False
+
+
+# the buckets of the rooms shared by every consumer in this worker
+room_buckets = RoomBuckets()
+
+
+@receiver(setting_changed)
+def _reset_room_buckets(setting, **kwargs):
+    # read the limits again when the tests or the load test change them
+    if setting in ("CHAT_RATE_LIMIT_ROOM", "CHAT_RATE_LIMIT_MAX_ROOMS"):
+        room_buckets.clear()
+
+
+class FloodControl:
+    """The limits of one connection.
+
+    The settings are read when the connection is made:
+
+    - ``CHAT_MAX_FRAME_SIZE``: the most characters in a frame received from the WebSocket
+    - ``CHAT_MAX_MESSAGE_LENGTH``: the most characters in a chat message
+    - ``CHAT_RATE_LIMIT_CONNECTION``: the (frames per second, burst) allowed on one connection, or None for no limit
+
+    :param room_name: The name of the chat room of the connection.
+    :type room_name: str
+    """
+
+    # one per connection, so no __dict__
+    __slots__ = ("room_name", "max_frame_size", "max_message_length", "bucket")
+
+    def __init__(self, room_name):
+        self.room_name = room_name
+        self.max_frame_size = getattr(settings, "CHAT_MAX_FRAME_SIZE", 16384)
+        self.max_message_length = getattr(settings, "CHAT_MAX_MESSAGE_LENGTH", 2000)
+        limit = getattr(settings, "CHAT_RATE_LIMIT_CONNECTION", (5, 10))
+        self.bucket = None if limit is None else TokenBucket(*limit)
+
+    def check_frame(self, text_data):
+        """Check a frame before it is decoded.
+
+        :param text_data: The frame received from the WebSocket.
+        :type text_data: str or bytes
+        :return: The limit the frame hit, "frame_size" or "connection", or None if it's allowed.
+        :rtype: str or None
+        """
+        # the length of the str or the bytes is checked, it's known without reading the frame
+        if len(text_data) > self.max_frame_size:
+            return self.hit("frame_size")
+        if self.bucket is not None and not self.bucket.take():
+            return self.hit("connection")
+        return None
+
+    def check_message(self, message):
+        """Check a decoded chat message before it is sent to the room.
+
+        :param message: The text of the chat message.
+        :type message: str
+        :return: The limit the message hit, "message_size" or "room", or None if it's allowed.
+        :rtype: str or None
+        """
+        if not isinstance(message, str) or len(message) > self.max_message_length:
+            return self.hit("message_size")
+        if not room_buckets.take(self.room_name):
+            return self.hit("room")
+        return None
+
+    @staticmethod
+    def hit(limit):
+        metrics.RATE_LIMITED.inc(limit)
+        return limit
@@ -0,0 +1,223 @@
+# an in-memory cache of the latest messages of each chat room
+# - every ChatConsumer in the worker adds the chat.message events it receives from the room group,
+# - and a new member of a room is sent the cached messages straight after accept() without a database query
+# the messages are cached as the JSON strings sent to the WebSocket, so a message is serialized once per worker
+# - instead of once per member of the room
+# a room is only cached while this worker has members in it
+# - the ring is filled by the chat.message events the worker receives, so it misses the messages sent while the
+#   worker had no members & is dropped when the last one leaves instead of being served as the latest messages later
+# the cache is also the retention buffer of the room's sequence numbers
+# - a client that reconnects after the message numbered N is sent the cached messages after N, if the cache has them all
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+# a rough count of the bytes used by a cached message on top of its JSON string (the tuple, the deque slot & the id)
+ENTRY_OVERHEAD = 100
+
+
+class _Room:
+    """The cached messages of one room, oldest first."""
+
+    def __init__(self, size):
+        # (message id, JSON string, sequence number or None)
+        self.frames = deque()
+        self.ids = set()
+        self.size = size
+        self.nbytes = 0
+
+
+class RecentMessageCache:
+    """A ring buffer of the latest messages of each room with a cap on the number of rooms & their total size.
+
+    The settings are read when the cache is first used so they can be changed in the tests:
+
+    - ``RECENT_MESSAGES_PER_ROOM``: the number of messages kept for each room
+    - ``RECENT_MESSAGES_MAX_ROOMS``: the number of rooms kept before the least recently used room is dropped
+    - ``RECENT_MESSAGES_MAX_BYTES``: the approximate memory used by every room before the least recently used
+      rooms are dropped
+    """
+
+    def __init__(self):
+        # the rooms in least recently used order, the last room is the most recently used
+        self._rooms = OrderedDict()
+        # room name -> the members of the room connected to this worker
+        self._members = {}
+        self.nbytes = 0
+        self._configured = False
+
+    def _configure(self):
+        self.per_room = getattr(settings, "RECENT_MESSAGES_PER_ROOM", 50)
+        self.max_rooms = getattr(settings, "RECENT_MESSAGES_MAX_ROOMS", 1000)
+        self.max_bytes = getattr(settings, "RECENT_MESSAGES_MAX_BYTES", 16 * 1024 * 1024)
+        self._configured = True
+
+    def add(self, room_name, message_id, serialize, seq=None):
+        """Cache a message of a room & return its JSON string.
+
+        Every consumer of the room in the worker receives the same message, so only the first call for a message id
+        serializes it and the other calls return the cached string.
+
+        :param room_name: The name of the chat room.
+        :type room_name: str
+        :param message_id: An id that is unique to the message.
+        :type message_id: str
+        :param serialize: A function that returns the JSON string of the message.
+        :type serialize: callable
+        :param seq: The sequence number of the message in its room.
+        :type seq: int or None
+        :return: The JSON string of the message.
+        :rtype: str
+        """
+        if not self._configured:
+            self._configure()
+
+        room = self._rooms.get(room_name)
+        if room is None:
+            room = self._rooms[room_name] = _Room(self.per_room)
+        else:
+            self._rooms.move_to_end(room_name)
+            if message_id in room.ids:
+                # search from the newest message because the copies of a message arrive together
+                for cached_id, frame, _ in reversed(room.frames):
+                    if cached_id == message_id:
+                        return frame
+
+        frame = serialize()
+        size = len(frame) + ENTRY_OVERHEAD
+        room.frames.append((message_id, frame, seq))
+        room.ids.add(message_id)
+        room.nbytes += size
+        self.nbytes += size
+
+        # drop the oldest message of the room when the ring is full
+        if len(room.frames) > room.size:
+            old_id, old_frame, _ = room.frames.popleft()
+            room.ids.discard(old_id)
+            room.nbytes -= len(old_frame) + ENTRY_OVERHEAD
+            self.nbytes -= len(old_frame) + ENTRY_OVERHEAD
+
+        self._evict(keep=room_name)
+        return frame
+
+    def _evict(self, keep):
+        # drop the least recently used rooms until the cache is under its caps, but never the room just used
+        while len(self._rooms) > 1 and (len(self._rooms) > self.max_rooms or self.nbytes > self.max_bytes):
+            room_name = next(iter(self._rooms))
+            if room_name == keep:
+                break
+            self.nbytes -= self._rooms.pop(room_name).nbytes
+
+    def join(self, room_name):
+        """Count a member of a room connected to this worker.
+
+        :param room_name: The name of the chat room.
+        :type room_name: str
+        """
+        self._members[room_name] = self._members.get(room_name, 0) + 1
+
+    def leave(self, room_name):
+        """Stop counting a member of a room, the room is dropped from the cache when its last member leaves.
+
+        :param room_name: The name of the chat room.
+        :type room_name: str
+        """
+        count = self._members.get(room_name, 0) - 1
+        if count > 0:
+            self._members[room_name] = count
+            return
+        self._members.pop(room_name, None)
+        room = self._rooms.pop(room_name, None)
+        if room is not None:
+            self.nbytes -= room.nbytes
+
+    def frames(self, room_name):
+        """Return the cached JSON strings of a room, oldest first.
+
+        :param room_name: The name of the chat room.
+        :type room_name: str
+        :return: The cached messages, or an empty list if the room isn't cached.
+        :rtype: list
+        """
+        if not self._configured:
+            self._configure()
+
+        room = self._rooms.get(room_name)
+        if room is None:
+            return []
+        self._rooms.move_to_end(room_name)
+        return [frame for _, frame, _ in room.frames]
+
+    def frames_since(self, room_name, seq, current=None):
+        """Return the cached JSON strings of a room's messages numbered after ``seq``, oldest first.
+
+        :param room_name: The name of the chat room.
+        :type room_name: str
+        :param seq: The sequence number of the last message the client saw.
+        :type seq: int
+        :param current: The last sequence number given out in the room, the cache must have the messages up to it.
+        :type current: int or None
+        :return: The messages, or None if the cache doesn't have every message since ``seq``.
+        :rtype: list or None
+        """
+        if not self._configured:
+            self._configure()
+
+        room = self._rooms.get(room_name)
+        if room is None:
+            return None
+        numbered = [(frame_seq, frame) for _, frame, frame_seq in room.frames if frame_seq is not None]
+        if not numbered:
+            return None
+        # the workers of a room may receive messages in a slightly different order than they were numbered
+        numbered.sort(key=lambda item: item[0])
+        first, last = numbered[0][0], numbered[-1][0]
+        # the messages just after seq were dropped from the ring, or the client saw numbers this room never reached
+        if first > seq + 1 or seq > last:
+            return None
+        # the newest messages of the room haven't reached the ring
+        if current is not None and last < current:
+            return None
+        missed = [(frame_seq, frame) for frame_seq, frame in numbered if frame_seq > seq]
+        # a message in the middle is missing, e.g. it was sent while this worker had no members in the room
+        if missed and missed[-1][0] - missed[0][0] + 1 != len(missed):
+            return None
+        self._rooms.move_to_end(room_name)
+        return [frame for _, frame in missed]
+
+    def clear(self):
+        """Drop every cached room."""
+        self._rooms.clear()
+        self._members.clear()
+        self.nbytes = 0
+        self._configured = False
+
+
+# the cache shared by every consumer in this worker
+recent_messages = RecentMessageCache()
+
+
+def history_frame(frames, has_more):
+    """Join cached JSON strings into a history frame without serializing the messages again.
+
+    :param frames: The JSON strings of the messages, oldest first.
+    :type frames: list
+    :param has_more: Whether there are older messages in the database.
+    :type has_more: bool
+    :return: The JSON string of the history frame.
+    :rtype: str
+    """
+    return '{"type": "history", "messages": [%s], "has_more": %s}' % (",".join(frames), "true" if has_more else "false")
+
+
+def catchup_frame(frames, since):
+    """Join cached JSON strings into the frame of the messages a reconnecting client missed.
+
+    :param frames: The JSON strings of the messages, oldest first.
+    :type frames: list
+    :param since: The sequence number of the last message the client saw.
+    :type since: int
+    :return: The JSON string of the catch-up frame.
+    :rtype: str
+    """
+    return '{"type": "catchup", "since": %d, "messages": [%s]}' % (since, ",".join(frames))
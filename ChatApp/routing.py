@@ -8,7 +8,12 @@ from . import consumers
 # Note: use re_path() due to limitations in URLRouter https://channels.readthedocs.io/en/latest/topics/routing.html#urlrouter
 # verify that the consumer for the /ws/chat/ROOM_NAME/ path works by running migrations to apply database changes
 # - (Django’s session framework needs the database). then start the Channels development server
+# the /ws/room/ROOM_NAME/ path carries both the chat & the presence of a room over one socket
+# - the /ws/ChatApp/ & /ws/presence/ paths are kept for clients that open a socket for each
+# the /ws/rooms/ path pushes the member counts of the active rooms
 websocket_urlpatterns = [
     re_path(r"ws/ChatApp/(?P<room_name>\w+)/$", consumers.ChatConsumer.as_asgi()),
     re_path(r"ws/presence/(?P<room_name>\w+)/$", consumers.PresenceConsumer.as_asgi()),
+    re_path(r"ws/room/(?P<room_name>\w+)/$", consumers.MultiplexConsumer.as_asgi()),
+    re_path(r"ws/rooms/$", consumers.RoomDirectoryConsumer.as_asgi()),
     ]
\ No newline at end of file
@@ -0,0 +1,122 @@
+# full-text search of the history of a chat room
+# - the words of every message are in the chatapp_message_fts index (migration 0003), kept up to date by triggers
+#   as the write-behind buffer inserts the messages, so a search reads the index instead of scanning the room
+# - the room & the author are indexed columns too, so the index only returns the messages of the room
+# the results are newest first & paginated with the id of the last result as the cursor, like the history
+# - e.g. /ChatApp/lobby/search/?q=deploy&username=alice&since=2024-07-01T00:00:00Z&before=1200&limit=20
+import re
+
+from django.db import connection
+
+from .history import clamp_limit, serialize_message
+from .models import Message
+
+# the words of a search, the other characters are ignored like the index's tokenizer ignores them
+WORD = re.compile(r"\w+")
+
+
+def _phrase(text):
+    # a quoted FTS5 string, the words in it are matched as a phrase & the operators in it are plain text
+    return '"%s"' % text.replace('"', '""')
+
+
+def match_expression(query, room_name, username=None):
+    """Build the FTS5 MATCH expression of a search.
+
+    Every word of the query must be in the message, the last word also matches the words it starts,
+    so a search for "dep" finds "deploy".
+
+    :param query: The words to search for.
+    :type query: str
+    :param room_name: The name of the chat room.
+    :type room_name: str
+    :param username: Only match the messages of this author.
+    :type username: str or None
+    :return: The expression, or None if the query has no words.
+    :rtype: str or None
+    """
+    words = WORD.findall(query)
+    if not words:
+        return None
+    terms = [_phrase(word) for word in words]
+    terms[-1] += "*"
+    # ^ anchors the room & the author to the start of their column, the exact match is checked on the table
+    expression = f"room_name : ^ {_phrase(room_name)} AND content : ({' AND '.join(terms)})"
+    if username:
+        expression += f" AND username : ^ {_phrase(username)}"
+    return expression
+
+
+def search_messages(room_name, query, username=None, since=None, until=None, before=None, limit=None):
+    """Return a page of the messages of a chat room that contain every word of a query, newest first.
+
+    :param room_name: The name of the chat room.
+    :type room_name: str
+    :param query: The words to search for.
+    :type query: str
+    :param username: Only return the messages of this author.
+    :type username: str or None
+    :param since: Only return the messages sent at or after this time.
+    :type since: datetime or None
+    :param until: Only return the messages sent before this time.
+    :type until: datetime or None
+    :param before: Only return the messages with an id lower than this one, the cursor of the next page.
+    :type before: int or None
+    :param limit: The maximum number of messages to return.
+    :type limit: int or None
+    :return: The messages and whether there are more older messages that match.
+    :rtype: dict
+    """
+    limit = clamp_limit(limit)
+    expression = match_expression(query, room_name, username)
+    if expression is None:
+        return {"messages": [], "has_more": False}
+
+    if connection.vendor == "sqlite":
+        rows = list(_search_index(expression, room_name, username, since, until, before, limit + 1))
+    else:
+        rows = list(_search_table(query, room_name, username, since, until, before)[: limit + 1])
+    # fetch one extra row to know if there is another page without running a COUNT query
+    has_more = len(rows) > limit
+    return {"messages": [serialize_message(row) for row in rows[:limit]], "has_more": has_more}
+
+
+def _search_index(expression, room_name, username, since, until, before, limit):
+    conditions = ["chatapp_message_fts MATCH %s", "m.room_name = %s"]
+    params = [expression, room_name]
+    if username:
+        conditions.append("m.username = %s")
+        params.append(username)
+    if since is not None:
+        conditions.append("m.created_at >= %s")
+        params.append(connection.ops.adapt_datetimefield_value(since))
+    if until is not None:
+        conditions.append("m.created_at < %s")
+        params.append(connection.ops.adapt_datetimefield_value(until))
+    if before is not None:
+        # the cursor is applied to the rowid of the index, so the index starts reading at the cursor
+        conditions.append("f.rowid < %s")
+        params.append(before)
+    params.append(limit)
+    # the index is read newest first & stops after the limit, so the cost follows the page, not the room
+    return Message.objects.raw(
+        f"SELECT m.* FROM chatapp_message_fts f JOIN {Message._meta.db_table} m ON m.id = f.rowid "
+        f"WHERE {' AND '.join(conditions)} ORDER BY f.rowid DESC LIMIT %s",
+        params,
+    )
+
+
+def _search_table(query, room_name, username, since, until, before):
+    # without FTS5 each word is a substring search of the room's messages
+    queryset = Message.objects.filter(room_name=room_name)
+    for word in WORD.findall(query):
+        queryset = queryset.filter(content__icontains=word)
+    if username:
+        queryset = queryset.filter(username=username)
+    if since is not None:
+        queryset = queryset.filter(created_at__gte=since)
+    if until is not None:
+        queryset = queryset.filter(created_at__lt=until)
+    if before is not None:
+        queryset = queryset.filter(id__lt=before)
+    return queryset.order_by("-id")
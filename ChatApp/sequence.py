@@ -0,0 +1,140 @@
+# number the messages of each chat room
+# - every message broadcast to a room is stamped with the next number of the room, 1, 2, 3...
+# - so a client that reconnects can say which message it saw last & be sent only the ones it missed
+# the backend is chosen with the CHAT_SEQUENCE_BACKEND setting
+# - RedisRoomSequence counts with INCR so every worker of the deployment shares the same numbers
+# - LocalRoomSequence counts in this process, for the tests & for running a single worker without Redis
+import asyncio
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.functional import LazyObject, empty
+from django.utils.module_loading import import_string
+
+from .history import get_last_seq_async
+
+# the prefix of the counter of each room
+SEQ_KEY_PREFIX = "chat:seq:"
+# INCR a counter only if it exists, so a missing counter is never counted from 1 over the numbers already saved
+INCR_EXISTING_SCRIPT = """
+if redis.call("EXISTS", KEYS[1]) == 1 then
+    return redis.call("INCR", KEYS[1])
+end
+return false
+"""
+
+
+class LocalRoomSequence:
+    """Count the messages of each room in a dictionary of this process.
+
+    A room starts counting after the highest number saved in the database, so the numbers keep going up when the
+    worker restarts.
+    """
+
+    def __init__(self):
+        # room name -> the last number given out
+        self._counters = {}
+        # room name -> the task reading the last saved number of the room
+        self._loading = {}
+
+    async def _load(self, room_name):
+        if room_name not in self._counters:
+            # read the database once, the messages received in the meantime wait for the same read
+            loading = self._loading.get(room_name)
+            if loading is None:
+                loading = self._loading[room_name] = asyncio.ensure_future(get_last_seq_async(room_name))
+            try:
+                last = await loading
+            finally:
+                self._loading.pop(room_name, None)
+            self._counters.setdefault(room_name, last)
+
+    async def next(self, room_name):
+        """Return the next sequence number of a room.
+
+        :param room_name: The name of the chat room.
+        :type room_name: str
+        :return: The sequence number.
+        :rtype: int
+        """
+        await self._load(room_name)
+        self._counters[room_name] += 1
+        return self._counters[room_name]
+
+    async def current(self, room_name):
+        """Return the last sequence number given out in a room, 0 if it has no numbered messages.
+
+        :param room_name: The name of the chat room.
+        :type room_name: str
+        :return: The sequence number.
+        :rtype: int
+        """
+        await self._load(room_name)
+        return self._counters[room_name]
+
+
+class RedisRoomSequence:
+    """Count the messages of each room with Redis INCR.
+
+    The counter has its own pool of connections to ``CHAT_SEQUENCE_REDIS_URL``.
+    A room whose counter is missing, e.g. after Redis was flushed, starts after the highest number in the database.
+    """
+
+    def __init__(self):
+        # a pool is bound to the event loop it was created on, so keep one client per loop
+        self._clients = {}
+        # the client -> its INCR_EXISTING_SCRIPT
+        self._incr_existing = {}
+
+    def client(self):
+        """Return the Redis client for the running event loop."""
+        import redis.asyncio
+
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            pool = redis.asyncio.ConnectionPool.from_url(
+                getattr(settings, "CHAT_SEQUENCE_REDIS_URL", "redis://127.0.0.1:6379/0")
+            )
+            client = self._clients[loop] = redis.asyncio.Redis(connection_pool=pool)
+        return client
+
+    async def next(self, room_name):
+        key = f"{SEQ_KEY_PREFIX}{room_name}"
+        redis = self.client()
+        incr_existing = self._incr_existing.get(redis)
+        if incr_existing is None:
+            incr_existing = self._incr_existing[redis] = redis.register_script(INCR_EXISTING_SCRIPT)
+        seq = await incr_existing(keys=[key])
+        if seq is None:
+            # a new counter starts after the messages already saved
+            # - the workers that find it missing at the same time all try to seed it, only the first SET NX does
+            #   & every INCR counts from there
+            await redis.set(key, await get_last_seq_async(room_name), nx=True)
+            seq = await redis.incr(key)
+        return int(seq)
+
+    async def current(self, room_name):
+        seq = await self.client().get(f"{SEQ_KEY_PREFIX}{room_name}")
+        if seq is None:
+            return await get_last_seq_async(room_name)
+        return int(seq)
+
+
+class DefaultRoomSequence(LazyObject):
+    """The sequence backend chosen by the ``CHAT_SEQUENCE_BACKEND`` setting, created when it's first used."""
+
+    def _setup(self):
+        self._wrapped = import_string(getattr(settings, "CHAT_SEQUENCE_BACKEND", "ChatApp.sequence.RedisRoomSequence"))()
+
+
+# the sequence numbers shared by the chat consumers
+room_sequences = DefaultRoomSequence()
+
+
+@receiver(setting_changed)
+def _reset_room_sequences(setting, **kwargs):
+    # create the backend again when the tests change it
+    if setting in ("CHAT_SEQUENCE_BACKEND", "CHAT_SEQUENCE_REDIS_URL"):
+        room_sequences._wrapped = empty
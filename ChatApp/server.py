@@ -0,0 +1,127 @@
+# a Daphne worker of `python manage.py serve`, see ChatApp/management/commands/serve.py
+# - importing daphne.server installs Twisted's asyncio reactor & its event loop, which can't be shared by forked
+#   processes, so this module is only imported by a worker after the fork
+# on SIGTERM or SIGINT the worker drains instead of dropping its connections:
+# - it stops accepting, so the new connections go to the other workers sharing the socket
+# - it tells each client to reconnect after a random delay of up to CHAT_DRAIN_JITTER seconds & closes it
+# - it waits up to CHAT_DRAIN_TIMEOUT seconds for the requests & the consumers to finish, writes the chat messages
+#   still in the write-behind buffer & stops
+import asyncio
+import logging
+import signal
+import time
+
+from daphne.server import Server
+from django.conf import settings
+from twisted.internet import reactor
+
+from .directory import room_counts
+from .liveness import drain_connections, idle_reaper
+from .persistence import message_buffer
+from .presence import presence_diffs
+from .sharding import shard_map
+
+logger = logging.getLogger(__name__)
+
+
+class DrainingServer(Server):
+    """A Daphne server that drains its connections when it's asked to stop.
+
+    :param application: The ASGI application.
+    :type application: callable
+    :param endpoints: The Twisted endpoint descriptions to listen on, e.g. "fd:fileno=3:domain=INET".
+    :type endpoints: list
+    """
+
+    def __init__(self, application, endpoints, **kwargs):
+        # the signals are handled by drain() instead of stopping the reactor straight away
+        super().__init__(application, endpoints=endpoints, signal_handlers=False, **kwargs)
+        # the listening ports, closed when the worker drains
+        self.ports = []
+        self.draining = False
+        self.listen_failed = False
+
+    def listen_success(self, port):
+        self.ports.append(port)
+        super().listen_success(port)
+
+    def listen_error(self, failure):
+        self.listen_failed = True
+        super().listen_error(failure)
+
+    def run(self):
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._on_signal)
+        # listen for new shards from the start, not only once the worker has members in a room
+        reactor.callWhenRunning(shard_map.start)
+        super().run()
+
+    def _on_signal(self, signum, frame):
+        # a signal handler mustn't touch the event loop directly
+        reactor.callFromThread(self.drain)
+
+    def drain(self):
+        """Stop accepting, close the connections gracefully & stop the worker."""
+        if self.draining:
+            return
+        self.draining = True
+        asyncio.ensure_future(self._drain())
+
+    def busy(self):
+        """Return whether a request or a WebSocket of this worker is still being handled."""
+        if idle_reaper.connections:
+            return True
+        # an idle keep-alive connection has no application running, it doesn't hold the worker up
+        return any(
+            "application_instance" in details and not details["application_instance"].done()
+            for details in self.connections.values()
+        )
+
+    async def _drain(self):
+        started = time.monotonic()
+        try:
+            for port in self.ports:
+                port.stopListening()
+            timeout = getattr(settings, "CHAT_DRAIN_TIMEOUT", 10)
+            closed = 0
+            while self.busy() and time.monotonic() - started < timeout:
+                # a socket whose handshake was under way when the ports closed is closed on the next round
+                closed += await drain_connections()
+                await asyncio.sleep(0.1)
+            # broadcast & write what the consumers left behind
+            await presence_diffs.flush_all()
+            await room_counts.flush()
+            await message_buffer.close()
+            logger.info("Drained %d connections in %.1fs", closed, time.monotonic() - started)
+        except Exception:
+            logger.exception("Failed to drain the worker")
+        finally:
+            self.stop()
+
+
+def run_worker(sock, application, proxy_headers=False):
+    """Serve an ASGI application on a listening socket until the worker has drained.
+
+    :param sock: The listening socket shared with the other workers.
+    :type sock: socket.socket
+    :param application: The ASGI application.
+    :type application: callable
+    :param proxy_headers: Whether to take the client's address from the X-Forwarded-* headers of a proxy.
+    :type proxy_headers: bool
+    """
+    # Twisted adopts the socket as an IPv4 socket & closes the descriptor it was given, so the socket object lets go of it
+    fileno = sock.detach()
+    server = DrainingServer(
+        application,
+        endpoints=[f"fd:fileno={fileno}"],
+        proxy_forwarded_address_header="X-Forwarded-For" if proxy_headers else None,
+        proxy_forwarded_port_header="X-Forwarded-Port" if proxy_headers else None,
+        proxy_forwarded_proto_header="X-Forwarded-Proto" if proxy_headers else None,
+        verbosity=0,
+    )
+    server.run()
+    if server.listen_failed:
+        # the master waits a moment before it replaces a worker that failed
+        raise RuntimeError("The worker couldn't listen on the socket")
+    # the messages left in the buffer if the event loop stopped before it was written
+    message_buffer.flush_sync()
@@ -0,0 +1,229 @@
+# room-to-worker affinity for a deployment with several Daphne processes
+# - without it any process may have members of any room, so a message is published to every process with members
+# - with CHAT_SHARDS set every room belongs to one shard, picked by consistent hashing of its group name,
+#   & a client that connects to another shard is sent where its room lives, so the members of a room share a process
+#   & a broadcast is delivered in memory by HybridChannelLayer
+# the clients & a front proxy ask /ChatApp/<room_name>/shard/ which shard to connect to
+# - a consumer on the wrong shard sends {"type": "redirect", "shard": ..., "url": ...} & closes with SHARD_MOVED_CLOSE_CODE
+# when a shard joins or leaves, `python manage.py reshard` sends the new shards to every process
+# - every process listens for them from its start, see ShardMap.start()
+# - each process redirects the members of the rooms that moved, only ~1/N of the rooms move with N shards
+import asyncio
+import bisect
+import hashlib
+import logging
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .presence import presence_group_name
+
+logger = logging.getLogger(__name__)
+
+# the close code of a connection whose room lives on another shard, the client reconnects to the shard it was sent
+SHARD_MOVED_CLOSE_CODE = 4010
+# the group with one member per process that receives the new shards from `python manage.py reshard`
+SHARDS_GROUP = "chat_shards"
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode(), usedforsecurity=False).digest()[:8], "big")
+
+
+class HashRing:
+    """A consistent hash ring of shard names.
+
+    Each shard has ``replicas`` points on the ring & a key belongs to the shard of the first point after its hash, so
+    adding or removing a shard only moves the keys between its points & the points before them.
+
+    :param shards: The names of the shards.
+    :type shards: Iterable
+    :param replicas: The points of each shard, more points spread the keys more evenly.
+    :type replicas: int
+    """
+
+    def __init__(self, shards=(), replicas=100):
+        self.replicas = replicas
+        # the sorted hashes of the points & the shard of each point
+        self._hashes = []
+        self._shards = []
+        for shard in shards:
+            self.add(shard)
+
+    def __len__(self):
+        return len(set(self._shards))
+
+    def add(self, shard):
+        for replica in range(self.replicas):
+            point = _hash(f"{shard}#{replica}")
+            index = bisect.bisect(self._hashes, point)
+            self._hashes.insert(index, point)
+            self._shards.insert(index, shard)
+
+    def remove(self, shard):
+        points = [(point, name) for point, name in zip(self._hashes, self._shards) if name != shard]
+        self._hashes = [point for point, _ in points]
+        self._shards = [name for _, name in points]
+
+    def get(self, key):
+        """Return the shard of a key.
+
+        :param key: The key, e.g. the group name of a room.
+        :type key: str
+        :return: The name of the shard, or None if the ring is empty.
+        :rtype: str or None
+        """
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._shards[index]
+
+
+class ShardMap:
+    """The shard of each room & the rooms with members in this process.
+
+    The settings are read when the map is first used so they can be changed in the tests:
+
+    - ``CHAT_SHARDS``: the WebSocket base URL of each shard by name, e.g. {"a": "ws://10.0.0.1:8001"},
+      or None to let every process host every room
+    - ``CHAT_SHARD_NAME``: the name of this process's shard in CHAT_SHARDS
+    - ``CHAT_SHARD_REPLICAS``: the points of each shard on the hash ring
+    """
+
+    def __init__(self):
+        # room name -> the consumers in the room in this process
+        self.rooms = {}
+        self._listener = None
+        self._configured = False
+
+    def _configure(self):
+        self.name = getattr(settings, "CHAT_SHARD_NAME", None)
+        self.replicas = getattr(settings, "CHAT_SHARD_REPLICAS", 100)
+        self.set_shards(getattr(settings, "CHAT_SHARDS", None))
+        self._configured = True
+
+    def set_shards(self, shards):
+        self.shards = dict(shards) if shards else None
+        self.ring = HashRing(self.shards or (), self.replicas)
+
+    @property
+    def enabled(self):
+        if not self._configured:
+            self._configure()
+        return self.shards is not None
+
+    def shard_for(self, room_name):
+        """Return the shard a room lives on.
+
+        :param room_name: The name of the chat room.
+        :type room_name: str
+        :return: The {"shard": name, "url": WebSocket base URL}, or None when sharding is off.
+        :rtype: dict or None
+        """
+        if not self.enabled:
+            return None
+        # the room's chat & presence groups live together, so hash the chat group name
+        shard = self.ring.get(f"chat_{room_name}")
+        return {"shard": shard, "url": self.shards[shard]}
+
+    def redirect_for(self, room_name):
+        """Return the shard a client should be sent to, or None if the room lives on this process's shard."""
+        shard = self.shard_for(room_name)
+        if shard is None or shard["shard"] == self.name:
+            return None
+        return shard
+
+    def join(self, room_name):
+        """Count a consumer in a room of this process."""
+        self.rooms[room_name] = self.rooms.get(room_name, 0) + 1
+
+    def start(self):
+        """Listen for the shards sent by `python manage.py reshard` on the running event loop.
+
+        Every process listens from its start, with or without CHAT_SHARDS & with or without members, so a reshard
+        that turns sharding on or changes the shards reaches the processes that didn't host any room yet.
+        """
+        loop = asyncio.get_running_loop()
+        if self._listener is None or self._listener.done() or self._listener.get_loop() is not loop:
+            self._listener = asyncio.ensure_future(self._listen())
+
+    def leave(self, room_name):
+        count = self.rooms.get(room_name, 0) - 1
+        if count > 0:
+            self.rooms[room_name] = count
+        else:
+            self.rooms.pop(room_name, None)
+
+    async def update(self, shards):
+        """Use new shards & redirect the members of this process's rooms that moved to another shard.
+
+        :param shards: The WebSocket base URL of each shard by name, or None to turn sharding off.
+        :type shards: dict or None
+        :return: The names of the rooms that moved.
+        :rtype: list
+        """
+        if not self._configured:
+            self._configure()
+        self.set_shards(shards)
+        moved = [room_name for room_name in list(self.rooms) if self.redirect_for(room_name) is not None]
+        channel_layer = get_channel_layer()
+        for room_name in moved:
+            # the consumers check the room against their own map, the members in other processes may still belong there
+            for group in (f"chat_{room_name}", presence_group_name(room_name)):
+                await channel_layer.group_send(group, {"type": "shard.moved", "room_name": room_name})
+        if moved:
+            logger.info("%d rooms moved to other shards", len(moved))
+        return moved
+
+    async def _listen(self):
+        channel_layer = get_channel_layer()
+        channel = await channel_layer.new_channel()
+        await channel_layer.group_add(SHARDS_GROUP, channel)
+        while True:
+            try:
+                message = await channel_layer.receive(channel)
+                if message.get("type") == "shards.update":
+                    await self.update(message["shards"])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Failed to apply the new shards")
+                await asyncio.sleep(1)
+
+    def clear(self):
+        """Forget the settings & the rooms, used by the tests."""
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+        self.rooms.clear()
+        self._configured = False
+
+
+# the shards seen by this process
+shard_map = ShardMap()
+
+
+class ShardListenerMiddleware:
+    """Start the process's listener for new shards with its first ASGI call, whatever its type.
+
+    ``python manage.py serve`` starts the listener when a worker starts, this covers the other servers, e.g. runserver.
+
+    :param application: The ASGI application to wrap.
+    :type application: callable
+    """
+
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        shard_map.start()
+        return await self.application(scope, receive, send)
+
+
+@receiver(setting_changed)
+def _reset_shard_map(setting, **kwargs):
+    # read the shards again when the tests change them
+    if setting in ("CHAT_SHARDS", "CHAT_SHARD_NAME", "CHAT_SHARD_REPLICAS"):
+        shard_map.clear()
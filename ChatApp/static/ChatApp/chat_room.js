@@ -0,0 +1,267 @@
+const roomName = JSON.parse(document.getElementById('room-name').textContent);
+
+// fetch username from localStorage because it will be used to store sent messages
+// check for successful retrieval of username
+const username = localStorage.getItem('username');
+if (!username) {
+    alert('Username was not found in localStorage');
+}        
+
+// the sequence number of the last message displayed, sent when reconnecting to be sent only the messages missed
+let lastSeq = null;
+// the milliseconds to wait before reconnecting, doubled after every failed attempt
+let reconnectDelay = 1000;
+// the milliseconds to wait before reconnecting when the server is shutting down, picked by the server so the
+// - clients of a worker don't all reconnect at once
+let drainDelay = 0;
+let roomSocket;
+// the WebSocket base URL of the shard that hosts the room, e.g. ws://10.0.0.2:8001
+let shardUrl = null;
+
+// ask which shard hosts the room, the url is null when the rooms aren't sharded
+async function findShard() {
+    try {
+        const response = await fetch('/ChatApp/' + encodeURIComponent(roomName) + '/shard/');
+        const shard = await response.json();
+        if (shard.url) {
+            return shard.url;
+        }
+    } catch (error) {
+        console.error(error);
+    }
+    return 'ws://' + window.location.host;
+}
+
+// one websocket carries both the chat & the presence of the room
+// - every frame is wrapped in an envelope that names its stream, e.g. {"stream": "chat", "payload": {...}}
+// - batch=25 asks the server to collect the messages of a busy room for up to 25 ms & send them in one frame
+async function connect() {
+    if (shardUrl === null) {
+        shardUrl = await findShard();
+    }
+    roomSocket = new WebSocket(
+        shardUrl
+        + '/ws/room/'
+        + roomName
+        + '/?username='
+        + encodeURIComponent(username)
+        + '&batch=25'
+        + (lastSeq === null ? '' : '&since=' + lastSeq),
+        // ask for the big frames, e.g. the history, to be compressed, the small frames stay JSON text
+        ['chat.json.deflate', 'chat.json']
+    );
+    roomSocket.onopen = onOpen;
+    roomSocket.onmessage = onMessage;
+    roomSocket.onclose = onClose;
+}
+
+// create a function to send a frame to one of the streams of the room socket
+function sendFrame(stream, payload) {
+    roomSocket.send(JSON.stringify({'stream': stream, 'payload': payload}));
+}
+
+// create a function to append a message to the chat log
+function displayMessage(message) {
+    const chatLog = document.querySelector('#chat-log');
+    const timestamp = new Date(message.timestamp).toLocaleString();
+    chatLog.value += (message.username + '\n' + timestamp + ' ' + message.message + '\n\n');
+    if (message.seq !== undefined && message.seq !== null && (lastSeq === null || message.seq > lastSeq)) {
+        lastSeq = message.seq;
+    }
+}
+
+// create a function to display the latest messages of the room
+// - the server sends them as a history frame as soon as the socket is accepted,
+// - so only the last page is fetched instead of replaying every message the browser has ever received
+// - it replaces the log, e.g. after a reconnect that missed more messages than the server keeps
+function displayHistory(messages) {
+    document.querySelector('#chat-log').value = '';
+    lastSeq = null;
+    messages.forEach(displayMessage);
+}
+
+// Function to add a user to the user list
+function addUser(user) {
+    const li = document.createElement('li');
+    li.className = 'list-group-item border-0 py-1 px-0';
+    li.innerHTML = `
+        <div class="d-flex align-items-center">
+            <div class="me-2" id="${user}_status" style="color: green;">●</div>
+            <div>${user} <small id="${user}_small" class="text-muted">Online</small></div>
+        </div>
+    `;
+    document.getElementById('user-list').appendChild(li);
+}
+
+// Function to update user list
+function updateUserList(users) {
+    document.getElementById('user-list').innerHTML = '';
+    users.forEach(addUser);
+}
+
+// handle a frame of the chat stream
+function handleChatFrame(data) {
+    if (data.type === 'history') {
+        displayHistory(data.messages);
+    } else if (data.type === 'batch' || data.type === 'catchup') {
+        // a catch-up frame has the messages sent while the browser was reconnecting
+        data.messages.forEach(displayMessage);
+    } else if (data.type === 'user_list') {
+        // Update the online user list UI
+        updateUserList(data.users);
+    } else if (data.type === undefined) {
+        displayMessage(data);
+    }
+
+    // Auto-scroll to bottom
+    const chatLog = document.querySelector('#chat-log');
+    chatLog.scrollTop = chatLog.scrollHeight;
+}
+
+// create a function to read a frame, a binary frame is JSON text compressed with deflate
+async function readFrame(data) {
+    if (typeof data === 'string') {
+        return JSON.parse(data);
+    }
+    const text = await new Response(data.stream().pipeThrough(new DecompressionStream('deflate'))).text();
+    return JSON.parse(text);
+}
+
+// handle the frames in the order they arrived even though a compressed frame takes a while to read
+let frames = Promise.resolve();
+function onMessage(e) {
+    frames = frames.then(() => readFrame(e.data)).then(handleEnvelope).catch(console.error);
+}
+
+// pass each frame to the handler of its stream
+function handleEnvelope(envelope) {
+    if (envelope.type === 'ping') {
+        // the server checks the socket is still alive when the tab was quiet for a while
+        roomSocket.send('{"type": "pong"}');
+    } else if (envelope.type === 'redirect') {
+        // the room lives on another shard, the socket is closed with 4010 & reconnects there
+        shardUrl = envelope.url;
+    } else if (envelope.type === 'reconnect') {
+        // the server is shutting down, the socket is closed with 4012 & reconnects to another server
+        drainDelay = envelope.retry_after;
+    } else if (envelope.type === 'resync') {
+        // the browser fell behind & the server dropped the frames it missed, so fetch the room again
+        document.querySelector('#chat-log').value = '';
+        sendFrame('chat', {'type': 'history'});
+        sendFrame('presence', {'type': 'snapshot'});
+    } else if (envelope.stream === 'chat') {
+        handleChatFrame(envelope.payload);
+    } else if (envelope.stream === 'presence') {
+        handlePresenceFrame(envelope.payload);
+    }
+}
+
+function onClose(e) {
+    if (e.code === 4010) {
+        // sent to the shard of the room, connect to it straight away
+        connect();
+        return;
+    } else if (e.code === 4012) {
+        // the server went away on purpose, catch up from the last message displayed once the delay is over
+        setTimeout(connect, drainDelay);
+        return;
+    } else if (e.code === 4011) {
+        console.error('Room socket closed because the browser stopped answering');
+    } else if (e.code === 4008) {
+        console.error('Room socket closed because the browser fell too far behind');
+    } else {
+        console.error('Room socket closed unexpectedly');
+    }
+    // reconnect & catch up from the last message displayed
+    setTimeout(connect, reconnectDelay);
+    reconnectDelay = Math.min(reconnectDelay * 2, 30000);
+}
+
+document.querySelector('#chat-message-input').focus();
+document.querySelector('#chat-message-input').onkeyup = function(e) {
+    if (e.key === 'Enter') {  // enter, return
+        document.querySelector('#chat-message-submit').click();
+    }
+};
+
+document.querySelector('#chat-message-submit').onclick = function(e) {
+    const messageInputDom = document.querySelector('#chat-message-input');
+    const message = messageInputDom.value;
+    if (message.trim() === '') return;  // Don't send empty messages
+
+    const timestamp = new Date().toLocaleString();            
+    sendFrame('chat', {
+        'message': message,
+        'timestamp': timestamp,
+        'username': username
+    });
+
+    messageInputDom.value = '';
+};        
+
+// Define loggedin_user variable
+const loggedin_user = username;
+
+// the seconds between heartbeats, the server shows the user as offline when the heartbeats stop
+const heartbeatInterval = JSON.parse(document.getElementById('heartbeat-interval').textContent);
+
+// handle open connection
+function onOpen(e){
+    console.log("CONNECTED TO room CONSUMER");
+    reconnectDelay = 1000;
+    sendFrame('presence', {
+        'username': loggedin_user,
+        'type': 'open'
+    });
+}
+
+// keep the user online in the room while the tab is open
+setInterval(function() {
+    if (roomSocket.readyState === WebSocket.OPEN) {
+        sendFrame('presence', {
+            'username': loggedin_user,
+            'type': 'heartbeat'
+        });
+    }
+}, heartbeatInterval * 1000);
+
+connect();
+
+// handle close connection
+window.addEventListener("beforeunload", function(e){
+    sendFrame('presence', {
+        'username': loggedin_user,
+        'type': 'offline'
+    })
+})
+
+// create a function to show a user as online or offline
+function setOnlineStatus(user, isOnline){
+    if(user == loggedin_user){
+        return
+    }
+    if(!document.getElementById(`${user}_status`)){
+        addUser(user)
+    }
+    var user_to_change = document.getElementById(`${user}_status`)
+    var small_status_to_change = document.getElementById(`${user}_small`)
+    if(isOnline){
+        user_to_change.style.color = 'green'
+        small_status_to_change.textContent = 'Online'
+    }else{
+        user_to_change.style.color = 'grey'
+        small_status_to_change.textContent = 'Offline'
+    }
+}
+
+// display usernames that are online
+// - a snapshot of every online user is sent when the socket opens
+// - then a diff of the users who joined or left is sent a few times a second at most
+function handlePresenceFrame(data){
+    if(data.type == 'presence_snapshot'){
+        updateUserList(data.users.filter(user => user != loggedin_user))
+    }else if(data.type == 'presence_diff'){
+        data.joined.forEach(user => setOnlineStatus(user, true))
+        data.left.forEach(user => setOnlineStatus(user, false))
+    }
+}
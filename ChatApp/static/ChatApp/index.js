@@ -0,0 +1,80 @@
+// add for username
+// trigger submit when user selects enter
+document.querySelector('#username-input').focus();
+document.querySelector('#username-input').onkeyup = function(e) {
+    if (e.key === 'Enter') {  // enter, return
+        document.querySelector('#room-name-submit').click();
+    }
+};
+
+document.querySelector('#room-name-input').onkeyup = function(e) {
+    if (e.key === 'Enter') {  // enter, return
+        document.querySelector('#room-name-submit').click();
+    }
+};
+
+// set const for inputs that will be stored in localStorage
+document.querySelector('#room-name-submit').onclick = function(e) {            
+    const username = document.querySelector('#username-input').value;
+    const roomName = document.querySelector('#room-name-input').value;
+
+    // check both input fields were filled
+    if (!username || ! roomName) {
+        alert('Complete all input fields to enter a chat room');
+        return;
+    }
+
+    // use Local storage for usernames
+    localStorage.setItem('username', username);
+
+    window.location.pathname = '/ChatApp/' + roomName + '/';
+};
+
+// show the busiest rooms with their members, clicking a room fills in its name
+// - the socket sends the busiest rooms when it connects & then the new count of each room that changes
+const roomCounts = new Map();
+
+function displayRooms() {
+    const list = document.querySelector('#room-list');
+    list.replaceChildren();
+    const rooms = [...roomCounts].filter(([, members]) => members > 0).sort((a, b) => b[1] - a[1]).slice(0, 10);
+    for (const [roomName, members] of rooms) {
+        const item = document.createElement('li');
+        item.className = 'list-group-item list-group-item-action d-flex justify-content-between';
+        item.textContent = roomName;
+        const badge = document.createElement('span');
+        badge.className = 'badge bg-primary rounded-pill';
+        badge.textContent = members;
+        item.appendChild(badge);
+        item.onclick = function() {
+            document.querySelector('#room-name-input').value = roomName;
+        };
+        list.appendChild(item);
+    }
+}
+
+function watchRooms() {
+    const roomsSocket = new WebSocket('ws://' + window.location.host + '/ws/rooms/');
+    roomsSocket.onmessage = function(e) {
+        const data = JSON.parse(e.data);
+        if (data.type === 'ping') {
+            roomsSocket.send('{"type": "pong"}');
+        } else if (data.type === 'rooms') {
+            // the busiest rooms when the socket connected
+            roomCounts.clear();
+            data.rooms.forEach(room => roomCounts.set(room.room_name, room.members));
+            displayRooms();
+        } else if (data.type === 'room_counts') {
+            for (const [roomName, members] of Object.entries(data.rooms)) {
+                roomCounts.set(roomName, members);
+            }
+            displayRooms();
+        }
+    };
+    // the directory is only a hint, try again later without bothering the user
+    roomsSocket.onclose = function() {
+        setTimeout(watchRooms, 5000 + Math.random() * 5000);
+    };
+}
+
+watchRooms();
@@ -1,3 +1,1292 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import time
+import zlib
+from datetime import timedelta
+
+import msgpack
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import codec, history, metrics
+from .auth import CachedAuthMiddlewareStack
+from .directory import DIRECTORY_GROUP, LocalRoomDirectory, RoomCountCoalescer, room_counts, room_directory
+from .layers import HybridChannelLayer, InMemoryPubSubTransport
+from .liveness import PING, drain_connections, idle_reaper
+from .models import Message
+from .outbox import SendQueue
+from .pages import page_cache
+from .persistence import message_buffer
+from .ratelimit import TokenBucket, room_buckets
+from .presence import InMemoryPresenceBackend, PresenceDiffCoalescer, presence_group_name, presence_store
+from .recent import RecentMessageCache, recent_messages
+from .sequence import RedisRoomSequence
+from .sharding import HashRing, shard_map
+from .routing import websocket_urlpatterns
+from .workers import PresenceBatch, PresenceWorker, worker_stats
 
 # Create your tests here.
+# use the in-memory channel layer so the tests don't need a Redis server
+IN_MEMORY_CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+IN_MEMORY_PRESENCE_BACKEND = "ChatApp.presence.InMemoryPresenceBackend"
+LOCAL_SEQUENCE_BACKEND = "ChatApp.sequence.LocalRoomSequence"
+LOCAL_DIRECTORY_BACKEND = "ChatApp.directory.LocalRoomDirectory"
+
+# the websocket application from asgi.py without the allowed hosts check, which rejects frames without an Origin
+websocket_application = CachedAuthMiddlewareStack(URLRouter(websocket_urlpatterns))
+
+
+class SlowGroupSendLayer(InMemoryChannelLayer):
+    # a group_send that takes a while, like a round trip to Redis
+    async def group_send(self, group, message):
+        await asyncio.sleep(0.05)
+        await super().group_send(group, message)
+
+
+class HistoryTests(TestCase):
+    def setUp(self):
+        for number in range(5):
+            Message.objects.create(room_name="lobby", username="alice", content=f"message {number}")
+        Message.objects.create(room_name="other", username="bob", content="elsewhere")
+        self.ids = list(Message.objects.filter(room_name="lobby").values_list("id", flat=True))
+
+    def test_latest_page_is_oldest_first(self):
+        page = history.get_history("lobby", limit=2)
+        self.assertEqual([m["message"] for m in page["messages"]], ["message 3", "message 4"])
+        self.assertTrue(page["has_more"])
+
+    def test_before_and_after_cursors(self):
+        page = history.get_history("lobby", before=self.ids[2])
+        self.assertEqual([m["id"] for m in page["messages"]], self.ids[:2])
+        self.assertFalse(page["has_more"])
+
+        page = history.get_history("lobby", after=self.ids[1], limit=2)
+        self.assertEqual([m["id"] for m in page["messages"]], self.ids[2:4])
+        self.assertTrue(page["has_more"])
+
+    def test_sequence_number_cursors(self):
+        # the workers' write-behind buffers may save the messages of a room out of order
+        for seq in (2, 1, 4, 3):
+            Message.objects.create(room_name="numbered", username="alice", content=f"number {seq}", seq=seq)
+
+        page = history.get_history("numbered", before_seq=4, limit=2)
+        self.assertEqual([m["seq"] for m in page["messages"]], [2, 3])
+        self.assertTrue(page["has_more"])
+        page = history.get_history("numbered", after_seq=2)
+        self.assertEqual([m["seq"] for m in page["messages"]], [3, 4])
+        self.assertFalse(page["has_more"])
+        # the messages saved before rooms had sequence numbers can't be reached with them
+        self.assertEqual(history.get_history("lobby", before_seq=10)["messages"], [])
+
+        response = self.client.get(reverse("history", args=["numbered"]), {"before_seq": 2})
+        self.assertEqual([m["message"] for m in response.json()["messages"]], ["number 1"])
+        response = self.client.get(reverse("history", args=["numbered"]), {"before_seq": 2, "after": self.ids[0]})
+        self.assertEqual(response.status_code, 400)
+
+    def test_history_view(self):
+        response = self.client.get(reverse("history", args=["lobby"]), {"after": self.ids[3]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m["message"] for m in response.json()["messages"]], ["message 4"])
+
+        response = self.client.get(reverse("history", args=["lobby"]), {"before": "abc"})
+        self.assertEqual(response.status_code, 400)
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        Message.objects.bulk_create(
+            [
+                Message(room_name="lobby", username="alice", content="the deploy is done"),
+                Message(room_name="lobby", username="bob", content="Deploying again, sorry"),
+                Message(room_name="lobby", username="alice", content="lunch?"),
+                Message(room_name="lobby_2", username="alice", content="deploy elsewhere"),
+            ]
+        )
+        self.ids = list(Message.objects.filter(room_name="lobby").values_list("id", flat=True))
+
+    def search(self, **params):
+        response = self.client.get(reverse("search", args=["lobby"]), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_search_is_scoped_and_paginated(self):
+        # the last word matches the words it starts, the results are newest first
+        page = self.search(q="DEPLOY", limit=1)
+        self.assertEqual([m["message"] for m in page["messages"]], ["Deploying again, sorry"])
+        self.assertTrue(page["has_more"])
+        page = self.search(q="deploy", before=page["messages"][-1]["id"])
+        self.assertEqual([m["message"] for m in page["messages"]], ["the deploy is done"])
+        self.assertFalse(page["has_more"])
+
+        self.assertEqual([m["username"] for m in self.search(q="deploy", username="alice")["messages"]], ["alice"])
+        self.assertEqual(self.search(q="deploy done again")["messages"], [])
+
+        Message.objects.filter(id=self.ids[0]).update(created_at=timezone.now() - timedelta(days=2))
+        since = (timezone.now() - timedelta(days=1)).isoformat()
+        self.assertEqual([m["id"] for m in self.search(q="deploy", since=since)["messages"]], [self.ids[1]])
+        self.assertEqual([m["id"] for m in self.search(q="deploy", until=since)["messages"]], [self.ids[0]])
+
+    def test_index_follows_the_table(self):
+        # an edited message is found by its new words only
+        Message.objects.filter(id=self.ids[2]).update(content="dinner?")
+        self.assertEqual(self.search(q="lunch")["messages"], [])
+        self.assertEqual(len(self.search(q="dinner")["messages"]), 1)
+        # quotes & FTS5 operators are plain words
+        self.assertEqual(self.search(q='"lunch" OR NEAR(*')["messages"], [])
+
+    def test_invalid_parameters(self):
+        for params in ({}, {"q": "deploy", "before": "x"}, {"q": "deploy", "since": "yesterday"}):
+            self.assertEqual(self.client.get(reverse("search", args=["lobby"]), params).status_code, 400)
+
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS,
+    CHAT_SEQUENCE_BACKEND=LOCAL_SEQUENCE_BACKEND,
+    CHAT_DIRECTORY_BACKEND=LOCAL_DIRECTORY_BACKEND,
+)
+class ChatConsumerTests(TestCase):
+    def setUp(self):
+        recent_messages.clear()
+
+    def test_message_is_broadcast_and_saved(self):
+        async def scenario():
+            communicator = WebsocketCommunicator(websocket_application, "/ws/ChatApp/lobby/")
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            # the latest messages of the room are sent after the connection is accepted
+            frame = json.loads(await communicator.receive_from())
+            self.assertEqual(frame, {"type": "history", "messages": [], "has_more": False})
+
+            await communicator.send_to(text_data=json.dumps({"message": "hello", "username": "alice"}))
+            frame = json.loads(await communicator.receive_from())
+            self.assertEqual((frame["message"], frame["username"]), ("hello", "alice"))
+            live_seq = frame["seq"]
+
+            # wait for the background save before asking for the history
+            await message_buffer.drain()
+            await communicator.send_to(text_data=json.dumps({"type": "history", "limit": 10}))
+            frame = json.loads(await communicator.receive_from())
+            self.assertEqual(frame["type"], "history")
+            self.assertEqual([m["message"] for m in frame["messages"]], ["hello"])
+            # a client can page back from a message it received live, which only has a sequence number
+            await communicator.send_to(text_data=json.dumps({"type": "history", "before_seq": live_seq + 1}))
+            frame = json.loads(await communicator.receive_from())
+            self.assertEqual([m["message"] for m in frame["messages"]], ["hello"])
+
+            await communicator.disconnect()
+            await message_buffer.close()
+
+        async_to_sync(scenario)()
+
+
+    def test_new_member_is_sent_the_cached_messages(self):
+        async def scenario():
+            alice = WebsocketCommunicator(websocket_application, "/ws/ChatApp/cached/")
+            await alice.connect()
+            await alice.receive_from()
+            await alice.send_to(text_data=json.dumps({"message": "hello", "username": "alice"}))
+            sent = await alice.receive_from()
+
+            bob = WebsocketCommunicator(websocket_application, "/ws/ChatApp/cached/")
+            await bob.connect()
+            frame = json.loads(await bob.receive_from())
+            self.assertEqual(frame["messages"], [json.loads(sent)])
+
+            await alice.disconnect()
+            await bob.disconnect()
+            await message_buffer.close()
+
+        async_to_sync(scenario)()
+
+    @override_settings(RECENT_MESSAGES_PER_ROOM=2)
+    def test_history_frame_says_whether_there_are_older_messages(self):
+        for seq in (1, 2, 3):
+            Message.objects.create(room_name="paged", username="alice", content=f"number {seq}", seq=seq)
+        Message.objects.create(room_name="short", username="alice", content="only one", seq=1)
+
+        async def first_frame(room):
+            communicator = WebsocketCommunicator(websocket_application, f"/ws/ChatApp/{room}/")
+            await communicator.connect()
+            frame = json.loads(await communicator.receive_from())
+            return communicator, frame
+
+        async def scenario():
+            # read from the database, then from the ring the first member filled
+            alice, frame = await first_frame("paged")
+            self.assertEqual([m["message"] for m in frame["messages"]], ["number 2", "number 3"])
+            self.assertTrue(frame["has_more"])
+            bob, frame = await first_frame("paged")
+            self.assertTrue(frame["has_more"])
+            carol, frame = await first_frame("short")
+            self.assertFalse(frame["has_more"])
+            dave, frame = await first_frame("short")
+            self.assertEqual((len(frame["messages"]), frame["has_more"]), (1, False))
+            for communicator in (alice, bob, carol, dave):
+                await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    @override_settings(CHAT_BATCH_MAX_WINDOW=10)
+    def test_messages_are_sent_in_batches_when_asked(self):
+        async def scenario():
+            communicator = WebsocketCommunicator(websocket_application, "/ws/ChatApp/busy/?batch=5000&batch_size=2")
+            await communicator.connect()
+            frame = json.loads(await communicator.receive_from())
+            self.assertEqual(frame, {"type": "batching", "window": 5000, "size": 2})
+            await communicator.receive_from()
+
+            # the batch is full after two messages so it's sent without waiting for the window
+            for text in ("one", "two"):
+                await communicator.send_to(text_data=json.dumps({"message": text, "username": "alice"}))
+            frame = json.loads(await communicator.receive_from())
+            self.assertEqual(frame["type"], "batch")
+            self.assertEqual([message["message"] for message in frame["messages"]], ["one", "two"])
+
+            await communicator.disconnect()
+            await message_buffer.close()
+
+        async_to_sync(scenario)()
+
+    def test_reconnecting_member_is_sent_only_the_missed_messages(self):
+        async def scenario():
+            alice = WebsocketCommunicator(websocket_application, "/ws/ChatApp/numbered/")
+            await alice.connect()
+            await alice.receive_from()
+            numbers = []
+            for text in ("one", "two", "three"):
+                await alice.send_to(text_data=json.dumps({"message": text, "username": "alice"}))
+                numbers.append(json.loads(await alice.receive_from())["seq"])
+            self.assertEqual(numbers, [numbers[0], numbers[0] + 1, numbers[0] + 2])
+
+            bob = WebsocketCommunicator(websocket_application, f"/ws/ChatApp/numbered/?since={numbers[0]}")
+            await bob.connect()
+            frame = json.loads(await bob.receive_from())
+            self.assertEqual(frame["type"], "catchup")
+            self.assertEqual([message["message"] for message in frame["messages"]], ["two", "three"])
+
+            # a client that missed more than the cache holds starts again from the latest page
+            carol = WebsocketCommunicator(websocket_application, "/ws/ChatApp/numbered/?since=-5")
+            await carol.connect()
+            frame = json.loads(await carol.receive_from())
+            self.assertEqual(frame["type"], "history")
+
+            for communicator in (alice, bob, carol):
+                await communicator.disconnect()
+            await message_buffer.close()
+            return numbers
+
+        numbers = async_to_sync(scenario)()
+        saved = Message.objects.filter(room_name="numbered").order_by("id").values_list("seq", flat=True)
+        self.assertEqual(list(saved), numbers)
+
+
+class FakeSequenceRedis:
+    # the commands RedisRoomSequence sends, on a dict, the tests run without a Redis server
+    # - each command yields to the event loop like a round trip, the script runs in one step like in Redis
+    def __init__(self, counters=None):
+        self.counters = dict(counters or {})
+
+    def register_script(self, script):
+        async def incr_existing(keys):
+            await asyncio.sleep(0)
+            if keys[0] not in self.counters:
+                return None
+            self.counters[keys[0]] += 1
+            return self.counters[keys[0]]
+
+        return incr_existing
+
+    async def set(self, key, value, nx=False):
+        await asyncio.sleep(0)
+        if nx and key in self.counters:
+            return None
+        self.counters[key] = int(value)
+        return True
+
+    async def incr(self, key):
+        await asyncio.sleep(0)
+        self.counters[key] = self.counters.get(key, 0) + 1
+        return self.counters[key]
+
+
+class RedisRoomSequenceTests(TestCase):
+    def setUp(self):
+        Message.objects.create(room_name="lobby", username="alice", content="saved", seq=5)
+
+    def sequence(self, redis):
+        sequence = RedisRoomSequence()
+        sequence.client = lambda: redis
+        return sequence
+
+    def test_seeded_counter_keeps_counting(self):
+        redis = FakeSequenceRedis({"chat:seq:lobby": 7})
+        sequence = self.sequence(redis)
+
+        async def scenario():
+            return [await sequence.next("lobby") for _ in range(2)]
+
+        self.assertEqual(async_to_sync(scenario)(), [8, 9])
+
+    def test_missing_counter_is_seeded_once(self):
+        redis = FakeSequenceRedis()
+        # two workers find the counter missing at the same time
+        workers = [self.sequence(redis), self.sequence(redis)]
+
+        async def scenario():
+            return await asyncio.gather(*(worker.next("lobby") for worker in workers))
+
+        self.assertEqual(sorted(async_to_sync(scenario)()), [6, 7])
+        self.assertEqual(redis.counters["chat:seq:lobby"], 7)
+
+
+class RecentMessageCacheTests(TestCase):
+    def test_message_is_serialized_once(self):
+        cache = RecentMessageCache()
+        calls = []
+        serialize = lambda: calls.append(1) or '{"message": "hi"}'
+        self.assertEqual(cache.add("lobby", "1", serialize), '{"message": "hi"}')
+        self.assertEqual(cache.add("lobby", "1", serialize), '{"message": "hi"}')
+        self.assertEqual(len(calls), 1)
+
+    @override_settings(RECENT_MESSAGES_PER_ROOM=2, RECENT_MESSAGES_MAX_ROOMS=2)
+    def test_ring_and_room_limits(self):
+        cache = RecentMessageCache()
+        for number in range(3):
+            cache.add("lobby", str(number), lambda: str(number))
+        self.assertEqual(cache.frames("lobby"), ["1", "2"])
+
+        cache.add("kitchen", "a", lambda: "a")
+        cache.frames("lobby")
+        # the kitchen is the least recently used room when a third room is added
+        cache.add("garden", "b", lambda: "b")
+        self.assertEqual(cache.frames("kitchen"), [])
+        self.assertEqual(cache.frames("lobby"), ["1", "2"])
+
+    @override_settings(RECENT_MESSAGES_PER_ROOM=3)
+    def test_frames_since_a_sequence_number(self):
+        cache = RecentMessageCache()
+        self.assertIsNone(cache.frames_since("lobby", 0))
+        # the messages may arrive out of order, they are sent in the order they were numbered
+        for seq in (1, 3, 2, 4):
+            cache.add("lobby", str(seq), lambda: str(seq), seq=seq)
+        self.assertEqual(cache.frames_since("lobby", 2), ["3", "4"])
+        self.assertEqual(cache.frames_since("lobby", 4), [])
+        # the first message was dropped from the ring, so a client that saw none of them can't catch up
+        self.assertIsNone(cache.frames_since("lobby", 0))
+        self.assertIsNone(cache.frames_since("lobby", 9))
+
+    def test_frames_since_with_a_gap_is_a_miss(self):
+        cache = RecentMessageCache()
+        # the message numbered 3 was sent while the worker had no members in the room
+        for seq in (1, 2, 4):
+            cache.add("lobby", str(seq), lambda: str(seq), seq=seq)
+        self.assertEqual(cache.frames_since("lobby", 3), ["4"])
+        self.assertIsNone(cache.frames_since("lobby", 1))
+        # the room's latest messages haven't reached the ring
+        self.assertIsNone(cache.frames_since("lobby", 3, current=5))
+        self.assertEqual(cache.frames_since("lobby", 3, current=4), ["4"])
+
+    def test_room_is_dropped_when_its_last_member_leaves(self):
+        cache = RecentMessageCache()
+        cache.join("lobby")
+        cache.join("lobby")
+        cache.add("lobby", "1", lambda: "x" * 50)
+        cache.leave("lobby")
+        self.assertEqual(cache.frames("lobby"), ["x" * 50])
+        # the worker no longer receives the room's messages, so the ring would go stale
+        cache.leave("lobby")
+        self.assertEqual(cache.frames("lobby"), [])
+        self.assertEqual(cache.nbytes, 0)
+
+    @override_settings(RECENT_MESSAGES_MAX_BYTES=250)
+    def test_memory_cap_drops_idle_rooms(self):
+        cache = RecentMessageCache()
+        cache.add("lobby", "1", lambda: "x" * 50)
+        cache.add("kitchen", "2", lambda: "y" * 50)
+        self.assertEqual(cache.frames("lobby"), [])
+        self.assertEqual(cache.nbytes, 50 + 100)
+
+
+class MessageWriteBufferTests(TestCase):
+    @override_settings(CHAT_HISTORY_BATCH_SIZE=3, CHAT_HISTORY_FLUSH_INTERVAL=10)
+    def test_full_batch_is_written_with_one_insert(self):
+        async def scenario():
+            for number in range(3):
+                await history.save_message("lobby", "alice", f"message {number}", timezone.now())
+            await message_buffer.drain()
+            await message_buffer.close()
+
+        with CaptureQueriesContext(connection) as queries:
+            # the flush interval is longer than the test so only the batch size can trigger the write
+            async_to_sync(scenario)()
+        self.assertEqual(Message.objects.count(), 3)
+        self.assertEqual(sum(query["sql"].startswith("INSERT") for query in queries.captured_queries), 1)
+
+    def test_flush_sync_writes_messages_left_in_the_buffer(self):
+        message_buffer._batch.append(Message(room_name="lobby", username="alice", content="left behind"))
+        message_buffer.flush_sync()
+        self.assertEqual(Message.objects.get().content, "left behind")
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, PRESENCE_BROADCAST_WINDOW=10)
+class PresenceDiffCoalescerTests(TestCase):
+    def test_changes_in_a_window_are_sent_as_one_diff(self):
+        async def scenario():
+            channel_layer = get_channel_layer()
+            channel_name = await channel_layer.new_channel()
+            await channel_layer.group_add("lobby_online_users", channel_name)
+
+            coalescer = PresenceDiffCoalescer()
+            coalescer.add("lobby", "alice", True)
+            coalescer.add("lobby", "bob", True)
+            coalescer.add("lobby", "carol", False)
+            # bob came online & went offline again within the window so he isn't sent
+            coalescer.add("lobby", "bob", False)
+            await coalescer.flush_all()
+
+            event = await channel_layer.receive(channel_name)
+            self.assertEqual(event["type"], "presence.diff")
+            self.assertEqual(json.loads(event["text"]), {"type": "presence_diff", "joined": ["alice"], "left": ["carol"]})
+
+            for task in coalescer._tasks:
+                task.cancel()
+
+        async_to_sync(scenario)()
+
+
+class PresenceBatchTests(TestCase):
+    def test_add_and_remove_of_the_same_user_cancel_out(self):
+        batch = PresenceBatch()
+        batch.add("lobby", "alice", True)
+        batch.add("lobby", "bob", False)
+        # a page refresh disconnects & reconnects alice within the batch
+        batch.add("lobby", "alice", False)
+        batch.add("lobby", "alice", True)
+        batch.add("kitchen", "alice", True)
+        batch.add("kitchen", "alice", False)
+
+        self.assertEqual(len(batch), 6)
+        self.assertEqual(batch.changes(), {("lobby", "alice"): True, ("lobby", "bob"): False})
+
+
+class InMemoryPresenceBackendTests(TestCase):
+    def test_heartbeats_lookups_and_sweep(self):
+        async def scenario():
+            backend = InMemoryPresenceBackend()
+            self.assertTrue(await backend.heartbeat("lobby", "alice", now=100))
+            # a refreshed heartbeat isn't a change
+            self.assertFalse(await backend.heartbeat("lobby", "alice", now=110))
+            await backend.heartbeat("lobby", "bob", now=70)
+            await backend.heartbeat("kitchen", "carol", now=100)
+
+            self.assertEqual(await backend.online_users("lobby", now=110), ["bob", "alice"])
+            self.assertEqual(await backend.statuses("lobby", ["alice", "carol"], now=110), {"alice": True, "carol": False})
+            self.assertEqual(await backend.count("lobby", now=110), 2)
+
+            # bob's last heartbeat is older than the TTL of 45 seconds by then
+            self.assertEqual(await backend.sweep(now=120), {"lobby": ["bob"]})
+            self.assertTrue(await backend.leave("lobby", "alice"))
+            self.assertEqual(await backend.online_users("lobby", now=110), [])
+
+        async_to_sync(scenario)()
+
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, PRESENCE_BACKEND=IN_MEMORY_PRESENCE_BACKEND, PRESENCE_BROADCAST_WINDOW=0
+)
+class PresenceConsumerTests(TestCase):
+    def test_snapshot_then_diff(self):
+        async def scenario():
+            await presence_store.heartbeat("lobby", "bob")
+
+            communicator = WebsocketCommunicator(websocket_application, "/ws/presence/lobby/")
+            await communicator.connect()
+            frame = json.loads(await communicator.receive_from())
+            self.assertEqual(frame, {"type": "presence_snapshot", "users": ["bob"]})
+
+            await communicator.send_to(text_data=json.dumps({"username": "alice", "type": "open"}))
+            frame = json.loads(await communicator.receive_from())
+            self.assertEqual(frame, {"type": "presence_diff", "joined": ["alice"], "left": []})
+
+            await communicator.send_to(text_data=json.dumps({"username": "alice", "type": "offline"}))
+            frame = json.loads(await communicator.receive_from())
+            self.assertEqual(frame, {"type": "presence_diff", "joined": [], "left": ["alice"]})
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_worker_writes_a_batch(self):
+        async def scenario():
+            worker = PresenceWorker()
+            await worker.add_user({"type": "add_user", "room_name": "kitchen", "username": "alice"})
+            await worker.add_user({"type": "add_user", "room_name": "kitchen", "username": "bob"})
+            await worker.remove_user({"type": "remove_user", "room_name": "kitchen", "username": "bob"})
+            worker.flush_task.cancel()
+            await worker.flush()
+            self.assertEqual(await presence_store.online_users("kitchen"), ["alice"])
+
+        batches = worker_stats.batches
+        async_to_sync(scenario)()
+        self.assertEqual(worker_stats.batches, batches + 1)
+
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS,
+    PRESENCE_BACKEND=IN_MEMORY_PRESENCE_BACKEND,
+    PRESENCE_BROADCAST_WINDOW=0,
+    CHAT_SEQUENCE_BACKEND=LOCAL_SEQUENCE_BACKEND,
+    CHAT_DIRECTORY_BACKEND=LOCAL_DIRECTORY_BACKEND,
+)
+class MultiplexConsumerTests(TestCase):
+    def setUp(self):
+        recent_messages.clear()
+
+    def test_chat_and_presence_share_one_socket(self):
+        async def scenario():
+            communicator = WebsocketCommunicator(websocket_application, "/ws/room/lobby/?username=alice")
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            # each stream sends its first frame wrapped in an envelope
+            frames = [json.loads(await communicator.receive_from()) for _ in range(2)]
+            self.assertIn({"stream": "chat", "payload": {"type": "history", "messages": [], "has_more": False}}, frames)
+            self.assertIn({"stream": "presence", "payload": {"type": "presence_snapshot", "users": []}}, frames)
+
+            await communicator.send_to(
+                text_data=json.dumps({"stream": "chat", "payload": {"message": "hello", "username": "alice"}})
+            )
+            frame = json.loads(await communicator.receive_from())
+            self.assertEqual(frame["stream"], "chat")
+            self.assertEqual(frame["payload"]["message"], "hello")
+
+            await communicator.send_to(
+                text_data=json.dumps({"stream": "presence", "payload": {"username": "alice", "type": "open"}})
+            )
+            frame = json.loads(await communicator.receive_from())
+            self.assertEqual(
+                frame, {"stream": "presence", "payload": {"type": "presence_diff", "joined": ["alice"], "left": []}}
+            )
+
+            await communicator.send_to(text_data=json.dumps({"stream": "video", "payload": {}}))
+            frame = json.loads(await communicator.receive_from())
+            self.assertEqual(frame, {"type": "error", "error": "unknown stream"})
+
+            await communicator.disconnect()
+            await message_buffer.close()
+
+        async_to_sync(scenario)()
+
+
+class HybridChannelLayerTests(TestCase):
+    def test_group_send_is_published_once_per_process(self):
+        async def scenario():
+            # each layer stands for a separate process
+            layers = [HybridChannelLayer(transport="ChatApp.layers.InMemoryPubSubTransport") for _ in range(2)]
+            members = {}
+            for layer in layers:
+                members[layer] = [await layer.new_channel() for _ in range(3)]
+                for channel in members[layer]:
+                    await layer.group_add("chat_lobby", channel)
+
+            await layers[0].group_send("chat_lobby", {"type": "chat.message", "text": "hello"})
+            for layer in layers:
+                for channel in members[layer]:
+                    self.assertEqual(await layer.receive(channel), {"type": "chat.message", "text": "hello"})
+            self.assertEqual(layers[0].transport.published, 1)
+
+            # a specific channel of another process is reached through that process's topic
+            await layers[1].send(members[layers[0]][0], {"type": "chat.message", "text": "direct"})
+            message = await layers[0].receive(members[layers[0]][0])
+            self.assertEqual(message["text"], "direct")
+
+            # a process whose last member left stops receiving the group's messages
+            for channel in members[layers[1]]:
+                await layers[1].group_discard("chat_lobby", channel)
+            await layers[0].group_send("chat_lobby", {"type": "chat.message", "text": "bye"})
+            self.assertEqual(layers[1].channels, {})
+
+            for layer in layers:
+                await layer.flush()
+
+        async_to_sync(scenario)()
+
+
+    def test_group_emptied_by_expiry_is_unsubscribed(self):
+        async def scenario():
+            layer = HybridChannelLayer(transport="ChatApp.layers.InMemoryPubSubTransport", group_expiry=60)
+            channel = await layer.new_channel()
+            await layer.group_add("chat_kitchen", channel)
+            topic = layer.group_topic("chat_kitchen")
+            self.assertIn(layer.transport, InMemoryPubSubTransport.subscribers[topic])
+
+            # the membership expires without a group_discard, e.g. the consumer's process lost it
+            layer.groups["chat_kitchen"][channel] = time.time() - 120
+            await layer.group_send("chat_lobby", {"type": "chat.message", "text": "hello"})
+            await asyncio.sleep(0)
+            self.assertNotIn("chat_kitchen", layer.groups)
+            self.assertNotIn(layer.transport, InMemoryPubSubTransport.subscribers.get(topic, ()))
+
+            # a member joining again subscribes again
+            await layer.group_add("chat_kitchen", channel)
+            self.assertIn(layer.transport, InMemoryPubSubTransport.subscribers[topic])
+            await layer.flush()
+
+        async_to_sync(scenario)()
+
+
+class HashRingTests(TestCase):
+    def test_rooms_are_spread_and_few_move(self):
+        rooms = [f"chat_room{number}" for number in range(3000)]
+        ring = HashRing(["a", "b", "c"])
+        before = {room: ring.get(room) for room in rooms}
+        for shard in "abc":
+            self.assertGreater(list(before.values()).count(shard), 600)
+
+        # only the rooms taken by the new shard move
+        ring.add("d")
+        moved = [room for room in rooms if ring.get(room) != before[room]]
+        self.assertTrue(all(ring.get(room) == "d" for room in moved))
+        self.assertLess(len(moved), len(rooms) * 0.4)
+
+        # & they come back when it leaves
+        ring.remove("d")
+        self.assertEqual({room: ring.get(room) for room in rooms}, before)
+
+    def test_sharded_rooms_fan_out_in_one_process(self):
+        async def scenario():
+            # three in-process workers, each room's members connect to the worker the ring picks
+            workers = {name: HybridChannelLayer(transport="ChatApp.layers.InMemoryPubSubTransport") for name in "abc"}
+            ring = HashRing(workers)
+            rooms = {}
+            for number in range(6):
+                group = f"chat_room{number}"
+                layer = workers[ring.get(group)]
+                rooms[group] = (layer, [await layer.new_channel() for _ in range(4)])
+                for channel in rooms[group][1]:
+                    await layer.group_add(group, channel)
+
+            remote = metrics.CHANNEL_LAYER_MESSAGES.value("remote")
+            for group, (layer, channels) in rooms.items():
+                await layer.group_send(group, {"type": "chat.message", "text": group})
+                for channel in channels:
+                    self.assertEqual((await layer.receive(channel))["text"], group)
+            # every delivery was in memory, no worker received a message from another
+            self.assertEqual(metrics.CHANNEL_LAYER_MESSAGES.value("remote"), remote)
+
+            for layer in workers.values():
+                await layer.flush()
+
+        async_to_sync(scenario)()
+
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS,
+    PRESENCE_BACKEND=IN_MEMORY_PRESENCE_BACKEND,
+    CHAT_SEQUENCE_BACKEND=LOCAL_SEQUENCE_BACKEND,
+    CHAT_DIRECTORY_BACKEND=LOCAL_DIRECTORY_BACKEND,
+    CHAT_SHARDS={"a": "ws://a.example", "b": "ws://b.example"},
+    CHAT_SHARD_NAME="a",
+)
+class ShardingTests(TestCase):
+    def setUp(self):
+        # read the shards of the settings again after a test moved the rooms
+        shard_map.clear()
+
+    def room_on(self, shard):
+        return next(f"room{n}" for n in range(100) if shard_map.shard_for(f"room{n}")["shard"] == shard)
+
+    def test_client_is_sent_to_the_shard_of_its_room(self):
+        room = self.room_on("b")
+        response = self.client.get(reverse("shard", args=[room]))
+        self.assertEqual(response.json(), {"room_name": room, "shard": "b", "url": "ws://b.example"})
+
+        async def scenario():
+            communicator = WebsocketCommunicator(websocket_application, f"/ws/room/{room}/")
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            frame = json.loads(await communicator.receive_from())
+            self.assertEqual(frame, {"type": "redirect", "shard": "b", "url": "ws://b.example"})
+            self.assertEqual((await communicator.receive_output())["code"], 4010)
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_members_are_redirected_when_their_room_moves(self):
+        room = self.room_on("a")
+        connections = metrics.ACTIVE_CONNECTIONS.value()
+
+        async def scenario():
+            communicator = WebsocketCommunicator(websocket_application, f"/ws/ChatApp/{room}/")
+            await communicator.connect()
+            self.assertEqual(json.loads(await communicator.receive_from())["type"], "history")
+            self.assertEqual(metrics.ACTIVE_CONNECTIONS.value(), connections + 1)
+            self.assertIn(room, shard_map.rooms)
+
+            # shard a leaves, so every room it hosted moves to b
+            self.assertEqual(await shard_map.update({"b": "ws://b.example"}), [room])
+            frame = json.loads(await communicator.receive_from())
+            self.assertEqual(frame, {"type": "redirect", "shard": "b", "url": "ws://b.example"})
+            self.assertEqual((await communicator.receive_output())["code"], 4010)
+            await communicator.disconnect()
+            # the member had joined the room, so it left the group & the counts like any other member
+            self.assertNotIn(room, shard_map.rooms)
+            self.assertEqual(metrics.ACTIVE_CONNECTIONS.value(), connections)
+            self.assertNotIn(room, dict(await room_directory.top(100)))
+            self.assertEqual(get_channel_layer().groups.get(f"chat_{room}", {}), {})
+            await message_buffer.close()
+
+        async_to_sync(scenario)()
+
+    def test_moved_room_is_redirected_once(self):
+        room = self.room_on("a")
+
+        async def scenario():
+            communicator = WebsocketCommunicator(websocket_application, f"/ws/presence/{room}/")
+            await communicator.connect()
+            await communicator.receive_from()
+            redirects = metrics.SHARD_REDIRECTS.value("moved")
+
+            await shard_map.update({"b": "ws://b.example"})
+            # every other process that hosts members of the room sends the news as well
+            await get_channel_layer().group_send(
+                presence_group_name(room), {"type": "shard.moved", "room_name": room}
+            )
+            self.assertEqual(json.loads(await communicator.receive_from())["type"], "redirect")
+            self.assertEqual((await communicator.receive_output())["code"], 4010)
+            self.assertTrue(await communicator.receive_nothing())
+            self.assertEqual(metrics.SHARD_REDIRECTS.value("moved"), redirects + 1)
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    def reshard_idle_process(self, shards):
+        """Start listening like a process without members, send shards with `reshard` & return the map's shards."""
+        async def scenario():
+            shard_map.start()
+            # let the listener join the shards group
+            await asyncio.sleep(0.01)
+            self.assertEqual(shard_map.rooms, {})
+            args = [f"--shard={name}={url}" for name, url in shards.items()]
+            await sync_to_async(call_command)("reshard", *args, stdout=io.StringIO())
+            for _ in range(100):
+                if shard_map.shards == shards:
+                    break
+                await asyncio.sleep(0.01)
+            redirect = shard_map.redirect_for(self.room_on("b"))
+            shard_map.clear()
+            return redirect
+
+        return async_to_sync(scenario)()
+
+    def test_idle_process_receives_new_shards(self):
+        shards = {"a": "ws://a.example", "b": "ws://b2.example"}
+        self.assertEqual(self.reshard_idle_process(shards)["url"], "ws://b2.example")
+
+    @override_settings(CHAT_SHARDS=None)
+    def test_reshard_turns_sharding_on(self):
+        self.assertFalse(shard_map.enabled)
+        shards = {"a": "ws://a.example", "b": "ws://b.example"}
+        self.assertEqual(self.reshard_idle_process(shards), {"shard": "b", "url": "ws://b.example"})
+
+    def test_presence_members_are_redirected_when_their_room_moves(self):
+        room = self.room_on("a")
+
+        async def scenario():
+            communicator = WebsocketCommunicator(websocket_application, f"/ws/presence/{room}/")
+            await communicator.connect()
+            self.assertEqual(json.loads(await communicator.receive_from())["type"], "presence_snapshot")
+
+            self.assertEqual(await shard_map.update({"b": "ws://b.example"}), [room])
+            frame = json.loads(await communicator.receive_from())
+            self.assertEqual(frame, {"type": "redirect", "shard": "b", "url": "ws://b.example"})
+            self.assertEqual((await communicator.receive_output())["code"], 4010)
+            await communicator.disconnect()
+            self.assertNotIn(room, shard_map.rooms)
+
+        async_to_sync(scenario)()
+
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS,
+    PRESENCE_BACKEND=IN_MEMORY_PRESENCE_BACKEND,
+    CHAT_SEQUENCE_BACKEND=LOCAL_SEQUENCE_BACKEND,
+    CHAT_DIRECTORY_BACKEND=LOCAL_DIRECTORY_BACKEND,
+    CHAT_PING_INTERVAL=20,
+    CHAT_IDLE_TIMEOUT=60,
+    CHAT_IDLE_CLOSE_CODE=4011,
+)
+class IdleReaperTests(TestCase):
+    def setUp(self):
+        idle_reaper.clear()
+        recent_messages.clear()
+
+    def test_quiet_connection_is_pinged_then_closed(self):
+        async def scenario():
+            communicator = WebsocketCommunicator(websocket_application, "/ws/ChatApp/quiet/")
+            await communicator.connect()
+            await communicator.receive_from()
+            [consumer] = idle_reaper.connections
+            # the scope only keeps what the consumer reads after connecting
+            self.assertNotIn("headers", consumer.scope)
+            self.assertEqual(consumer.scope["url_route"]["kwargs"]["room_name"], "quiet")
+
+            connected_at = idle_reaper.connections[consumer]
+            self.assertEqual(await idle_reaper.reap(now=connected_at + 10), (0, 0))
+            self.assertEqual(await idle_reaper.reap(now=connected_at + 20), (1, 0))
+            self.assertEqual(await communicator.receive_from(), PING)
+
+            # the pong counts as a sign of life & isn't passed to the consumer
+            await communicator.send_to(text_data='{"type": "pong"}')
+            self.assertTrue(await communicator.receive_nothing())
+            self.assertGreater(idle_reaper.connections[consumer], connected_at)
+
+            closed = metrics.IDLE_CONNECTIONS_CLOSED.value()
+            self.assertEqual(await idle_reaper.reap(now=idle_reaper.connections[consumer] + 60), (0, 1))
+            self.assertEqual(await communicator.receive_output(), {"type": "websocket.close", "code": 4011})
+            await communicator.wait()
+            self.assertEqual(metrics.IDLE_CONNECTIONS_CLOSED.value(), closed + 1)
+            self.assertEqual(idle_reaper.connections, {})
+            # the consumer left its room group without waiting for the socket to close
+            self.assertNotIn(consumer.channel_name, get_channel_layer().groups.get("chat_quiet", {}))
+            await message_buffer.close()
+
+        async_to_sync(scenario)()
+
+    @override_settings(CHAT_DRAIN_JITTER=2)
+    def test_drained_connection_is_told_to_reconnect(self):
+        async def scenario():
+            communicator = WebsocketCommunicator(websocket_application, "/ws/ChatApp/draining/")
+            await communicator.connect()
+            await communicator.receive_from()
+            [consumer] = idle_reaper.connections
+
+            self.assertEqual(await drain_connections(), 1)
+            reconnect = json.loads(await communicator.receive_from())
+            self.assertEqual(reconnect["type"], "reconnect")
+            self.assertTrue(0 <= reconnect["retry_after"] <= 2000)
+            self.assertEqual(await communicator.receive_output(), {"type": "websocket.close", "code": 4012})
+            await communicator.wait()
+            self.assertEqual(idle_reaper.connections, {})
+            self.assertNotIn(consumer.channel_name, get_channel_layer().groups.get("chat_draining", {}))
+            # a drained connection isn't drained again
+            self.assertEqual(await drain_connections(), 0)
+            await message_buffer.close()
+
+        async_to_sync(scenario)()
+
+
+class LocalRoomDirectoryTests(TestCase):
+    def test_rooms_are_ordered_by_members(self):
+        async def scenario():
+            directory = LocalRoomDirectory()
+            for room_name in ["a", "b", "b", "c", "c", "c"]:
+                await directory.join(room_name)
+            top = await directory.top(10)
+            # a member leaving moves the room down past the rooms it had caught up with
+            self.assertEqual(await directory.leave("c"), 2)
+            self.assertEqual(await directory.leave("a"), 0)
+            self.assertEqual(await directory.leave("a"), 0)
+            return top, await directory.top(1), await directory.top(10), await directory.size()
+
+        top, first, after, size = async_to_sync(scenario)()
+        self.assertEqual(top, [("c", 3), ("b", 2), ("a", 1)])
+        self.assertEqual(first, [("b", 2)])
+        self.assertEqual(after, [("b", 2), ("c", 2)])
+        self.assertEqual(size, 2)
+
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS,
+    PRESENCE_BACKEND=IN_MEMORY_PRESENCE_BACKEND,
+    CHAT_SEQUENCE_BACKEND=LOCAL_SEQUENCE_BACKEND,
+    CHAT_DIRECTORY_BACKEND=LOCAL_DIRECTORY_BACKEND,
+    CHAT_DIRECTORY_CACHE_TTL=60,
+)
+class RoomDirectoryTests(TestCase):
+    def setUp(self):
+        recent_messages.clear()
+        room_directory.clear()
+        room_counts.clear()
+
+    @override_settings(
+        CHANNEL_LAYERS={"default": {"BACKEND": "ChatApp.tests.SlowGroupSendLayer"}},
+        CHAT_DIRECTORY_PUSH_WINDOW=0.01,
+    )
+    def test_count_changed_while_sending_is_pushed(self):
+        async def scenario():
+            channel_layer = get_channel_layer()
+            channel = await channel_layer.new_channel()
+            await channel_layer.group_add(DIRECTORY_GROUP, channel)
+            coalescer = RoomCountCoalescer()
+            coalescer.add("busy", 1)
+            # the window ended & its counts are being sent
+            await asyncio.sleep(0.03)
+            coalescer.add("busy", 2)
+            frames = [json.loads((await asyncio.wait_for(channel_layer.receive(channel), 1))["text"]) for _ in range(2)]
+            return [frame["rooms"] for frame in frames]
+
+        self.assertEqual(async_to_sync(scenario)(), [{"busy": 1}, {"busy": 2}])
+
+    def test_member_counts_are_pushed_to_the_feed(self):
+        async def scenario():
+            feed = WebsocketCommunicator(websocket_application, "/ws/rooms/")
+            await feed.connect()
+            self.assertEqual(json.loads(await feed.receive_from()), {"type": "rooms", "rooms": [], "active_rooms": 0})
+
+            members = []
+            for _ in range(2):
+                communicator = WebsocketCommunicator(websocket_application, "/ws/ChatApp/busy/")
+                await communicator.connect()
+                await communicator.receive_from()
+                members.append(communicator)
+            await members[0].disconnect()
+            # the counts of the window are pushed as one frame with the latest count of the room
+            await room_counts.flush()
+            self.assertEqual(json.loads(await feed.receive_from()), {"type": "room_counts", "rooms": {"busy": 1}})
+
+            await members[1].disconnect()
+            await room_counts.flush()
+            self.assertEqual(json.loads(await feed.receive_from()), {"type": "room_counts", "rooms": {"busy": 0}})
+            await feed.disconnect()
+            await message_buffer.close()
+
+        async_to_sync(scenario)()
+
+    def test_busiest_rooms_are_cached(self):
+        for room_name in ["quiet", "busy", "busy"]:
+            async_to_sync(room_directory.join)(room_name)
+        response = self.client.get(reverse("rooms"))
+        self.assertEqual(response.json(), {
+            "rooms": [{"room_name": "busy", "members": 2}, {"room_name": "quiet", "members": 1}],
+            "active_rooms": 2,
+        })
+        self.assertIn("max-age=60", response["Cache-Control"])
+
+        # the directory isn't read again until the cached rooms expire
+        async_to_sync(room_directory.join)("new")
+        self.assertEqual(self.client.get(reverse("rooms")).json()["active_rooms"], 2)
+
+
+class SendQueueTests(TestCase):
+    async def fill(self, queue, count):
+        for number in range(count):
+            await queue.send({"type": "websocket.send", "text": str(number)})
+            if not number:
+                # let the writer start sending the first frame
+                await asyncio.sleep(0)
+
+    def run_slow_client(self, count):
+        """Queue frames for a client that doesn't read until they are all queued & return what it was sent."""
+        async def scenario():
+            sent = []
+            reading = asyncio.Event()
+
+            async def slow_send(message):
+                await reading.wait()
+                sent.append(message)
+
+            queue = SendQueue(slow_send)
+            await self.fill(queue, count)
+            stats = queue.stats()
+            reading.set()
+            await queue.drain()
+            queue.close()
+            return sent, stats
+
+        return async_to_sync(scenario)()
+
+    def test_writer_stops_when_the_queue_is_empty(self):
+        async def scenario():
+            sent = []
+
+            async def send(message):
+                sent.append(message)
+
+            queue = SendQueue(send)
+            await self.fill(queue, 3)
+            await queue.drain()
+            # an idle connection has no writer task, the next frame starts one
+            self.assertIsNone(queue._writer)
+            await self.fill(queue, 1)
+            await queue.drain()
+            return [message["text"] for message in sent]
+
+        self.assertEqual(async_to_sync(scenario)(), ["0", "1", "2", "0"])
+
+    def test_writer_restarts_after_a_failed_send(self):
+        async def scenario():
+            sent = []
+
+            async def send(message):
+                if message["text"] == "broken":
+                    raise RuntimeError("the socket closed")
+                sent.append(message)
+
+            queue = SendQueue(send)
+            await queue.send({"type": "websocket.send", "text": "broken"})
+            with self.assertRaises(RuntimeError):
+                await queue.drain()
+            self.assertIsNone(queue._writer)
+            await queue.send({"type": "websocket.send", "text": "next"})
+            await queue.drain()
+            return [message["text"] for message in sent]
+
+        self.assertEqual(async_to_sync(scenario)(), ["next"])
+
+    @override_settings(CHAT_SEND_QUEUE_SIZE=3, CHAT_SEND_QUEUE_POLICY="drop_oldest")
+    def test_drop_oldest(self):
+        sent, stats = self.run_slow_client(6)
+        # the first frame was already being sent when the queue filled up
+        self.assertEqual([message["text"] for message in sent], ["0", "3", "4", "5"])
+        self.assertEqual(stats["dropped"], 2)
+
+    @override_settings(CHAT_SEND_QUEUE_SIZE=3, CHAT_SEND_QUEUE_POLICY="coalesce")
+    def test_coalesce(self):
+        sent, stats = self.run_slow_client(6)
+        texts = [message["text"] for message in sent]
+        self.assertEqual(texts[0], "0")
+        self.assertEqual(json.loads(texts[1]), {"type": "resync", "missed": 3})
+        self.assertEqual(texts[2:], ["4", "5"])
+        self.assertEqual(stats["coalesced"], 3)
+        self.assertNotIn("resync", sent[1])
+
+    @override_settings(CHAT_SEND_QUEUE_SIZE=3, CHAT_SEND_QUEUE_POLICY="disconnect", CHAT_SEND_QUEUE_CLOSE_CODE=4008)
+    def test_disconnect(self):
+        closed = metrics.SLOW_CLIENTS_CLOSED.value()
+        sent, stats = self.run_slow_client(6)
+        self.assertEqual(sent[-1], {"type": "websocket.close", "code": 4008})
+        self.assertEqual(metrics.SLOW_CLIENTS_CLOSED.value(), closed + 1)
+
+
+class TokenBucketTests(TestCase):
+    def test_burst_then_steady_rate(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        now = bucket.updated_at
+        self.assertEqual([bucket.take(now) for _ in range(4)], [True, True, True, False])
+        # half a second refills one token at two tokens per second
+        self.assertTrue(bucket.take(now + 0.5))
+        self.assertFalse(bucket.take(now + 0.5))
+
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS,
+    CHAT_SEQUENCE_BACKEND=LOCAL_SEQUENCE_BACKEND,
+    CHAT_DIRECTORY_BACKEND=LOCAL_DIRECTORY_BACKEND,
+    CHAT_MAX_FRAME_SIZE=200,
+    CHAT_MAX_MESSAGE_LENGTH=20,
+)
+class FloodControlTests(TestCase):
+    def setUp(self):
+        recent_messages.clear()
+        room_buckets.clear()
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(websocket_application, "/ws/ChatApp/flood/")
+        await communicator.connect()
+        # skip the history frame
+        await communicator.receive_from()
+        return communicator
+
+    @override_settings(CHAT_RATE_LIMIT_CONNECTION=(0.001, 2), CHAT_RATE_LIMIT_ROOM=None)
+    def test_connection_rate(self):
+        async def scenario():
+            communicator = await self.connect()
+            for _ in range(3):
+                await communicator.send_to(text_data=json.dumps({"message": "hi", "username": "spam"}))
+            # the error is sent straight back while the two messages go through the room group
+            frames = [json.loads(await communicator.receive_from()) for _ in range(3)]
+            self.assertIn({"type": "error", "error": "rate limited", "limit": "connection"}, frames)
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+            await message_buffer.close()
+
+        limited = metrics.RATE_LIMITED.value("connection")
+        async_to_sync(scenario)()
+        self.assertEqual(metrics.RATE_LIMITED.value("connection"), limited + 1)
+
+    @override_settings(CHAT_RATE_LIMIT_CONNECTION=None, CHAT_RATE_LIMIT_ROOM=(0.001, 1))
+    def test_room_rate_and_sizes(self):
+        async def scenario():
+            communicator = await self.connect()
+            await communicator.send_to(text_data=json.dumps({"message": "x" * 21, "username": "spam"}))
+            frame = json.loads(await communicator.receive_from())
+            self.assertEqual(frame["limit"], "message_size")
+
+            await communicator.send_to(text_data=json.dumps({"message": "hi", "username": "spam"}))
+            self.assertEqual(json.loads(await communicator.receive_from())["message"], "hi")
+            await communicator.send_to(text_data=json.dumps({"message": "hi", "username": "spam"}))
+            frame = json.loads(await communicator.receive_from())
+            self.assertEqual(frame["limit"], "room")
+
+            # a frame that is too big closes the connection without being decoded
+            await communicator.send_to(text_data="{" * 201)
+            self.assertEqual(await communicator.receive_output(), {"type": "websocket.close", "code": 1009})
+            await communicator.disconnect()
+            await message_buffer.close()
+
+        async_to_sync(scenario)()
+
+
+class WireFormatTests(TestCase):
+    def history(self, count):
+        messages = [
+            {"id": number, "message": f"message number {number}", "username": "alice", "timestamp": "2024-07-28T18:30:00"}
+            for number in range(count)
+        ]
+        return codec.dumps({"type": "history", "messages": messages, "has_more": True})
+
+    def test_round_trip_and_size(self):
+        text = self.history(50)
+        obj = json.loads(text)
+
+        packed = codec.WIRE_FORMATS["chat.msgpack"].encode(text)["bytes"]
+        self.assertEqual(msgpack.unpackb(packed), obj)
+        self.assertLess(len(packed), len(text))
+
+        compressed = codec.WIRE_FORMATS["chat.json.deflate"].encode(text)["bytes"]
+        self.assertEqual(zlib.decompress(compressed).decode(), text)
+        self.assertLess(len(compressed), len(text) / 4)
+
+        wrapper = msgpack.unpackb(codec.WIRE_FORMATS["chat.msgpack.deflate"].encode(text)["bytes"])
+        self.assertEqual(wrapper["type"], "deflate")
+        self.assertEqual(msgpack.unpackb(zlib.decompress(wrapper["data"])), obj)
+
+        # a small frame isn't worth compressing
+        small = codec.dumps({"message": "hi", "username": "alice"})
+        self.assertEqual(codec.WIRE_FORMATS["chat.json.deflate"].encode(small), {"type": "websocket.send", "text": small})
+        self.assertEqual(codec.WIRE_FORMATS["chat.msgpack"].decode(bytes_data=msgpack.packb({"a": 1})), {"a": 1})
+
+    @override_settings(
+        CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS,
+        CHAT_SEQUENCE_BACKEND=LOCAL_SEQUENCE_BACKEND,
+        CHAT_DIRECTORY_BACKEND=LOCAL_DIRECTORY_BACKEND,
+    )
+    def test_consumer_speaks_the_negotiated_format(self):
+        async def scenario():
+            communicator = WebsocketCommunicator(
+                websocket_application, "/ws/ChatApp/packed/", subprotocols=["chat.msgpack", "chat.json"]
+            )
+            connected, subprotocol = await communicator.connect()
+            self.assertEqual(subprotocol, "chat.msgpack")
+            frame = msgpack.unpackb(await communicator.receive_from())
+            self.assertEqual(frame["type"], "history")
+
+            await communicator.send_to(bytes_data=msgpack.packb({"message": "hello", "username": "alice"}))
+            frame = msgpack.unpackb(await communicator.receive_from())
+            self.assertEqual((frame["message"], frame["username"]), ("hello", "alice"))
+
+            await communicator.disconnect()
+            await message_buffer.close()
+
+        recent_messages.clear()
+        async_to_sync(scenario)()
+
+
+class PageTests(TestCase):
+    def setUp(self):
+        page_cache.clear()
+
+    def test_chat_room_is_rendered_once_and_revalidated(self):
+        response = self.client.get(reverse("chat_room", args=["lobby"]))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("no-cache", response["Cache-Control"])
+        # the script & the styles are static files, not inline
+        self.assertContains(response, "ChatApp/chat_room.js")
+        self.assertNotContains(response, "new WebSocket")
+        etag = response["ETag"]
+        page = page_cache.get("chat_room.html", key="lobby")
+        self.assertEqual(page[1], etag)
+
+        # a browser that has the page is told it hasn't changed
+        response = self.client.get(reverse("chat_room", args=["lobby"]), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+
+        # each room has its own page
+        response = self.client.get(reverse("chat_room", args=["kitchen"]), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '"kitchen"')
+
+    @override_settings(CHAT_PAGE_CACHE_SIZE=1)
+    def test_least_recently_used_page_is_dropped(self):
+        first = page_cache.get("chat_room.html", {"room_name": "lobby", "heartbeat_interval": 15}, key="lobby")
+        self.assertIs(page_cache.get("chat_room.html", key="lobby"), first)
+        page_cache.get("index.html")
+        self.assertIsNot(
+            page_cache.get("chat_room.html", {"room_name": "lobby", "heartbeat_interval": 15}, key="lobby"), first
+        )
+
+
+# a new auth cache is created for the tests & dropped after them
+@override_settings(CHAT_AUTH_CACHE_BACKEND="ChatApp.auth.LocalAuthCache")
+class CachedAuthMiddlewareTests(TestCase):
+    def connect_as(self, cookie):
+        users = []
+
+        async def application(scope, receive, send):
+            users.append(scope["user"].username)
+            await send({"type": "websocket.close"})
+
+        async def scenario():
+            headers = [(b"cookie", cookie.encode())] if cookie else []
+            communicator = WebsocketCommunicator(CachedAuthMiddlewareStack(application), "/ws/", headers=headers)
+            await communicator.connect()
+
+        async_to_sync(scenario)()
+        return users[0]
+
+    def test_session_user_is_cached_until_logout(self):
+        from django.contrib.auth.models import User
+
+        User.objects.create_user("alice", password="secret")
+        self.client.login(username="alice", password="secret")
+        cookie = f"sessionid={self.client.cookies['sessionid'].value}"
+        hits = metrics.AUTH_CACHE.value("hit")
+
+        self.assertEqual(self.connect_as(cookie), "alice")
+        # the second handshake of the session doesn't read the database
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.connect_as(cookie), "alice")
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(metrics.AUTH_CACHE.value("hit"), hits + 1)
+
+        # the logout drops the session from the cache, so the next handshake is anonymous
+        self.client.logout()
+        self.assertEqual(self.connect_as(cookie), "")
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.connect_as(""), "")
+        self.assertEqual(len(queries), 0)
+
+class MetricsTests(TestCase):
+    def test_metrics_view_renders_prometheus_text(self):
+        histogram = metrics.Histogram("test_latency_seconds", "A test histogram.", buckets=(0.1, 1))
+        try:
+            histogram.observe(0.05)
+            histogram.observe(0.5)
+            response = self.client.get(reverse("metrics"))
+        finally:
+            metrics.registry.remove(histogram)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        body = response.content.decode()
+        self.assertIn("# TYPE test_latency_seconds histogram", body)
+        self.assertIn('test_latency_seconds_bucket{le="0.1"} 1', body)
+        self.assertIn('test_latency_seconds_bucket{le="+Inf"} 2', body)
+        self.assertIn("test_latency_seconds_count 2", body)
+
+    @override_settings(METRICS_ENABLED=False)
+    def test_disabled_metrics_record_nothing(self):
+        counter = metrics.Counter("test_total", "A test counter.", ("room",))
+        metrics.registry.remove(counter)
+        counter.inc("lobby")
+        self.assertEqual(counter.value("lobby"), 0)
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 404)
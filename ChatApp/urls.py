@@ -7,7 +7,19 @@ from . import views
 # set a path to the chat_room function in views.py & name it
 # - NOTE: include ChatApp to explicitly match URLs that start with /ChatApp/ followed by a dynamic room name, 
 # - matching the pathname the JavaScript in index.html was set to redirect 
+# set a path to the metrics function in views.py next to the index, for Prometheus to scrape
+# set a path to the history function in views.py to fetch a page of a chat room's history as JSON
+# set a path to the search function in views.py to search the history of a chat room
+# set a path to the online_users function in views.py to fetch the users who are online in a chat room as JSON
+# set a path to the shard function in views.py to find the shard that hosts a chat room
+# set a path to the rooms function in views.py to list the busiest chat rooms as JSON
 urlpatterns = [
     path("", views.index, name="index"),
+    path("metrics/", views.metrics, name="metrics"),
+    path("rooms/", views.rooms, name="rooms"),
     path("ChatApp/<str:room_name>/", views.chat_room, name="chat_room"),
+    path("ChatApp/<str:room_name>/history/", views.history, name="history"),
+    path("ChatApp/<str:room_name>/search/", views.search, name="search"),
+    path("ChatApp/<str:room_name>/online/", views.online_users, name="online_users"),
+    path("ChatApp/<str:room_name>/shard/", views.shard, name="shard"),
     ]
@@ -1,11 +1,45 @@
-# import render
-from django.shortcuts import render
 # import HttpResponse to test that the view shows after runserver
 from django.http import HttpResponse
+# import JsonResponse to return the history of a chat room as JSON
+from django.http import JsonResponse
+# import settings to pass the presence heartbeat interval to the chat room template
+from django.conf import settings
+# import parse_datetime to read the time range of a search
+from django.utils.dateparse import parse_datetime
+from django.utils import timezone
+
+# import Http404 to hide the metrics view when the metrics are turned off
+from django.http import Http404
+# import condition & cache_control to answer the requests for a cached page the browser already has with 304
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+# import patch_cache_control to let the browsers & proxies reuse the room directory while it's cached
+from django.utils.cache import patch_cache_control
+
+from . import metrics as chat_metrics
+from .directory import hot_rooms
+from .history import get_history
+from .search import search_messages
+from .pages import page_cache
+from .presence import presence_store
+from .sharding import shard_map
 
 # Create your views here.
+# return the cached HTML & ETag of the homepage
+def _index_page():
+    return page_cache.get("index.html")
+
+# return the cached HTML & ETag of a chat room
+# - pass the number of seconds between the heartbeats that keep the user online in the room
+def _chat_room_page(room_name):
+    context = {"room_name": room_name, "heartbeat_interval": getattr(settings, "PRESENCE_HEARTBEAT_INTERVAL", 15)}
+    return page_cache.get("chat_room.html", context, key=room_name)
+
 # create a view for the homepage of the app 
 # - load index.html into the function
+# - the page is rendered once & the browser checks its ETag on every visit, no-cache means "revalidate", not "don't store"
+@cache_control(no_cache=True)
+@condition(etag_func=lambda request: _index_page()[1])
 def index(request):
     """A view for the homepage of the ChatApp.
 
@@ -17,10 +51,29 @@ def index(request):
     # runserver to check if HttpResponse shows in webpage then comment out HttpResponse
     # return HttpResponse("<h2>Hello World</h2>")
     # render the index template
-    return render(request, "index.html")
+    # - the page has no per-user content, so it's rendered once without the context processors & cached
+    return HttpResponse(_index_page()[0])
+
+# create a view that returns the metrics of this worker in the Prometheus text format
+# - scrape it with Prometheus, e.g. /metrics/
+def metrics(request):
+    """A view for the metrics of the consumers in this worker.
+
+    :param request: The HTTP request object containing information about the client's request.
+    :type request: HttpRequest
+    :return: Return the metrics in the Prometheus text exposition format
+    :rtype: HttpResponse
+    """
+    # the view doesn't exist when METRICS_ENABLED is False
+    if not chat_metrics.enabled:
+        raise Http404("Metrics are disabled")
+    return HttpResponse(chat_metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
 
 # create a view for the chat room of the app 
 # - load chat_room.html into the function
+# - the page of each room is rendered once & the browser checks its ETag on every visit
+@cache_control(no_cache=True)
+@condition(etag_func=lambda request, room_name: _chat_room_page(room_name)[1])
 def chat_room(request, room_name):
     """A view for the chat room of the ChatApp.
 
@@ -31,9 +84,108 @@ def chat_room(request, room_name):
     :return: Return the chat_room template
     :rtype: HttpResponse
     """
-    # the response is the dictionary for the room names
-    # pass the context variables into a single dictionary to render in the template correctly
-    context = {"room_name": room_name}
+    # the context is the room name & the heartbeat interval, see _chat_room_page
+    # - the page is rendered once per room without the context processors & cached
+    return HttpResponse(_chat_room_page(room_name)[0])
+
+# create a view that returns a page of the history of a chat room as JSON
+# - e.g. /ChatApp/lobby/history/?before=120&limit=50, or ?before_seq=42 from the sequence number of a live message
+def history(request, room_name):
+    """A view for a page of the history of a chat room.
+
+    :param request: The HTTP request object, with optional "before", "after", "before_seq", "after_seq" & "limit"
+        query parameters.
+    :type request: HttpRequest
+    :param room_name: The name of the chat room.
+    :type room_name: str
+    :return: Return the messages of the page & whether there are more messages
+    :rtype: JsonResponse
+    """
+    # the cursors & the limit are optional but must be whole numbers when they are given
+    cursors = ("before", "after", "before_seq", "after_seq", "limit")
+    try:
+        params = {key: int(request.GET[key]) for key in cursors if key in request.GET}
+    except ValueError:
+        return JsonResponse({"error": "before, after, before_seq, after_seq and limit must be integers"}, status=400)
+
+    try:
+        return JsonResponse(get_history(room_name, **params))
+    except ValueError as error:
+        return JsonResponse({"error": str(error)}, status=400)
+
+# create a view that searches the history of a chat room & returns a page of the results as JSON
+# - e.g. /ChatApp/lobby/search/?q=deploy&username=alice&since=2024-07-01T00:00:00Z&until=...&before=1200&limit=20
+def search(request, room_name):
+    """A view for a page of the messages of a chat room that contain the words of a search, newest first.
+
+    :param request: The HTTP request object, with the "q" query parameter & optional "username", "since", "until",
+        "before" & "limit" query parameters.
+    :type request: HttpRequest
+    :param room_name: The name of the chat room.
+    :type room_name: str
+    :return: Return the messages of the page & whether there are more messages, pass the id of the last message as
+        "before" to fetch the next page
+    :rtype: JsonResponse
+    """
+    query = request.GET.get("q", "")
+    if not query.strip():
+        return JsonResponse({"error": "q is required"}, status=400)
+    try:
+        params = {key: int(request.GET[key]) for key in ("before", "limit") if key in request.GET}
+    except ValueError:
+        return JsonResponse({"error": "before and limit must be integers"}, status=400)
+    # the time range is ISO 8601, a time without a timezone is in the server's timezone
+    for key in ("since", "until"):
+        if key in request.GET:
+            params[key] = parse_datetime(request.GET[key])
+            if params[key] is None:
+                return JsonResponse({"error": f"{key} must be an ISO 8601 date and time"}, status=400)
+            if timezone.is_naive(params[key]):
+                params[key] = timezone.make_aware(params[key])
+
+    return JsonResponse(search_messages(room_name, query, username=request.GET.get("username") or None, **params))
+
+# create a view that returns the users who are online in a chat room as JSON
+# - it's asynchronous because the presence store is read with the async Redis client
+async def online_users(request, room_name):
+    """A view for the users who are online in a chat room.
+
+    :param request: The HTTP request object containing information about the client's request.
+    :type request: HttpRequest
+    :param room_name: The name of the chat room.
+    :type room_name: str
+    :return: Return the usernames that are online in the room
+    :rtype: JsonResponse
+    """
+    # only the room's own sorted set is read, not the online users of every room
+    return JsonResponse({"room_name": room_name, "users": await presence_store.online_users(room_name)})
+
+# create a view that tells a client or a front proxy which shard hosts a chat room
+# - e.g. /ChatApp/lobby/shard/ -> {"room_name": "lobby", "shard": "b", "url": "ws://10.0.0.2:8001"}
+def shard(request, room_name):
+    """A view for the shard of a chat room.
 
-    # render the context to the chat_room template of ChatApp
-    return render(request, "chat_room.html", context)
\ No newline at end of file
+    :param request: The HTTP request object containing information about the client's request.
+    :type request: HttpRequest
+    :param room_name: The name of the chat room.
+    :type room_name: str
+    :return: Return the name & the WebSocket base URL of the shard, both null when the rooms aren't sharded
+    :rtype: JsonResponse
+    """
+    return JsonResponse({"room_name": room_name, **(shard_map.shard_for(room_name) or {"shard": None, "url": None})})
+
+# create a view that returns the busiest chat rooms as JSON, e.g. for the homepage or an operator's dashboard
+# - e.g. /rooms/ -> {"rooms": [{"room_name": "lobby", "members": 12}], "active_rooms": 3}
+# - it's asynchronous because the directory is read with the async Redis client
+async def rooms(request):
+    """A view for the directory of the active chat rooms.
+
+    :param request: The HTTP request object containing information about the client's request.
+    :type request: HttpRequest
+    :return: Return the busiest rooms with their member counts & the number of rooms with members
+    :rtype: JsonResponse
+    """
+    # the counts are kept as the members come & go, so the view reads the top of the directory, cached for a moment
+    response = JsonResponse(await hot_rooms())
+    patch_cache_control(response, max_age=getattr(settings, "CHAT_DIRECTORY_CACHE_TTL", 2))
+    return response
@@ -0,0 +1,158 @@
+# https://channels.readthedocs.io/en/stable/topics/worker.html
+# a background worker for the "presence_channel" channel
+# - ChatConsumer sends an add_user event when a chat socket connects & a remove_user event when it disconnects
+# - run it with: python manage.py runworker presence_channel
+# the events are collected into batches so a reconnect storm costs one pipelined Redis round trip per batch,
+# - & a user who disconnects & reconnects within a batch (e.g. a page refresh) doesn't change the presence store at all
+import asyncio
+import logging
+import time
+
+from channels.consumer import AsyncConsumer
+from django.conf import settings
+
+from . import metrics
+from .presence import presence_diffs, presence_store
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceBatch:
+    """The presence changes collected from the add_user & remove_user events of one batch."""
+
+    def __init__(self):
+        # (room name, username) -> [online before the batch, online after the batch]
+        self._changes = {}
+        self.events = 0
+
+    def __len__(self):
+        return self.events
+
+    def add(self, room_name, username, is_online):
+        """Record an add_user or remove_user event.
+
+        :param room_name: The name of the chat room.
+        :type room_name: str
+        :param username: The username of the user.
+        :type username: str
+        :param is_online: True for add_user, False for remove_user.
+        :type is_online: bool
+        """
+        self.events += 1
+        pair = (room_name, username)
+        if pair in self._changes:
+            self._changes[pair][1] = is_online
+        else:
+            self._changes[pair] = [not is_online, is_online]
+
+    def changes(self):
+        """Return the net change of each user, leaving out the users who were added & removed in the same batch.
+
+        :return: Whether each user is online, by (room name, username).
+        :rtype: dict
+        """
+        return {pair: after for pair, (before, after) in self._changes.items() if before != after}
+
+
+class PresenceWorkerStats:
+    """Throughput counters of the presence worker in this process."""
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.events = 0
+        self.deduplicated = 0
+        self.batches = 0
+        self.updates = 0
+        self.errors = 0
+
+    def as_dict(self):
+        """Return the counters and the events processed per second since the worker started.
+
+        :return: The counters by name.
+        :rtype: dict
+        """
+        elapsed = max(time.monotonic() - self.started_at, 1e-9)
+        return {
+            "events": self.events,
+            "deduplicated": self.deduplicated,
+            "batches": self.batches,
+            "updates": self.updates,
+            "errors": self.errors,
+            "events_per_second": self.events / elapsed,
+        }
+
+
+# the counters of the presence worker in this process
+worker_stats = PresenceWorkerStats()
+
+
+class PresenceWorker(AsyncConsumer):
+    """Consume the add_user & remove_user events sent to the "presence_channel" channel in batches.
+
+    A batch is written when it has ``PRESENCE_WORKER_BATCH_SIZE`` events or ``PRESENCE_WORKER_BATCH_WINDOW`` seconds
+    after its first event.
+    """
+
+    batch = None
+    flush_task = None
+
+    # add a user to the room's presence store
+    async def add_user(self, event):
+        await self.collect(event, True)
+
+    # remove a user from the room's presence store
+    async def remove_user(self, event):
+        await self.collect(event, False)
+
+    async def collect(self, event, is_online):
+        """Add an event to the current batch & write the batch when it is full.
+
+        :param event: The add_user or remove_user event sent by ChatConsumer.
+        :type event: dict
+        :param is_online: True for add_user, False for remove_user.
+        :type is_online: bool
+        """
+        worker_stats.events += 1
+        username = event.get("username")
+        if not username:
+            # there is nobody to show as online without a username
+            worker_stats.deduplicated += 1
+            return
+        # older ChatConsumers only sent the group name, which is the room name with a "chat_" prefix
+        room_name = event.get("room_name") or event["room_group_name"].removeprefix("chat_")
+
+        if self.batch is None:
+            self.batch = PresenceBatch()
+            self.flush_task = asyncio.ensure_future(self.flush_later())
+        self.batch.add(room_name, username, is_online)
+
+        # write a full batch straight away, the next event isn't handled until it's written
+        if len(self.batch) >= getattr(settings, "PRESENCE_WORKER_BATCH_SIZE", 500):
+            self.flush_task.cancel()
+            await self.flush()
+
+    async def flush_later(self):
+        await asyncio.sleep(getattr(settings, "PRESENCE_WORKER_BATCH_WINDOW", 0.1))
+        await self.flush()
+
+    async def flush(self):
+        """Write the net changes of the current batch to the presence store with one pipelined round trip."""
+        batch, self.batch = self.batch, None
+        if batch is None:
+            return
+        changes = batch.changes()
+        worker_stats.batches += 1
+        worker_stats.deduplicated += len(batch) - len(changes)
+        try:
+            changed = await presence_store.update_many(changes)
+        except Exception:
+            worker_stats.errors += 1
+            logger.exception("Failed to update the presence of %d users", len(changes))
+            return
+        worker_stats.updates += len(changed)
+        metrics.PRESENCE_UPDATES.inc("worker", amount=len(changed))
+
+        # tell the rooms about the users whose status changed
+        for room_name, username in changed:
+            presence_diffs.add(room_name, username, changes[(room_name, username)])
+        logger.debug("Presence worker: %s", worker_stats.as_dict())
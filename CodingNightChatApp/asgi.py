@@ -11,45 +11,61 @@ import os
 
 from django.core.asgi import get_asgi_application
 
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'CodingNightChatApp.settings')
+
+# https://channels.readthedocs.io/en/latest/installation.html#installation
+# initialise Django ASGI application early to ensure the AppRegistry is populated
+# - before importing code that may import ORM models.
+# - the consumers import the models, so this comes before the imports of ChatApp below
+#   for `daphne CodingNightChatApp.asgi:application`, which imports this module before Django is set up
+# changed application to django_asgi_app
+# application = get_asgi_application() -> this initialises a standard ASGI application that can handle HTTP requests.
+django_asgi_app = get_asgi_application()
+
 # https://channels.readthedocs.io/en/latest/installation.html#installation
 # adjust the project’s asgi.py file, e.g. CodingNightChatApp/asgi.py, to wrap the Django ASGI application
 # import ProtocolTypeRouter & URLRouter
 # https://channels.readthedocs.io/en/latest/tutorial/part_2.html#write-your-first-consumer
 # URLRouter will examine the HTTP path of the connection to route it to a particular consumer, based on the provided url patterns
 from channels.routing import ProtocolTypeRouter, URLRouter
+# import ChannelNameRouter to route the events sent to a named channel to a background worker
+# - https://channels.readthedocs.io/en/stable/topics/worker.html
+from channels.routing import ChannelNameRouter
 
-# import AuthMiddlewareStack to populate the connection’s scope with a reference to the currently authenticated user, 
+# import CachedAuthMiddlewareStack to populate the connection’s scope with a reference to the currently authenticated user, 
 # -(similar to how Django’s AuthenticationMiddleware populates the request object of a view with the currently authenticated user) 
 # - then the connection will be given to the URLRouter
-from channels.auth import AuthMiddlewareStack
+# - it's channels.auth.AuthMiddlewareStack with the user of each session cached, so reconnects don't read the database
+from ChatApp.auth import CachedAuthMiddlewareStack
 
 # import routing
 from ChatApp.routing import websocket_urlpatterns
 
+# import ShardListenerMiddleware so every process listens for the shards sent by `python manage.py reshard`
+# - from its first connection of any type, even if it never hosts a room
+from ChatApp.sharding import ShardListenerMiddleware
+
+# import the worker that consumes the add_user & remove_user events sent to "presence_channel"
+from ChatApp.workers import PresenceWorker
+
 # import Middleware to ensure WebSocket connections are only accepted from allowed hosts defined in ALLOWED_HOSTS,
 # - preventing Cross-Site WebSocket Hijacking (CSWSH) by verifying the request's origin.
 from channels.security.websocket import AllowedHostsOriginValidator
 
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'CodingNightChatApp.settings')
-
-# https://channels.readthedocs.io/en/latest/installation.html#installation
-# initialise Django ASGI application early to ensure the AppRegistry is populated
-# - before importing code that may import ORM models.
-# changed application to django_asgi_app
-# application = get_asgi_application() -> this initialises a standard ASGI application that can handle HTTP requests.
-django_asgi_app = get_asgi_application()
-
 # Now, create a more flexible ASGI application that uses ProtocolTypeRouter to route different types of protocols (e.g., HTTP, WebSocket).
 # add websocket to ProtocolTypeRouter list
 # when connecting to the Channels development server, the ProtocolTypeRouter will first inspect the type of connection
-# - if it is a WebSocket connection (ws:// or wss://), the connection will be given to the AuthMiddlewareStack
-application = ProtocolTypeRouter(
+# - if it is a WebSocket connection (ws:// or wss://), the connection will be given to the CachedAuthMiddlewareStack
+# add channel to ProtocolTypeRouter list so `python manage.py runworker presence_channel` runs the PresenceWorker
+# wrap the router in ShardListenerMiddleware to start listening for new shards with the first connection
+application = ShardListenerMiddleware(ProtocolTypeRouter(
     {
         "http": django_asgi_app,
         "websocket": AllowedHostsOriginValidator(
-            AuthMiddlewareStack(URLRouter(websocket_urlpatterns))
+            CachedAuthMiddlewareStack(URLRouter(websocket_urlpatterns))
         ),
+        "channel": ChannelNameRouter({"presence_channel": PresenceWorker.as_asgi()}),
     }
-)
+))
 
 
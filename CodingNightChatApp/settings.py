@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -87,6 +88,8 @@ ASGI_APPLICATION = "CodingNightChatApp.asgi.application"
 # configure channel layer
 # - a kind of communication system that allows multiple consumer instances to talk to each other & other parts of Django
 # NOTE: it's possible to configure multiple channel layers but most projects use a single 'default' channel layer
+# set "BACKEND" to "ChatApp.layers.HybridChannelLayer" to deliver a group message to the consumers of this process in
+# - memory & publish it once to Redis for the other processes, instead of pushing one copy per member to Redis
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
@@ -107,6 +110,83 @@ DATABASES = {
 }
 
 
+# the write-behind buffer that saves chat messages to the database (ChatApp/persistence.py)
+# - a batch is written with bulk_create when it has CHAT_HISTORY_BATCH_SIZE messages
+# - or when CHAT_HISTORY_FLUSH_INTERVAL seconds have passed since its first message
+# - consumers wait to add messages once CHAT_HISTORY_MAX_PENDING messages are waiting to be written
+CHAT_HISTORY_BATCH_SIZE = 100
+CHAT_HISTORY_FLUSH_INTERVAL = 0.05
+CHAT_HISTORY_MAX_PENDING = 5000
+
+# the in-memory cache of the latest messages of each room that is sent to new members (ChatApp/recent.py)
+# - RECENT_MESSAGES_PER_ROOM messages are kept for each room
+# - the least recently used rooms are dropped when there are more than RECENT_MESSAGES_MAX_ROOMS rooms
+# - or the cached messages use more than RECENT_MESSAGES_MAX_BYTES bytes
+RECENT_MESSAGES_PER_ROOM = 50
+RECENT_MESSAGES_MAX_ROOMS = 1000
+RECENT_MESSAGES_MAX_BYTES = 16 * 1024 * 1024
+
+# use orjson to encode & decode the WebSocket frames when it's installed (ChatApp/codec.py)
+# - set to False to always use the json module
+CHAT_FAST_JSON = True
+
+# the users who are online in each room (ChatApp/presence.py)
+# - PRESENCE_BACKEND stores them in Redis sorted sets, with its own pool of connections to PRESENCE_REDIS_URL
+# - use "ChatApp.presence.InMemoryPresenceBackend" to run a single worker without a Redis server
+# - the browser sends a heartbeat every PRESENCE_HEARTBEAT_INTERVAL seconds
+# - a user is shown as offline PRESENCE_TTL seconds after their last heartbeat
+# - each worker sweeps the users whose heartbeats expired every PRESENCE_SWEEP_INTERVAL seconds
+PRESENCE_BACKEND = "ChatApp.presence.RedisPresenceBackend"
+PRESENCE_REDIS_URL = "redis://127.0.0.1:6379/0"
+PRESENCE_REDIS_MAX_CONNECTIONS = 50
+PRESENCE_HEARTBEAT_INTERVAL = 15
+PRESENCE_TTL = 45
+PRESENCE_SWEEP_INTERVAL = 15
+# the changes of a room's online users are collected for PRESENCE_BROADCAST_WINDOW seconds
+# - and sent to the room as one diff frame instead of one frame per change
+PRESENCE_BROADCAST_WINDOW = 0.25
+# the worker run with `python manage.py runworker presence_channel` (ChatApp/workers.py)
+# - writes the add_user & remove_user events of ChatConsumer to the presence store in batches
+# - of PRESENCE_WORKER_BATCH_SIZE events or PRESENCE_WORKER_BATCH_WINDOW seconds
+PRESENCE_WORKER_BATCH_SIZE = 500
+PRESENCE_WORKER_BATCH_WINDOW = 0.1
+# every WebSocket sends its frames through a queue of at most CHAT_SEND_QUEUE_SIZE frames (ChatApp/outbox.py)
+# - CHAT_SEND_QUEUE_POLICY is applied when a slow client's queue is full:
+# - "drop_oldest" drops the oldest frame, "coalesce" replaces the frames with one resync frame
+# - & "disconnect" closes the connection with CHAT_SEND_QUEUE_CLOSE_CODE
+CHAT_SEND_QUEUE_SIZE = 256
+CHAT_SEND_QUEUE_POLICY = "drop_oldest"
+CHAT_SEND_QUEUE_CLOSE_CODE = 4008
+# the flood control of the frames received from the WebSockets (ChatApp/ratelimit.py)
+# - a frame longer than CHAT_MAX_FRAME_SIZE characters closes the connection before it is decoded
+# - a chat message longer than CHAT_MAX_MESSAGE_LENGTH characters is rejected
+# - each connection & each room has a token bucket of (frames per second, burst)
+CHAT_MAX_FRAME_SIZE = 16384
+CHAT_MAX_MESSAGE_LENGTH = 2000
+CHAT_RATE_LIMIT_CONNECTION = (5, 10)
+CHAT_RATE_LIMIT_ROOM = (50, 100)
+CHAT_RATE_LIMIT_MAX_ROOMS = 10000
+# a client that connects with ?batch=<milliseconds>&batch_size=<messages> is sent the chat messages in batch frames
+# - (ChatApp/batching.py), the server caps the window in seconds & the messages in a batch
+CHAT_BATCH_MAX_WINDOW = 0.05
+CHAT_BATCH_MAX_SIZE = 100
+# a client can ask for msgpack frames or compressed frames with the subprotocols of its WebSocket (ChatApp/codec.py)
+# - "chat.json" (the default), "chat.msgpack", "chat.json.deflate" or "chat.msgpack.deflate"
+# - with .deflate the frames of at least CHAT_COMPRESS_MIN_SIZE characters are compressed, e.g. the history backfill
+CHAT_COMPRESS_MIN_SIZE = 4096
+# every message of a room is numbered by CHAT_SEQUENCE_BACKEND (ChatApp/sequence.py)
+# - a client that reconnects with ?since=<seq> is sent only the messages it missed while the recent message cache
+#   still has them all, & the latest page otherwise
+# - ChatApp.sequence.LocalRoomSequence counts in the worker, for a single worker without Redis
+CHAT_SEQUENCE_BACKEND = "ChatApp.sequence.RedisRoomSequence"
+CHAT_SEQUENCE_REDIS_URL = "redis://127.0.0.1:6379/0"
+
+
+# record the metrics of the consumers in this worker & serve them at /metrics/ (ChatApp/metrics.py)
+# - set to False to turn the recording & the view off
+METRICS_ENABLED = True
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -143,6 +223,73 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# the static files are copied here by `python manage.py collectstatic`
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+
+# collectstatic adds a hash of its content to the name of every static file, e.g. chat_room.3f2a9c1e.js,
+# - & {% static %} links to the hashed name, so the server in front of STATIC_ROOT can send the files with
+#   Cache-Control: public, max-age=31536000, immutable & a changed file gets a new URL
+# the hashed names need collectstatic to have been run, so they are only used when DEBUG is False
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': (
+            'django.contrib.staticfiles.storage.StaticFilesStorage'
+            if DEBUG
+            else 'django.contrib.staticfiles.storage.ManifestStaticFilesStorage'
+        ),
+    },
+}
+
+# the rendered pages of the index & the chat rooms kept by each worker, see ChatApp/pages.py
+CHAT_PAGE_CACHE_SIZE = 1000
+
+# the user of each session is cached for the WebSocket handshakes, see ChatApp/auth.py
+# - ChatApp.auth.LocalAuthCache keeps CHAT_AUTH_CACHE_SIZE sessions in each worker, a logout is seen by the worker
+#   that handled it straight away & by the others within CHAT_AUTH_CACHE_TTL seconds
+# - ChatApp.auth.RedisAuthCache keeps them in Redis at CHAT_AUTH_CACHE_REDIS_URL, a logout is seen by every worker
+CHAT_AUTH_CACHE_BACKEND = "ChatApp.auth.LocalAuthCache"
+CHAT_AUTH_CACHE_TTL = 30
+CHAT_AUTH_CACHE_SIZE = 10000
+CHAT_AUTH_CACHE_REDIS_URL = "redis://127.0.0.1:6379/0"
+
+# room sharding for a deployment with several Daphne processes, see ChatApp/sharding.py
+# - CHAT_SHARDS maps the name of each process to the WebSocket base URL it's reached at,
+#   e.g. {"a": "ws://10.0.0.1:8001", "b": "ws://10.0.0.2:8001"}, & each room is hosted by one of them
+# - CHAT_SHARD_NAME is the name of this process, set it with the CHAT_SHARD_NAME environment variable
+# - None lets every process host every room
+CHAT_SHARDS = None
+CHAT_SHARD_NAME = os.environ.get("CHAT_SHARD_NAME")
+CHAT_SHARD_REPLICAS = 100
+
+# the idle connections are pinged & closed, see ChatApp/liveness.py
+# - a connection that sent nothing for CHAT_PING_INTERVAL seconds is sent {"type": "ping"}, None turns the pings off
+# - a connection that sent nothing for CHAT_IDLE_TIMEOUT seconds is closed with CHAT_IDLE_CLOSE_CODE
+CHAT_PING_INTERVAL = 20
+CHAT_IDLE_TIMEOUT = 60
+CHAT_IDLE_CLOSE_CODE = 4011
+
+# the directory of the active rooms & their member counts, see ChatApp/directory.py
+# - ChatApp.directory.RedisRoomDirectory counts in a sorted set at CHAT_DIRECTORY_REDIS_URL shared by every worker
+# - ChatApp.directory.LocalRoomDirectory counts in each worker, for a single worker without Redis
+# - /rooms/ returns the CHAT_DIRECTORY_SIZE busiest rooms, cached for CHAT_DIRECTORY_CACHE_TTL seconds
+# - /ws/rooms/ pushes the new counts of the rooms that changed every CHAT_DIRECTORY_PUSH_WINDOW seconds
+CHAT_DIRECTORY_BACKEND = "ChatApp.directory.RedisRoomDirectory"
+CHAT_DIRECTORY_REDIS_URL = "redis://127.0.0.1:6379/0"
+CHAT_DIRECTORY_SIZE = 50
+CHAT_DIRECTORY_CACHE_TTL = 2
+CHAT_DIRECTORY_PUSH_WINDOW = 1
+
+# a worker of `python manage.py serve` drains when it's stopped, see ChatApp/server.py
+# - each client is told to reconnect after a random delay of up to CHAT_DRAIN_JITTER seconds
+#   & is closed with CHAT_DRAIN_CLOSE_CODE
+# - the worker stops after CHAT_DRAIN_TIMEOUT seconds even if some requests haven't finished
+CHAT_DRAIN_JITTER = 5
+CHAT_DRAIN_TIMEOUT = 10
+CHAT_DRAIN_CLOSE_CODE = 4012
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
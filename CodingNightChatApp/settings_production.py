@@ -0,0 +1,79 @@
+"""
+Production settings for CodingNightChatApp, used by `python manage.py serve`.
+
+Run with DJANGO_SETTINGS_MODULE=CodingNightChatApp.settings_production & set:
+
+- DJANGO_SECRET_KEY: the secret key
+- DJANGO_ALLOWED_HOSTS: the host names of the site, separated by commas
+- REDIS_URL: the Redis server shared by the workers, defaults to redis://127.0.0.1:6379/0
+- CHAT_CHANNEL_LAYER: the backend of the channel layer, defaults to channels_redis.core.RedisChannelLayer
+
+https://docs.djangoproject.com/en/4.2/howto/deployment/checklist/
+"""
+
+import os
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .settings import *  # noqa: F401,F403
+from .settings import INSTALLED_APPS, STORAGES
+
+DEBUG = False
+
+SECRET_KEY = os.environ.get("DJANGO_SECRET_KEY")
+if not SECRET_KEY:
+    raise ImproperlyConfigured("Set the DJANGO_SECRET_KEY environment variable")
+
+ALLOWED_HOSTS = [host.strip() for host in os.environ.get("DJANGO_ALLOWED_HOSTS", "").split(",") if host.strip()]
+
+# 'daphne' only adds its runserver command, & importing it installs Twisted's reactor when Django starts
+# - `python manage.py serve` forks its workers after Django starts & each one installs a reactor of its own
+INSTALLED_APPS = [app for app in INSTALLED_APPS if app != 'daphne']
+
+# the hashed names of the static files, settings.py picks them from DEBUG before it's changed here
+STORAGES = {
+    **STORAGES,
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.ManifestStaticFilesStorage',
+    },
+}
+
+# every worker shares the channel layer, the presence, the sequence numbers, the room directory & the cached
+# - session users through the same Redis server
+# - set CHAT_CHANNEL_LAYER=ChatApp.layers.HybridChannelLayer to send each group message to Redis once per worker
+REDIS_URL = os.environ.get("REDIS_URL", "redis://127.0.0.1:6379/0")
+CHANNEL_LAYERS = {
+    "default": {
+        "BACKEND": os.environ.get("CHAT_CHANNEL_LAYER", "channels_redis.core.RedisChannelLayer"),
+        "CONFIG": {
+            "hosts": [REDIS_URL],
+        },
+    },
+}
+PRESENCE_REDIS_URL = REDIS_URL
+CHAT_SEQUENCE_REDIS_URL = REDIS_URL
+CHAT_DIRECTORY_REDIS_URL = REDIS_URL
+# a logout is seen by every worker straight away
+CHAT_AUTH_CACHE_BACKEND = "ChatApp.auth.RedisAuthCache"
+CHAT_AUTH_CACHE_REDIS_URL = REDIS_URL
+
+# the workers log to the console of the master, e.g. the drains & the workers that exit
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'process': {
+            'format': '%(asctime)s [%(process)d] %(levelname)s %(name)s: %(message)s',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'process',
+        },
+    },
+    'root': {
+        'handlers': ['console'],
+        'level': 'INFO',
+    },
+}